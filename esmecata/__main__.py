@@ -19,13 +19,14 @@ import os
 import sys
 import time
 
-from esmecata.proteomes import check_proteomes, retrieve_proteomes
+from esmecata.proteomes import check_proteomes, retrieve_proteomes, make_taxonomy_index
 from esmecata.clustering import make_clustering
 from esmecata.annotation import annotate_proteins
 from esmecata.workflow import perform_workflow, perform_workflow_eggnog
 from esmecata.eggnog import annotate_with_eggnog
 from esmecata.utils import limited_integer_type, range_limited_float_type, is_valid_dir
 from esmecata.analysis import perform_analysis
+from esmecata.taxonomy import set_taxonomy_index
 from esmecata import __version__ as VERSION
 
 MESSAGE = '''
@@ -115,6 +116,13 @@ def main():
         required=False,
         action='store_true',
         default=None)
+    parent_parser_taxonomy_index = argparse.ArgumentParser(add_help=False)
+    parent_parser_taxonomy_index.add_argument(
+        '--taxonomy-index',
+        dest='taxonomy_index',
+        help='Taxonomy index file (created with esmecata taxonomy_index) used instead of ete3 NCBI Taxonomy database to query the taxonomy.',
+        required=False,
+        default=None)
     parent_parser_all_proteomes = argparse.ArgumentParser(add_help=False)
     parent_parser_all_proteomes.add_argument(
         '--all-proteomes',
@@ -176,6 +184,14 @@ def main():
         required=False,
         action='store_true',
         default=None)
+    parent_parser_nested_clustering = argparse.ArgumentParser(add_help=False)
+    parent_parser_nested_clustering.add_argument(
+        '--nested-clustering',
+        dest='nested_clustering',
+        help='Cluster only the taxa whose proteomes are not included in the proteomes of another taxon. The clusters of the nested taxa are derived from this clustering (faster but they can differ from a clustering of their proteomes).',
+        required=False,
+        action='store_true',
+        default=None)
     parent_parser_remove_tmp = argparse.ArgumentParser(add_help=False)
     parent_parser_remove_tmp.add_argument(
         '--remove-tmp',
@@ -226,6 +242,30 @@ def main():
             For example, if 'family' is given, only taxon ranks inferior or equal to family will be kept. \
             Look at the readme for more information (and a list of rank names).''',
         default=None)
+    parent_parser_subtree_rank = argparse.ArgumentParser(add_help=False)
+    parent_parser_subtree_rank.add_argument(
+        '--subtree-rank',
+        dest='subtree_rank',
+        required=False,
+        help='''Fetch the proteomes of the taxa at this rank (such as family) once and resolve the proteomes of the lower taxa of the affiliations \
+            with the lineages of the proteome organisms, instead of querying UniProt for each lower taxon.''',
+        default=None)
+    parent_parser_proteome_cache = argparse.ArgumentParser(add_help=False)
+    parent_parser_proteome_cache.add_argument(
+        '--proteome-cache',
+        dest='proteome_cache_file',
+        required=False,
+        help='''Pathname to a SQLite file storing the answers of the UniProt proteome queries for the UniProt release. \
+            It can be shared between runs (and between esmecata processes) to avoid querying UniProt again for the same taxa.''',
+        default=None)
+    parent_parser_proteome_store = argparse.ArgumentParser(add_help=False)
+    parent_parser_proteome_store.add_argument(
+        '--proteome-store',
+        dest='proteome_store_folder',
+        required=False,
+        help='''Pathname to a folder storing the downloaded proteomes for the UniProt release. \
+            It can be shared between runs and projects (and between esmecata processes), proteomes already in the store are linked in the output folder instead of being downloaded again.''',
+        default=None)
     parent_parser_minimal_number_proteomes = argparse.ArgumentParser(add_help=False)
     parent_parser_minimal_number_proteomes.add_argument(
         '--minimal-nb-proteomes',
@@ -293,7 +333,8 @@ def main():
             parent_parser_taxadb, parent_parser_all_proteomes, parent_parser_sparql,
             parent_parser_limit_maximal_number_proteomes, parent_parser_rank_limit,
             parent_parser_minimal_number_proteomes, parent_parser_update_affiliation,
-            parent_parser_bioservices
+            parent_parser_bioservices, parent_parser_taxonomy_index, parent_parser_subtree_rank,
+            parent_parser_proteome_cache, parent_parser_proteome_store
             ],
         allow_abbrev=False)
     proteomes_parser = subparsers.add_parser(
@@ -304,7 +345,8 @@ def main():
             parent_parser_taxadb, parent_parser_all_proteomes, parent_parser_sparql,
             parent_parser_limit_maximal_number_proteomes, parent_parser_rank_limit,
             parent_parser_minimal_number_proteomes, parent_parser_update_affiliation,
-            parent_parser_bioservices
+            parent_parser_bioservices, parent_parser_taxonomy_index, parent_parser_subtree_rank,
+            parent_parser_proteome_cache, parent_parser_proteome_store
             ],
         allow_abbrev=False)
     clustering_parser = subparsers.add_parser(
@@ -313,7 +355,7 @@ def main():
         parents=[
             parent_parser_i_clustering_folder, parent_parser_o, parent_parser_c,
             parent_parser_thr, parent_parser_mmseqs_options, parent_parser_linclust,
-            parent_parser_remove_tmp
+            parent_parser_remove_tmp, parent_parser_nested_clustering
             ],
         allow_abbrev=False)
     annotation_uniprot_parser = subparsers.add_parser(
@@ -344,7 +386,8 @@ def main():
             parent_parser_propagate, parent_parser_uniref, parent_parser_expression,
             parent_parser_rank_limit, parent_parser_minimal_number_proteomes,
             parent_parser_annotation_file, parent_parser_update_affiliation,
-            parent_parser_bioservices
+            parent_parser_bioservices, parent_parser_taxonomy_index, parent_parser_subtree_rank,
+            parent_parser_proteome_cache, parent_parser_proteome_store, parent_parser_nested_clustering
             ],
         allow_abbrev=False)
     workflow_eggnog_parser = subparsers.add_parser(
@@ -356,7 +399,9 @@ def main():
             parent_parser_all_proteomes, parent_parser_sparql, parent_parser_remove_tmp,
             parent_parser_limit_maximal_number_proteomes, parent_parser_thr, parent_parser_mmseqs_options,
             parent_parser_linclust, parent_parser_rank_limit, parent_parser_minimal_number_proteomes,
-            parent_parser_update_affiliation, parent_parser_bioservices, parent_parser_eggnog_tmp_dir
+            parent_parser_update_affiliation, parent_parser_bioservices, parent_parser_eggnog_tmp_dir,
+            parent_parser_taxonomy_index, parent_parser_subtree_rank,
+            parent_parser_proteome_cache, parent_parser_proteome_store, parent_parser_nested_clustering
             ],
         allow_abbrev=False)
     analysis_parser = subparsers.add_parser(
@@ -364,7 +409,14 @@ def main():
         help='Create clustermap for EC.',
         parents=[
             parent_parser_i_analysis_folder, parent_parser_o, parent_parser_taxon_rank,
-            parent_parser_nb_digit
+            parent_parser_nb_digit, parent_parser_taxonomy_index
+            ],
+        allow_abbrev=False)
+    taxonomy_index_parser = subparsers.add_parser(
+        'taxonomy_index',
+        help='Compile ete3 NCBI Taxonomy database into a memory-mapped taxonomy index usable by the other commands.',
+        parents=[
+            parent_parser_o, parent_parser_taxadb
             ],
         allow_abbrev=False)
 
@@ -398,6 +450,10 @@ def main():
         else:
             uniprot_sparql_endpoint = args.sparql
 
+    if args.cmd in ['proteomes', 'workflow_uniprot', 'workflow', 'check', 'analysis']:
+        if args.taxonomy_index is not None:
+            set_taxonomy_index(args.taxonomy_index)
+
     if args.cmd in ['proteomes', 'workflow_uniprot', 'workflow', 'check']:
         if args.busco is not None:
             busco_score = 100*args.busco
@@ -406,14 +462,17 @@ def main():
         retrieve_proteomes(args.input, args.output, busco_score, args.ignore_taxadb_update,
                             args.all_proteomes, uniprot_sparql_endpoint, args.limit_maximal_number_proteomes,
                             args.rank_limit, args.minimal_number_proteomes, args.update_affiliations,
-                            args.option_bioservices)
+                            args.option_bioservices, args.subtree_rank, args.proteome_cache_file,
+                            args.proteome_store_folder)
     if args.cmd == 'check':
         check_proteomes(args.input, args.output, busco_score, args.ignore_taxadb_update,
                             args.all_proteomes, uniprot_sparql_endpoint, args.limit_maximal_number_proteomes,
                             args.rank_limit, args.minimal_number_proteomes, args.update_affiliations,
-                            args.option_bioservices)
+                            args.option_bioservices, args.subtree_rank, args.proteome_cache_file,
+                            args.proteome_store_folder, cost_plan=True)
     elif args.cmd == 'clustering':
-        make_clustering(args.input, args.output, args.cpu, args.threshold_clustering, args.mmseqs_options, args.linclust, args.remove_tmp)
+        make_clustering(args.input, args.output, args.cpu, args.threshold_clustering, args.mmseqs_options, args.linclust, args.remove_tmp,
+                        args.nested_clustering)
     elif args.cmd == 'annotation_uniprot':
         annotate_proteins(args.input, args.output, uniprot_sparql_endpoint,
                         args.propagate_annotation, args.uniref, args.expression,
@@ -425,7 +484,8 @@ def main():
                             args.cpu, args.threshold_clustering, args.mmseqs_options,
                             args.linclust, args.propagate_annotation, args.uniref,
                             args.expression, args.minimal_number_proteomes, args.annotation_files,
-                            args.update_affiliations, args.option_bioservices)
+                            args.update_affiliations, args.option_bioservices, args.subtree_rank,
+                            args.proteome_cache_file, args.proteome_store_folder, args.nested_clustering)
     elif args.cmd == 'annotation':
         annotate_with_eggnog(args.input, args.output, args.eggnog_database, args.cpu,
                              args.eggnog_tmp_dir)
@@ -435,9 +495,12 @@ def main():
                                 args.remove_tmp, args.limit_maximal_number_proteomes, args.rank_limit,
                                 args.cpu, args.threshold_clustering, args.mmseqs_options,
                                 args.linclust, args.minimal_number_proteomes, args.update_affiliations,
-                                args.option_bioservices, args.eggnog_tmp_dir)
+                                args.option_bioservices, args.eggnog_tmp_dir, args.subtree_rank,
+                                args.proteome_cache_file, args.proteome_store_folder, args.nested_clustering)
     elif args.cmd == 'analysis':
         perform_analysis(args.input, args.output, args.taxon_rank, args.nb_digit)
+    elif args.cmd == 'taxonomy_index':
+        make_taxonomy_index(args.output, args.ignore_taxadb_update)
 
     logger.info("--- Total runtime %.2f seconds ---" % (time.time() - start_time))
     logger.warning(f'--- Logs written in {log_file_path} ---')
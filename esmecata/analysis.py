@@ -21,7 +21,8 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 
 from collections import Counter
-from ete3 import NCBITaxa
+
+from esmecata.taxonomy import get_taxonomy_service
 
 logger = logging.getLogger(__name__)
 
@@ -79,7 +80,7 @@ def get_taxon_obs_name(proteome_tax_id_file, selected_taxon_rank='family'):
     Returns:
         taxa_name (dict): annotation dict: taxon_name as key and observation_name as value
     """
-    ncbi = NCBITaxa()
+    ncbi = get_taxonomy_service()
     taxa_name = {}
     total_obs_name = []
     selected_obs_name = []
@@ -0,0 +1,381 @@
+# Copyright (C) 2021-2024 Arnaud Belcour - Inria, Univ Rennes, CNRS, IRISA Dyliss
+# Univ. Grenoble Alpes, Inria, Microcosme
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Entries of the proteome cache older than this number of seconds are removed (30 days).
+PROTEOME_CACHE_MAX_AGE = 30 * 24 * 3600
+
+# Maximal number of entries of the proteome cache, the least recently used entries are removed first.
+PROTEOME_CACHE_MAX_ENTRIES = 200000
+
+# UniProt release stored in the proteome cache is used without querying UniProt during this number of seconds (1 day).
+UNIPROT_RELEASE_MAX_AGE = 24 * 3600
+
+# Time (in seconds) waited by a process when the cache is locked by another process.
+PROTEOME_CACHE_TIMEOUT = 60
+
+# Maximal total size (in bytes) of the proteome files of the proteome store, the least recently used proteomes are removed first (100 GB).
+PROTEOME_STORE_MAX_SIZE = 100 * 1024**3
+
+# Name of the SQLite database indexing the proteome files of the proteome store.
+PROTEOME_STORE_DATABASE = 'proteome_store.sqlite'
+
+
+def compute_file_checksum(file_path):
+    """ Compute the SHA-256 checksum of a file.
+
+    Args:
+        file_path (str): pathname to the file
+
+    Returns:
+        checksum (str): hexadecimal SHA-256 checksum of the file
+    """
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class SQLiteCache:
+    """ Base class of the caches stored in a SQLite database shared between esmecata runs.
+    Each thread uses its own connection and the database is in WAL mode, so the cache can be used by several threads and esmecata processes.
+    """
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self.statistics_lock = threading.Lock()
+        self.connections = threading.local()
+
+        cache_folder = os.path.dirname(os.path.abspath(cache_file))
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+
+    def _connect(self):
+        """ Return the connection of the current thread to the cache database (created at the first call of the thread).
+
+        Returns:
+            connection (sqlite3.Connection): connection to the cache database
+        """
+        connection = getattr(self.connections, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.cache_file, timeout=PROTEOME_CACHE_TIMEOUT)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.connections.connection = connection
+        return connection
+
+    def _count(self, hit):
+        """ Count a hit or a miss of the cache.
+
+        Args:
+            hit (bool): True for a hit, False for a miss
+        """
+        with self.statistics_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def close(self):
+        """ Close the connection of the current thread to the cache database.
+        """
+        connection = getattr(self.connections, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.connections.connection = None
+
+
+class ProteomeMetadataCache(SQLiteCache):
+    """ SQLite cache of the answers of the UniProt proteome queries shared between esmecata runs.
+    Answers are stored for a taxon ID, the query options and the UniProt release, so a new UniProt release leads to new queries.
+    """
+    def __init__(self, cache_file, max_age=PROTEOME_CACHE_MAX_AGE, max_entries=PROTEOME_CACHE_MAX_ENTRIES):
+        super().__init__(cache_file)
+        self.max_age = max_age
+        self.max_entries = max_entries
+
+        connection = self._connect()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS proteome_queries (tax_id TEXT, query_options TEXT, uniprot_release TEXT, '
+                               'answer TEXT, creation_time REAL, access_time REAL, PRIMARY KEY (tax_id, query_options, uniprot_release))')
+            connection.execute('CREATE INDEX IF NOT EXISTS proteome_queries_access_time ON proteome_queries (access_time)')
+            connection.execute('CREATE TABLE IF NOT EXISTS uniprot_releases (query_system TEXT PRIMARY KEY, uniprot_release TEXT, access_time REAL)')
+        self.evict()
+
+    def get_uniprot_release(self, query_system, release_function, max_age=UNIPROT_RELEASE_MAX_AGE):
+        """ Return the UniProt release stored for a query system if it is more recent than max_age, otherwise get it with release_function and store it.
+
+        Args:
+            query_system (str): name of the system used to query UniProt (REST or SPARQL endpoint)
+            release_function (function): function without argument returning the current UniProt release
+            max_age (float): number of seconds during which a stored UniProt release is used
+
+        Returns:
+            uniprot_release (str): UniProt release
+        """
+        connection = self._connect()
+        row = connection.execute('SELECT uniprot_release, access_time FROM uniprot_releases WHERE query_system = ?', (query_system,)).fetchone()
+        if row is not None and time.time() - row[1] < max_age:
+            return row[0]
+
+        uniprot_release = release_function()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO uniprot_releases VALUES (?, ?, ?)', (query_system, uniprot_release, time.time()))
+        return uniprot_release
+
+    def get(self, tax_id, query_options, uniprot_release):
+        """ Get the answer of a proteome query.
+
+        Args:
+            tax_id (str): taxon ID queried
+            query_options (dict): options of the query
+            uniprot_release (str): UniProt release
+
+        Returns:
+            answer: answer stored for the query or None if the query is not in the cache
+        """
+        key = (str(tax_id), json.dumps(query_options, sort_keys=True), uniprot_release)
+        connection = self._connect()
+        row = connection.execute('SELECT answer, creation_time FROM proteome_queries WHERE tax_id = ? AND query_options = ? AND uniprot_release = ?', key).fetchone()
+
+        if row is None or time.time() - row[1] > self.max_age:
+            self._count(False)
+            return None
+
+        with connection:
+            connection.execute('UPDATE proteome_queries SET access_time = ? WHERE tax_id = ? AND query_options = ? AND uniprot_release = ?', (time.time(), *key))
+        self._count(True)
+        return json.loads(row[0])
+
+    def put(self, tax_id, query_options, uniprot_release, answer):
+        """ Store the answer of a proteome query.
+
+        Args:
+            tax_id (str): taxon ID queried
+            query_options (dict): options of the query
+            uniprot_release (str): UniProt release
+            answer: answer of the query (must be serializable in JSON)
+        """
+        current_time = time.time()
+        connection = self._connect()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO proteome_queries VALUES (?, ?, ?, ?, ?, ?)',
+                               (str(tax_id), json.dumps(query_options, sort_keys=True), uniprot_release, json.dumps(answer), current_time, current_time))
+
+    def evict(self):
+        """ Remove the entries older than max_age and the least recently used entries exceeding max_entries.
+
+        Returns:
+            nb_removed_entries (int): number of entries removed from the cache
+        """
+        connection = self._connect()
+        with connection:
+            nb_removed_entries = connection.execute('DELETE FROM proteome_queries WHERE creation_time < ?', (time.time() - self.max_age,)).rowcount
+            nb_entries = connection.execute('SELECT COUNT(*) FROM proteome_queries').fetchone()[0]
+            if nb_entries > self.max_entries:
+                nb_removed_entries += connection.execute('DELETE FROM proteome_queries WHERE rowid IN '
+                                                         '(SELECT rowid FROM proteome_queries ORDER BY access_time LIMIT ?)', (nb_entries - self.max_entries,)).rowcount
+        if nb_removed_entries > 0:
+            logger.info('|EsMeCaTa|proteome_cache| %d entries removed from the proteome cache %s.', nb_removed_entries, self.cache_file)
+        return nb_removed_entries
+
+    def cache_statistics(self):
+        """ Return the number of hits and misses of the cache.
+
+        Returns:
+            statistics (dict): hits, misses and number of entries of the cache
+        """
+        nb_entries = self._connect().execute('SELECT COUNT(*) FROM proteome_queries').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'size': nb_entries}
+
+
+class ProteomeStore(SQLiteCache):
+    """ Proteome files shared between esmecata runs and projects.
+    Proteome files are stored by their SHA-256 checksum (so identical files from several UniProt releases are stored once)
+    and indexed by proteome ID and UniProt release in a SQLite database.
+    Proteomes are hard linked in the proteomes folder of the runs (or copied if the store is on another file system).
+    """
+    def __init__(self, store_folder, max_size=PROTEOME_STORE_MAX_SIZE):
+        super().__init__(os.path.join(store_folder, PROTEOME_STORE_DATABASE))
+        self.store_folder = store_folder
+        self.max_size = max_size
+
+        connection = self._connect()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS proteomes (proteome_id TEXT, uniprot_release TEXT, checksum TEXT, size INTEGER, '
+                               'access_time REAL, PRIMARY KEY (proteome_id, uniprot_release))')
+            connection.execute('CREATE INDEX IF NOT EXISTS proteomes_checksum ON proteomes (checksum)')
+
+    def _object_path(self, checksum):
+        """ Return the pathname of the file of the store with this checksum.
+
+        Args:
+            checksum (str): SHA-256 checksum of the proteome file
+
+        Returns:
+            object_path (str): pathname to the proteome file in the store
+        """
+        return os.path.join(self.store_folder, 'objects', checksum[:2], checksum + '.faa.gz')
+
+    def link(self, proteome_id, uniprot_release, output_proteome_file):
+        """ Link the proteome file of the store in output_proteome_file if the store contains it for this UniProt release.
+        The checksum of the file is checked before linking it.
+
+        Args:
+            proteome_id (str): proteome ID
+            uniprot_release (str): UniProt release
+            output_proteome_file (str): pathname to the proteome file to create
+
+        Returns:
+            linked (bool): True if the proteome has been linked, False if it is not in the store
+        """
+        connection = self._connect()
+        row = connection.execute('SELECT checksum FROM proteomes WHERE proteome_id = ? AND uniprot_release = ?', (proteome_id, uniprot_release)).fetchone()
+        if row is None:
+            self._count(False)
+            return False
+
+        checksum = row[0]
+        object_path = self._object_path(checksum)
+        # The file can have been removed by another process evicting it or be corrupted.
+        if not os.path.exists(object_path) or compute_file_checksum(object_path) != checksum:
+            logger.warning('|EsMeCaTa|proteome_store| Proteome %s is missing or corrupted in the proteome store, it will be downloaded.', proteome_id)
+            with connection:
+                connection.execute('DELETE FROM proteomes WHERE checksum = ?', (checksum,))
+            if os.path.exists(object_path):
+                os.remove(object_path)
+            self._count(False)
+            return False
+
+        try:
+            os.link(object_path, output_proteome_file)
+        except FileNotFoundError:
+            self._count(False)
+            return False
+        except OSError:
+            # The store is on another file system: the proteome is copied, as a symbolic link would be broken once the proteome is evicted.
+            # It is copied with a temporary name and renamed, so an interrupted copy never leaves an incomplete proteome file.
+            file_descriptor, tmp_proteome_file = tempfile.mkstemp(prefix='.'+proteome_id+'_', suffix='.faa.gz.tmp', dir=os.path.dirname(output_proteome_file) or '.')
+            os.close(file_descriptor)
+            try:
+                shutil.copyfile(object_path, tmp_proteome_file)
+                os.replace(tmp_proteome_file, output_proteome_file)
+            except FileNotFoundError:
+                self._count(False)
+                return False
+            finally:
+                if os.path.exists(tmp_proteome_file):
+                    os.remove(tmp_proteome_file)
+
+        with connection:
+            connection.execute('UPDATE proteomes SET access_time = ? WHERE proteome_id = ? AND uniprot_release = ?', (time.time(), proteome_id, uniprot_release))
+        self._count(True)
+        return True
+
+    def get_size(self, proteome_id, uniprot_release):
+        """ Return the size of the proteome file of the store for this UniProt release (without checking the file, nor counting a hit or a miss).
+
+        Args:
+            proteome_id (str): proteome ID
+            uniprot_release (str): UniProt release
+
+        Returns:
+            size (int): size (in bytes) of the proteome file or None if it is not in the store
+        """
+        row = self._connect().execute('SELECT size FROM proteomes WHERE proteome_id = ? AND uniprot_release = ?', (proteome_id, uniprot_release)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def add(self, proteome_id, uniprot_release, proteome_file):
+        """ Add a proteome file to the store.
+
+        Args:
+            proteome_id (str): proteome ID
+            uniprot_release (str): UniProt release
+            proteome_file (str): pathname to the proteome file
+        """
+        checksum = compute_file_checksum(proteome_file)
+        object_path = self._object_path(checksum)
+        if not os.path.exists(object_path):
+            object_folder = os.path.dirname(object_path)
+            os.makedirs(object_folder, exist_ok=True)
+            # Write the file with a temporary name and rename it, so other processes never see an incomplete file.
+            file_descriptor, tmp_object_path = tempfile.mkstemp(prefix='.'+checksum, dir=object_folder)
+            os.close(file_descriptor)
+            try:
+                os.remove(tmp_object_path)
+                try:
+                    os.link(proteome_file, tmp_object_path)
+                except OSError:
+                    shutil.copyfile(proteome_file, tmp_object_path)
+                os.replace(tmp_object_path, object_path)
+            finally:
+                if os.path.exists(tmp_object_path):
+                    os.remove(tmp_object_path)
+
+        connection = self._connect()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO proteomes VALUES (?, ?, ?, ?, ?)',
+                               (proteome_id, uniprot_release, checksum, os.path.getsize(object_path), time.time()))
+
+    def evict(self):
+        """ Remove the least recently used proteome files until the total size of the store is below max_size.
+        Proteomes linked or copied in run folders stay available in these folders.
+
+        Returns:
+            nb_removed_files (int): number of proteome files removed from the store
+        """
+        nb_removed_files = 0
+        connection = self._connect()
+        with connection:
+            # Lock the database during the eviction, other processes wait to add or link proteomes.
+            connection.execute('BEGIN IMMEDIATE')
+            store_files = connection.execute('SELECT checksum, MAX(size), MAX(access_time) FROM proteomes GROUP BY checksum ORDER BY MAX(access_time)').fetchall()
+            total_size = sum(size for _, size, _ in store_files)
+            for checksum, size, _ in store_files:
+                if total_size <= self.max_size:
+                    break
+                connection.execute('DELETE FROM proteomes WHERE checksum = ?', (checksum,))
+                object_path = self._object_path(checksum)
+                if os.path.exists(object_path):
+                    os.remove(object_path)
+                total_size -= size
+                nb_removed_files += 1
+        if nb_removed_files > 0:
+            logger.info('|EsMeCaTa|proteome_store| %d proteome files removed from the proteome store %s.', nb_removed_files, self.store_folder)
+        return nb_removed_files
+
+    def cache_statistics(self):
+        """ Return the number of hits and misses of the store.
+
+        Returns:
+            statistics (dict): hits, misses, number of proteomes and total size (in bytes) of the store
+        """
+        nb_proteomes = self._connect().execute('SELECT COUNT(*) FROM proteomes').fetchone()[0]
+        total_size = self._connect().execute('SELECT SUM(size) FROM (SELECT MAX(size) AS size FROM proteomes GROUP BY checksum)').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'size': nb_proteomes, 'total_size': total_size or 0}
@@ -14,9 +14,10 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>
 
 import csv
-import gzip
+import hashlib
 import json
 import logging
+import math
 import matplotlib.pyplot as plt
 import numpy as np
 import os
@@ -28,14 +29,22 @@ import sys
 import time
 
 from Bio import SeqIO
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from Bio import __version__ as biopython_version
 from shutil import which
 
 from esmecata import __version__ as esmecata_version
-from esmecata.utils import is_valid_path, is_valid_dir
+from esmecata.utils import get_proteome_accessions, is_valid_path, is_valid_dir, ProteomeAccessionIndex, PROTEOME_ACCESSION_INDEX_FILENAME
 
 logger = logging.getLogger(__name__)
 
+# Size (in bytes) of compressed proteomes clustered by each MMseqs2 thread, taxa with larger proteomes are clustered with more threads.
+MMSEQS_PROTEOME_SIZE_BY_THREAD = 20 * 1024 * 1024
+# File (in the clustering output folder) associating the key of each clustering (proteomes and options) to the taxon name clustered with it.
+CLUSTERING_CACHE_FILENAME = 'clustering_cache.json'
+# File (in the mmseqs folder of a taxon) storing the MMseqs2 command and options used to create its cluster database.
+MMSEQS_CLUSTERING_OPTIONS_FILENAME = 'clustering_options.json'
+
 
 def compute_stat_clustering(output_folder, stat_file=None):
     """Compute stat associated to the number of proteome for each taxonomic affiliations.
@@ -175,7 +184,284 @@ def copy_already_clustered_file(output_folder, already_clustered_obs_name, new_o
     shutil.copyfile(already_cluster_output_file, cluster_output_file)
 
 
-def run_mmseqs(observation_name, observation_name_proteomes, mmseqs_tmp_path, nb_cpu, mmseqs_options, linclust):
+def compute_clustering_key(observation_name_proteomes, clust_threshold, mmseqs_options, linclust):
+    """Compute the key of a clustering, two taxa with the same key have the same clustering results.
+
+    Args:
+        observation_name_proteomes (list): list of pathname to each proteomes associated to the taxon
+        clust_threshold (float): threshold to select protein cluster according to the representation of protein proteome in the cluster
+        mmseqs_options (str): use alternative mmseqs option
+        linclust (bool): use linclust
+
+    Returns:
+        clustering_key (str): sha256 hash of the sorted proteome IDs (with the size and modification time of their files) and of the clustering options
+    """
+    # A proteome downloaded again with a new content under the same ID changes the key.
+    proteome_stats = []
+    for proteome_file in sorted(set(observation_name_proteomes), key=os.path.basename):
+        proteome_file_stat = os.stat(proteome_file)
+        proteome_stats.append([os.path.basename(proteome_file)[:-len('.faa.gz')], proteome_file_stat.st_size, proteome_file_stat.st_mtime_ns])
+    clustering_content = json.dumps([proteome_stats, clust_threshold, mmseqs_options if mmseqs_options else '', bool(linclust)])
+
+    return hashlib.sha256(clustering_content.encode('utf-8')).hexdigest()
+
+
+def reuse_taxon_clustering(output_folder, already_clustered_tax_name, proteomes_tax_name):
+    """Copy the clustering results of a taxon to another taxon having the same clustering key.
+
+    Args:
+        output_folder (str): pathname to the output folder of esmecata clustering
+        already_clustered_tax_name (str): name of the taxon already clustered
+        proteomes_tax_name (str): name of the taxon reusing the clustering
+    """
+    already_clustered_tax_name = already_clustered_tax_name.replace(' ', '_')
+    proteomes_tax_name = proteomes_tax_name.replace(' ', '_')
+
+    for result_folder_name in ['cluster_founds', 'computed_threshold', 'reference_proteins']:
+        copy_already_clustered_file(os.path.join(output_folder, result_folder_name), already_clustered_tax_name, proteomes_tax_name)
+
+    # FASTA files are not created when no protein clusters are kept.
+    for result_folder_name in ['reference_proteins_representative_fasta', 'reference_proteins_consensus_fasta']:
+        if os.path.exists(os.path.join(output_folder, result_folder_name, already_clustered_tax_name+'.faa')):
+            copy_already_clustered_file(os.path.join(output_folder, result_folder_name), already_clustered_tax_name, proteomes_tax_name, '.faa')
+        elif os.path.exists(os.path.join(output_folder, result_folder_name, proteomes_tax_name+'.faa')):
+            os.remove(os.path.join(output_folder, result_folder_name, proteomes_tax_name+'.faa'))
+
+    logger.info('|EsMeCaTa|clustering| Reuse clustering of %s for %s (same proteomes).', already_clustered_tax_name, proteomes_tax_name)
+
+
+def create_proteomes_mmseqs_db(proteome_files, mmseqs_db_path):
+    """Create one MMseqs2 sequence database containing the proteins of all the proteomes.
+    The database is reused if it has already been created with the same proteomes (same pathnames, sizes and modification times).
+
+    Args:
+        proteome_files (list): list of pathname to the proteomes
+        mmseqs_db_path (str): pathname to the folder which will contain the database
+
+    Returns:
+        mmseqs_proteomes_db (str): pathname to the MMseqs2 sequence database
+        proteome_db_keys (dict): pathname to each proteome (key) associated with the database keys of its proteins (numpy array, value)
+    """
+    is_valid_dir(mmseqs_db_path)
+    mmseqs_proteomes_db = os.path.join(mmseqs_db_path, 'proteomes_db')
+    mmseqs_proteomes_db_lookup = mmseqs_proteomes_db + '.lookup'
+    # Proteomes given to createdb (in the order of the file numbers of the lookup file) with their size and modification time.
+    mmseqs_proteomes_db_files = os.path.join(mmseqs_db_path, 'proteomes_db_files.txt')
+    proteome_files = sorted(set(proteome_files))
+    proteome_file_stats = []
+    for proteome_file in proteome_files:
+        proteome_file_stat = os.stat(proteome_file)
+        proteome_file_stats.append([proteome_file, str(proteome_file_stat.st_size), str(proteome_file_stat.st_mtime_ns)])
+
+    already_created_db = False
+    if os.path.exists(mmseqs_proteomes_db_lookup) and os.path.exists(mmseqs_proteomes_db_files):
+        with open(mmseqs_proteomes_db_files, 'r') as open_db_files:
+            already_created_db = list(csv.reader(open_db_files, delimiter='\t')) == proteome_file_stats
+
+    if not already_created_db:
+        logger.info('|EsMeCaTa|clustering| Create MMseqs2 database of %d proteomes.', len(proteome_files))
+        if os.path.exists(mmseqs_proteomes_db_files):
+            os.remove(mmseqs_proteomes_db_files)
+        subprocess.call(['mmseqs', 'createdb', *proteome_files, mmseqs_proteomes_db, '-v', '2'])
+        # Write the proteome list after createdb, so an interrupted creation is not reused.
+        with open(mmseqs_proteomes_db_files, 'w') as open_db_files:
+            csvwriter = csv.writer(open_db_files, delimiter='\t')
+            csvwriter.writerows(proteome_file_stats)
+    else:
+        logger.info('|EsMeCaTa|clustering| Reuse MMseqs2 database of %d proteomes.', len(proteome_files))
+
+    # The lookup file contains the key, the accession and the file number of each protein of the database.
+    db_keys = []
+    db_file_numbers = []
+    with open(mmseqs_proteomes_db_lookup, 'r') as open_lookup_file:
+        csvreader = csv.reader(open_lookup_file, delimiter='\t')
+        for row in csvreader:
+            db_keys.append(int(row[0]))
+            db_file_numbers.append(int(row[2]))
+    db_keys = np.array(db_keys, dtype=np.int64)
+    db_file_numbers = np.array(db_file_numbers, dtype=np.int64)
+
+    # Group the keys by file number in one pass: sort them by file number and split them at the first key of each file.
+    file_number_order = np.argsort(db_file_numbers, kind='stable')
+    file_boundaries = np.searchsorted(db_file_numbers[file_number_order], np.arange(1, len(proteome_files)))
+    proteome_db_keys = dict(zip(proteome_files, np.split(db_keys[file_number_order], file_boundaries)))
+
+    return mmseqs_proteomes_db, proteome_db_keys
+
+
+def get_mmseqs_cluster_options(mmseqs_options):
+    """Get the options given to the mmseqs clustering commands.
+
+    Args:
+        mmseqs_options (str): options that will be used by mmseqs (default: '--min-seq-id', '0.3', '-c', '0.8')
+
+    Returns:
+        mmseqs_cluster_options (list): list of the mmseqs options
+    """
+    # If no option given by the user, use the default options: '--min-seq-id', '0.3', '-c', '0.8'.
+    # Sequence identity of 30% and coverage of 80%.
+    if not mmseqs_options:
+        mmseqs_cluster_options = ['--min-seq-id', '0.3', '-c', '0.8']
+    else:
+        mmseqs_cluster_options = mmseqs_options.split(' ')
+
+    return mmseqs_cluster_options
+
+
+def write_mmseqs_clustering_options(mmseqs_tmp_cluster, mmseqs_options, linclust):
+    """Write the MMseqs2 command and options used to create the cluster database of a taxon.
+
+    Args:
+        mmseqs_tmp_cluster (str): pathname to the mmseqs folder of the taxon
+        mmseqs_options (str): options that will be used by mmseqs (default: '--min-seq-id', '0.3', '-c', '0.8')
+        linclust (bool): use linclust
+    """
+    with open(os.path.join(mmseqs_tmp_cluster, MMSEQS_CLUSTERING_OPTIONS_FILENAME), 'w') as open_options_file:
+        json.dump({'linclust': bool(linclust), 'mmseqs_options': get_mmseqs_cluster_options(mmseqs_options)}, open_options_file)
+
+
+def has_mmseqs_clustering_options(mmseqs_tmp_cluster, mmseqs_options, linclust):
+    """Check that the cluster database of a taxon has been created with the same MMseqs2 command and options.
+
+    Args:
+        mmseqs_tmp_cluster (str): pathname to the mmseqs folder of the taxon
+        mmseqs_options (str): options that will be used by mmseqs (default: '--min-seq-id', '0.3', '-c', '0.8')
+        linclust (bool): use linclust
+
+    Returns:
+        same_options (bool): True if the command and options are the same (False if they are unknown)
+    """
+    mmseqs_options_file = os.path.join(mmseqs_tmp_cluster, MMSEQS_CLUSTERING_OPTIONS_FILENAME)
+    if not os.path.exists(mmseqs_options_file):
+        return False
+    with open(mmseqs_options_file, 'r') as open_options_file:
+        previous_options = json.load(open_options_file)
+
+    return previous_options == {'linclust': bool(linclust), 'mmseqs_options': get_mmseqs_cluster_options(mmseqs_options)}
+
+
+def create_taxon_mmseqs_db(mmseqs_tmp_cluster, mmseqs_tmp_db, observation_name_proteomes, mmseqs_proteomes_db=None, proteome_db_keys=None):
+    """Create the MMseqs2 database containing the protein sequences from all the proteomes of a taxon.
+    A database extracted from mmseqs_proteomes_db does not depend on it (sequences, headers and lookup are copied).
+
+    Args:
+        mmseqs_tmp_cluster (str): pathname to the mmseqs folder of the taxon
+        mmseqs_tmp_db (str): pathname to the database to create
+        observation_name_proteomes (list): list of pathname to each proteomes associated to the taxon
+        mmseqs_proteomes_db (str): pathname to a MMseqs2 database containing the proteomes (if None, the database is created from the proteomes)
+        proteome_db_keys (dict): pathname to each proteome associated with the keys of its proteins in mmseqs_proteomes_db
+    """
+    if mmseqs_proteomes_db is not None:
+        # Extract the protein sequences of the proteomes of the taxon from the database of all proteomes.
+        mmseqs_tmp_db_keys = os.path.join(mmseqs_tmp_cluster, 'db_keys.txt')
+        taxon_db_keys = np.sort(np.concatenate([proteome_db_keys[proteome_file] for proteome_file in observation_name_proteomes]))
+        np.savetxt(mmseqs_tmp_db_keys, taxon_db_keys, fmt='%d')
+        subprocess.call(['mmseqs', 'createsubdb', mmseqs_tmp_db_keys, mmseqs_proteomes_db, mmseqs_tmp_db, '--subdb-mode', '0', '-v', '2'])
+        # createsubdb links the headers, the lookup and the source files to the ones of the database of all proteomes,
+        # which is created again when the proteomes change: they are written in the taxon database so it stays valid (for clusterupdate).
+        for mmseqs_db_suffix in ['_h', '_h.index', '_h.dbtype', '.lookup', '.source']:
+            if os.path.islink(mmseqs_tmp_db + mmseqs_db_suffix):
+                os.remove(mmseqs_tmp_db + mmseqs_db_suffix)
+        subprocess.call(['mmseqs', 'createsubdb', mmseqs_tmp_db_keys, mmseqs_proteomes_db + '_h', mmseqs_tmp_db + '_h', '--subdb-mode', '0', '-v', '2'])
+        taxon_db_key_set = set(taxon_db_keys.tolist())
+        with open(mmseqs_proteomes_db + '.lookup', 'r') as open_lookup_file, open(mmseqs_tmp_db + '.lookup', 'w') as open_taxon_lookup_file:
+            for line in open_lookup_file:
+                if int(line.split('\t', 1)[0]) in taxon_db_key_set:
+                    open_taxon_lookup_file.write(line)
+        shutil.copyfile(mmseqs_proteomes_db + '.source', mmseqs_tmp_db + '.source')
+    else:
+        subprocess.call(['mmseqs', 'createdb', *observation_name_proteomes, mmseqs_tmp_db, '-v', '2'])
+
+
+def convert_mmseqs_clustering(mmseqs_tmp_cluster, nb_cpu):
+    """Create the representative and consensus sequences and the tabulated file of the clustering of a taxon (cluster_db of db).
+
+    Args:
+        mmseqs_tmp_cluster (str): pathname to the mmseqs folder of the taxon
+        nb_cpu (int): number of CPU for mmseqs
+    """
+    mmseqs_tmp_cluster_output = os.path.join(mmseqs_tmp_cluster, 'cluster')
+    mmseqs_tmp_clustered_tabulated = mmseqs_tmp_cluster_output+'_cluster.tsv'
+    mmseqs_tmp_representative_fasta = mmseqs_tmp_cluster_output + '_rep_seq.fasta'
+    mmseqs_consensus_fasta = mmseqs_tmp_cluster_output + '_con_seq.fasta'
+
+    mmseqs_tmp_db = os.path.join(mmseqs_tmp_cluster, 'db')
+    mmseqs_tmp_db_clustered = os.path.join(mmseqs_tmp_cluster, 'cluster_db')
+    mmseqs_seq_db =  os.path.join(mmseqs_tmp_cluster, 'cluster_seq')
+    mmseqs_profile =  os.path.join(mmseqs_tmp_cluster, 'cluster_profile')
+    mmseqs_consensus =  os.path.join(mmseqs_tmp_cluster, 'cluster_consensus')
+
+    # Create sequence database with representative from the clustered proteins.
+    subprocess.call(['mmseqs', 'createsubdb', mmseqs_tmp_db_clustered, mmseqs_tmp_db, mmseqs_seq_db, '-v', '2'])
+    # Create the profile from the clustering.
+    subprocess.call(['mmseqs', 'result2profile', mmseqs_seq_db, mmseqs_tmp_db, mmseqs_tmp_db_clustered, mmseqs_profile, '--threads', str(nb_cpu), '-v', '2'])
+    # Create the consensus from the profile.
+    subprocess.call(['mmseqs', 'profile2consensus', mmseqs_profile, mmseqs_consensus, '--threads', str(nb_cpu), '-v', '2'])
+    # Create the consensus fasta file.
+    subprocess.call(['mmseqs', 'convert2fasta', mmseqs_consensus, mmseqs_consensus_fasta, '-v', '2'])
+    # Create TSV resulting files to be analysed after.
+    subprocess.call(['mmseqs', 'createtsv', mmseqs_tmp_db, mmseqs_tmp_db, mmseqs_tmp_db_clustered, mmseqs_tmp_clustered_tabulated, '--threads', str(nb_cpu), '-v', '2'])
+    # Create fasta file containing representative proteins (representatives are the first protein of the alignement).
+    subprocess.call(['mmseqs', 'convert2fasta', mmseqs_seq_db, mmseqs_tmp_representative_fasta, '-v', '2'])
+
+
+def update_mmseqs(observation_name, observation_name_proteomes, mmseqs_tmp_path, nb_cpu, mmseqs_options, mmseqs_proteomes_db=None, proteome_db_keys=None):
+    """Update the MMseqs2 clustering of a taxon with mmseqs clusterupdate, when new proteomes are added to the already clustered proteomes.
+    The sequences of the previous proteomes keep their clusters and only the new sequences are searched against them (or clustered together).
+
+    Args:
+        observation_name (str): observation name associated to a taxonomic affiliations
+        observation_name_proteomes (list): list of pathname to each proteomes (previous and new ones) associated to the observation_name
+        mmseqs_tmp_path (str): pathname to the folder containing mmseqs results
+        nb_cpu (int): number of CPU for mmseqs
+        mmseqs_options (str): options that will be used by mmseqs (default: '--min-seq-id', '0.3', '-c', '0.8')
+        mmseqs_proteomes_db (str): pathname to a MMseqs2 database containing the proteomes (if None, a database is created from the proteomes)
+        proteome_db_keys (dict): pathname to each proteome associated with the keys of its proteins in mmseqs_proteomes_db
+
+    Returns:
+        mmseqs_tmp_clustered_tabulated (str): pathname to the mmseqs tabulated file containg protein cluster
+        mmseqs_tmp_representative_fasta (str): pathname to the mmseqs fasta file containing representative protein sequences
+        mmseqs_consensus_fasta (str): pathname to the mmseqs fasta file containing consensus protein sequences
+    """
+    mmseqs_tmp_cluster = os.path.join(mmseqs_tmp_path, observation_name)
+
+    mmseqs_tmp_cluster_output = os.path.join(mmseqs_tmp_cluster, 'cluster')
+    mmseqs_tmp_clustered_tabulated = mmseqs_tmp_cluster_output+'_cluster.tsv'
+    mmseqs_tmp_representative_fasta = mmseqs_tmp_cluster_output + '_rep_seq.fasta'
+    mmseqs_consensus_fasta = mmseqs_tmp_cluster_output + '_con_seq.fasta'
+
+    mmseqs_tmp_db = os.path.join(mmseqs_tmp_cluster, 'db')
+    mmseqs_tmp_db_clustered = os.path.join(mmseqs_tmp_cluster, 'cluster_db')
+    mmseqs_new_db = os.path.join(mmseqs_tmp_cluster, 'new_db')
+    mmseqs_updated_db = os.path.join(mmseqs_tmp_cluster, 'updated_db')
+    mmseqs_updated_db_clustered = os.path.join(mmseqs_tmp_cluster, 'updated_cluster_db')
+    mmseqs_update_tmp = os.path.join(mmseqs_tmp_cluster, 'cluster_update_tmp')
+
+    # Create database containing the protein sequences from all the proteomes (previous and new ones) of the taxon.
+    create_taxon_mmseqs_db(mmseqs_tmp_cluster, mmseqs_new_db, observation_name_proteomes, mmseqs_proteomes_db, proteome_db_keys)
+
+    # Add the new sequences to the previous clustering.
+    update_cmd = ['mmseqs', 'clusterupdate', mmseqs_tmp_db, mmseqs_new_db, mmseqs_tmp_db_clustered, mmseqs_updated_db, mmseqs_updated_db_clustered,
+                  mmseqs_update_tmp, '--threads', str(nb_cpu), '-v', '2']
+    update_cmd += get_mmseqs_cluster_options(mmseqs_options)
+    subprocess.call(update_cmd)
+
+    # Replace the previous databases by the updated ones and remove the files created from the previous clustering.
+    for mmseqs_db in [mmseqs_tmp_db, mmseqs_tmp_db_clustered, mmseqs_new_db] + [os.path.join(mmseqs_tmp_cluster, mmseqs_db_name) for mmseqs_db_name in ['cluster_seq', 'cluster_profile', 'cluster_consensus']]:
+        subprocess.call(['mmseqs', 'rmdb', mmseqs_db, '-v', '2'])
+    subprocess.call(['mmseqs', 'mvdb', mmseqs_updated_db, mmseqs_tmp_db, '-v', '2'])
+    subprocess.call(['mmseqs', 'mvdb', mmseqs_updated_db_clustered, mmseqs_tmp_db_clustered, '-v', '2'])
+    for mmseqs_output_file in [mmseqs_tmp_clustered_tabulated, mmseqs_tmp_representative_fasta, mmseqs_consensus_fasta]:
+        if os.path.exists(mmseqs_output_file):
+            os.remove(mmseqs_output_file)
+    shutil.rmtree(mmseqs_update_tmp, ignore_errors=True)
+
+    convert_mmseqs_clustering(mmseqs_tmp_cluster, nb_cpu)
+
+    return mmseqs_tmp_clustered_tabulated, mmseqs_tmp_representative_fasta, mmseqs_consensus_fasta
+
+
+def run_mmseqs(observation_name, observation_name_proteomes, mmseqs_tmp_path, nb_cpu, mmseqs_options, linclust, mmseqs_proteomes_db=None, proteome_db_keys=None):
     """Run MMseqs2 on proteomes for an observation name
 
     Args:
@@ -185,6 +471,8 @@ def run_mmseqs(observation_name, observation_name_proteomes, mmseqs_tmp_path, nb
         nb_cpu (int): number of CPU for mmseqs
         mmseqs_options (str): options that will be used by mmseqs (default: '--min-seq-id', '0.3', '-c', '0.8')
         linclust (bool): use linclust for faster clustering
+        mmseqs_proteomes_db (str): pathname to a MMseqs2 database containing the proteomes (if None, a database is created from the proteomes)
+        proteome_db_keys (dict): pathname to each proteome associated with the keys of its proteins in mmseqs_proteomes_db
 
     Returns:
         mmseqs_tmp_clustered_tabulated (str): pathname to the mmseqs tabulated file containg protein cluster
@@ -204,13 +492,10 @@ def run_mmseqs(observation_name, observation_name_proteomes, mmseqs_tmp_path, nb
     mmseqs_tmp_db = os.path.join(mmseqs_tmp_cluster, 'db')
     mmseqs_tmp_db_clustered = os.path.join(mmseqs_tmp_cluster, 'cluster_db')
     mmseqs_tmp_cluster_tmp = os.path.join(mmseqs_tmp_cluster, 'cluster_tmp')
-    mmseqs_seq_db =  os.path.join(mmseqs_tmp_cluster, 'cluster_seq')
-    mmseqs_profile =  os.path.join(mmseqs_tmp_cluster, 'cluster_profile')
-    mmseqs_consensus =  os.path.join(mmseqs_tmp_cluster, 'cluster_consensus')
 
     if not os.path.exists(mmseqs_tmp_clustered_tabulated):
         # Create database containing the protein sequences from all the proteomes of a taxon.
-        subprocess.call(['mmseqs', 'createdb', *observation_name_proteomes, mmseqs_tmp_db, '-v', '2'])
+        create_taxon_mmseqs_db(mmseqs_tmp_cluster, mmseqs_tmp_db, observation_name_proteomes, mmseqs_proteomes_db, proteome_db_keys)
 
         # Cluster the protein sequences.
         cluster_cmd = ['mmseqs']
@@ -220,28 +505,13 @@ def run_mmseqs(observation_name, observation_name_proteomes, mmseqs_tmp_path, nb
             cluster_cmd += ['cluster']
 
         cluster_cmd += [mmseqs_tmp_db, mmseqs_tmp_db_clustered, mmseqs_tmp_cluster_tmp, '--threads', str(nb_cpu), '-v', '2']
-
-        # If no option given by the user, use the default options: '--min-seq-id', '0.3', '-c', '0.8'.
-        # Sequence identity of 30% and coverage of 80%.
-        if not mmseqs_options:
-            cluster_cmd += ['--min-seq-id', '0.3', '-c', '0.8']
-        else:
-            cluster_cmd += mmseqs_options.split(' ')
+        cluster_cmd += get_mmseqs_cluster_options(mmseqs_options)
 
         subprocess.call(cluster_cmd)
+        # Options are checked before updating this clustering with new proteomes.
+        write_mmseqs_clustering_options(mmseqs_tmp_cluster, mmseqs_options, linclust)
 
-        # Create sequence database with representative from the clustered proteins.
-        subprocess.call(['mmseqs', 'createsubdb', mmseqs_tmp_db_clustered, mmseqs_tmp_db, mmseqs_seq_db, '-v', '2'])
-        # Create the profile from the clustering.
-        subprocess.call(['mmseqs', 'result2profile', mmseqs_seq_db, mmseqs_tmp_db, mmseqs_tmp_db_clustered, mmseqs_profile, '--threads', str(nb_cpu), '-v', '2'])
-        # Create the consensus from the profile.
-        subprocess.call(['mmseqs', 'profile2consensus', mmseqs_profile, mmseqs_consensus, '--threads', str(nb_cpu), '-v', '2'])
-        # Create the consensus fasta file.
-        subprocess.call(['mmseqs', 'convert2fasta', mmseqs_consensus, mmseqs_consensus_fasta, '-v', '2'])
-        # Create TSV resulting files to be analysed after.
-        subprocess.call(['mmseqs', 'createtsv', mmseqs_tmp_db, mmseqs_tmp_db, mmseqs_tmp_db_clustered, mmseqs_tmp_clustered_tabulated, '--threads', str(nb_cpu), '-v', '2'])
-        # Create fasta file containing representative proteins (representatives are the first protein of the alignement).
-        subprocess.call(['mmseqs', 'convert2fasta', mmseqs_seq_db, mmseqs_tmp_representative_fasta, '-v', '2'])
+        convert_mmseqs_clustering(mmseqs_tmp_cluster, nb_cpu)
 
     # Old clustering method used with easy-cluster.
     """
@@ -282,37 +552,56 @@ def extrat_protein_cluster_from_mmseqs(mmseqs_tmp_clustered_tabulated, cluster_p
     return protein_clusters
 
 
-def compute_proteome_representativeness_ratio(protein_clusters, observation_name_proteomes, computed_threshold_file=None):
+def compute_proteome_representativeness_ratio(protein_clusters, observation_name_proteomes, computed_threshold_file=None, proteome_accession_index=None):
     """Compute for each protein cluster the ratio of representation of each proteomes in the cluster.
 
     Args:
         protein_clusters (dict): protein clusters found by mmseqs (representative protein as key and all the protein in the cluster as value)
         observation_name_proteomes (list): list of pathname to each proteomes associated to the observation_name
         computed_threshold_file (str): pathname to the output file containing the computed ratio
+        proteome_accession_index (ProteomeAccessionIndex): index mapping protein accessions to proteomes (if None, the accession files of the proteomes are read)
 
     Returns:
         number_proteomes (int): number of the proteomes for the observation_name
         rep_prot_organims (dict): names of each proteomes associated with each protein cluster
         computed_threshold_cluster (dict): ratio of proteomes representativeness for each protein cluster
     """
-    # Retrieve protein ID and the corresponding proteome.
-    organism_prots = {}
-    for fasta_file in observation_name_proteomes:
-        with gzip.open(fasta_file, 'rt') as fasta_handle:
-            for record in SeqIO.parse(fasta_handle, 'fasta'):
-                compressed_filebasename = os.path.basename(fasta_file)
-                fasta_filebasename = os.path.splitext(compressed_filebasename)[0]
-                filebasename = os.path.splitext(fasta_filebasename)[0]
-                organism_prots[record.id.split('|')[1]] = filebasename
-
     number_proteomes = len(observation_name_proteomes)
 
-    # Compute the ratio between the number of proteome represented by a protein in the cluster and the total number of proteome.
-    rep_prot_organims = {}
-    computed_threshold_cluster = {}
-    for rep_protein in protein_clusters:
-        rep_prot_organims[rep_protein] = set([organism_prots[prot] for prot in protein_clusters[rep_protein]])
-        computed_threshold_cluster[rep_protein] = len(rep_prot_organims[rep_protein]) / number_proteomes
+    if proteome_accession_index is not None:
+        # Search the proteome of each clustered protein in the proteome accession index.
+        observation_proteomes = [os.path.basename(fasta_file)[:-len('.faa.gz')] for fasta_file in observation_name_proteomes]
+        cluster_proteins = [prot for rep_protein in protein_clusters for prot in protein_clusters[rep_protein]]
+        protein_proteome_codes = proteome_accession_index.get_proteome_codes(cluster_proteins, observation_proteomes)
+        if (protein_proteome_codes == -1).any():
+            missing_protein = cluster_proteins[int(np.flatnonzero(protein_proteome_codes == -1)[0])]
+            raise KeyError('Protein {0} is not in the proteome accession index {1}.'.format(missing_protein, proteome_accession_index.index_file))
+
+        rep_prot_organims = {}
+        computed_threshold_cluster = {}
+        protein_position = 0
+        for rep_protein in protein_clusters:
+            number_proteins = len(protein_clusters[rep_protein])
+            proteome_codes = protein_proteome_codes[protein_position:protein_position+number_proteins]
+            protein_position += number_proteins
+            rep_prot_organims[rep_protein] = set([proteome_accession_index.proteomes[proteome_code] for proteome_code in set(proteome_codes.tolist())])
+            computed_threshold_cluster[rep_protein] = len(rep_prot_organims[rep_protein]) / number_proteomes
+    else:
+        # Retrieve protein ID and the corresponding proteome (from the accession files written next to the proteomes).
+        organism_prots = {}
+        for fasta_file in observation_name_proteomes:
+            compressed_filebasename = os.path.basename(fasta_file)
+            fasta_filebasename = os.path.splitext(compressed_filebasename)[0]
+            filebasename = os.path.splitext(fasta_filebasename)[0]
+            for protein_accession in get_proteome_accessions(fasta_file):
+                organism_prots[protein_accession] = filebasename
+
+        # Compute the ratio between the number of proteome represented by a protein in the cluster and the total number of proteome.
+        rep_prot_organims = {}
+        computed_threshold_cluster = {}
+        for rep_protein in protein_clusters:
+            rep_prot_organims[rep_protein] = set([organism_prots[prot] for prot in protein_clusters[rep_protein]])
+            computed_threshold_cluster[rep_protein] = len(rep_prot_organims[rep_protein]) / number_proteomes
 
     if computed_threshold_file:
         # Create a tsv file containing the computer threshold (number of organism in the cluster compared to the total number of organism) for each organisms.
@@ -360,7 +649,231 @@ def filter_protein_cluster(protein_clusters, number_proteomes, rep_prot_organims
     return protein_cluster_to_keeps
 
 
-def make_clustering(proteome_folder, output_folder, nb_cpu, clust_threshold, mmseqs_options, linclust, remove_tmp):
+def write_kept_protein_records(mmseqs_fasta_file, protein_cluster_to_keeps, output_fasta_file, proteomes_tax_name):
+    """Write the sequences of the protein clusters kept, the fasta file is not created when 0 sequences were kept.
+
+    Args:
+        mmseqs_fasta_file (str): pathname to the mmseqs fasta file containing representative or consensus protein sequences
+        protein_cluster_to_keeps (set): representative protein IDs associated with cluster that are kept
+        output_fasta_file (str): pathname to the output fasta file
+        proteomes_tax_name (str): taxon name associated with the proteomes
+    """
+    # Create BioPython records with the proteins kept.
+    new_records = [record for record in SeqIO.parse(mmseqs_fasta_file, 'fasta') if record.id.split('|')[1] in protein_cluster_to_keeps]
+
+    # Do not create fasta file when 0 sequences were kept.
+    if len(new_records) > 0:
+        SeqIO.write(new_records, output_fasta_file, 'fasta')
+    else:
+        logger.info('|EsMeCaTa|clustering| 0 protein clusters %s, no fasta created.', proteomes_tax_name)
+        # Remove the fasta file of a previous clustering of the taxon.
+        if os.path.exists(output_fasta_file):
+            os.remove(output_fasta_file)
+
+
+def cluster_taxon_proteomes(proteomes_tax_name, observation_name_proteomes, output_folder, nb_threads, clust_threshold, mmseqs_options, linclust,
+                            remove_tmp, proteome_accession_index=None, mmseqs_proteomes_db=None, proteome_db_keys=None, update_clustering=None):
+    """Cluster the proteomes of a taxon with MMseqs2 and select the protein clusters representative of the proteomes.
+
+    Args:
+        proteomes_tax_name (str): taxon name associated with the proteomes
+        observation_name_proteomes (list): list of pathname to each proteomes associated to the taxon
+        output_folder (str): pathname to the output folder of esmecata clustering
+        nb_threads (int): number of threads used by mmseqs
+        clust_threshold (float): threshold to select protein cluster according to the representation of protein proteome in the cluster
+        mmseqs_options (str): use alternative mmseqs option
+        linclust (bool): use linclust
+        remove_tmp (bool): remove the tmp files
+        proteome_accession_index (ProteomeAccessionIndex): index mapping protein accessions to proteomes
+        mmseqs_proteomes_db (str): pathname to a MMseqs2 database containing the proteomes
+        proteome_db_keys (dict): pathname to each proteome associated with the keys of its proteins in mmseqs_proteomes_db
+        update_clustering (bool): update the previous MMseqs2 clustering of the taxon (its proteomes are included in the new ones) instead of clustering again
+    """
+    mmseqs_tmp_path = os.path.join(output_folder, 'mmseqs_tmp')
+    cluster_founds_path = os.path.join(output_folder, 'cluster_founds')
+    computed_threshold_path = os.path.join(output_folder, 'computed_threshold')
+    reference_proteins_path = os.path.join(output_folder, 'reference_proteins')
+    reference_proteins_representative_fasta_path = os.path.join(output_folder, 'reference_proteins_representative_fasta')
+    reference_proteins_consensus_fasta_path = os.path.join(output_folder, 'reference_proteins_consensus_fasta')
+
+    # Change space with '_' to avoid issue.
+    proteomes_tax_name = proteomes_tax_name.replace(' ', '_')
+    # If the computed threshold file exists, mmseqs has already been run.
+    mmseqs_tmp_cluster = os.path.join(mmseqs_tmp_path, proteomes_tax_name)
+    if update_clustering:
+        # Add the new proteomes to the previous mmseqs2 run.
+        mmseqs_tmp_clustered_tabulated, mmseqs_tmp_representative_fasta, mmseqs_consensus_fasta = update_mmseqs(proteomes_tax_name, observation_name_proteomes, mmseqs_tmp_path, nb_threads, mmseqs_options,
+                                                                                                        mmseqs_proteomes_db, proteome_db_keys)
+    else:
+        # Run mmseqs on organism.
+        # Delete previous mmseqs2 run if it exists to avoid overwritting issues.
+        if os.path.exists(mmseqs_tmp_cluster):
+            shutil.rmtree(mmseqs_tmp_cluster)
+        mmseqs_tmp_clustered_tabulated, mmseqs_tmp_representative_fasta, mmseqs_consensus_fasta = run_mmseqs(proteomes_tax_name, observation_name_proteomes, mmseqs_tmp_path, nb_threads, mmseqs_options, linclust,
+                                                                                                     mmseqs_proteomes_db, proteome_db_keys)
+
+    # Extract protein clusters from mmseqs results.
+    cluster_proteomes_output_file = os.path.join(cluster_founds_path, proteomes_tax_name+'.tsv')
+    protein_clusters = extrat_protein_cluster_from_mmseqs(mmseqs_tmp_clustered_tabulated, cluster_proteomes_output_file)
+
+    # Compute proteome representativeness ratio.
+    computed_threshold_file = os.path.join(computed_threshold_path, proteomes_tax_name+'.tsv')
+    if proteome_accession_index is not None and not proteome_accession_index.is_up_to_date(observation_name_proteomes):
+        proteome_accession_index = None
+    number_proteomes, rep_prot_organims, computed_threshold_cluster = compute_proteome_representativeness_ratio(protein_clusters,
+                                                                                                                observation_name_proteomes, computed_threshold_file,
+                                                                                                                proteome_accession_index)
+
+    # Filter protein cluster for each protein cluster.
+    cluster_proteomes_filtered_output_file = os.path.join(reference_proteins_path, proteomes_tax_name+'.tsv')
+    protein_cluster_to_keeps = filter_protein_cluster(protein_clusters, number_proteomes, rep_prot_organims, computed_threshold_cluster,
+                                                    clust_threshold, cluster_proteomes_filtered_output_file)
+
+    logger.info('|EsMeCaTa|clustering| %d protein clusters kept for %s.', len(protein_cluster_to_keeps), proteomes_tax_name)
+
+    # Create output proteome files for OTU with the representative and the consensus proteins kept.
+    representative_fasta_file = os.path.join(reference_proteins_representative_fasta_path, proteomes_tax_name+'.faa')
+    write_kept_protein_records(mmseqs_tmp_representative_fasta, protein_cluster_to_keeps, representative_fasta_file, proteomes_tax_name)
+    consensus_fasta_file = os.path.join(reference_proteins_consensus_fasta_path, proteomes_tax_name+'.faa')
+    write_kept_protein_records(mmseqs_consensus_fasta, protein_cluster_to_keeps, consensus_fasta_file, proteomes_tax_name)
+
+    if remove_tmp:
+        shutil.rmtree(mmseqs_tmp_cluster)
+
+
+def find_nested_taxa(taxa_proteomes):
+    """Find the taxa whose proteomes are included in the proteomes of another taxon (such as a genus and its family).
+
+    Args:
+        taxa_proteomes (dict): taxon name (key) associated with the list of pathnames to its proteomes (value)
+
+    Returns:
+        nested_taxa (dict): nested taxon name (key) associated with the name of the taxon containing its proteomes (value), this taxon is not nested
+    """
+    taxa_proteome_sets = {tax_name: set(proteome_files) for tax_name, proteome_files in taxa_proteomes.items()}
+
+    # Search the including taxa from the largest to the smallest proteome sets, the largest sets are not nested.
+    nested_taxa = {}
+    including_taxa = []
+    for tax_name in sorted(taxa_proteome_sets, key=lambda tax_name: (-len(taxa_proteome_sets[tax_name]), tax_name)):
+        candidate_taxa = [including_tax_name for including_tax_name in including_taxa
+                          if taxa_proteome_sets[tax_name].issubset(taxa_proteome_sets[including_tax_name])]
+        if len(candidate_taxa) > 0:
+            # Use the smallest including taxon, the closest to the proteomes of the nested taxon.
+            nested_taxa[tax_name] = min(candidate_taxa, key=lambda including_tax_name: (len(taxa_proteome_sets[including_tax_name]), including_tax_name))
+        else:
+            including_taxa.append(tax_name)
+
+    return nested_taxa
+
+
+def derive_nested_taxon_clustering(output_folder, including_tax_name, proteomes_tax_name, observation_name_proteomes, clust_threshold,
+                                   proteome_accession_index=None):
+    """Create the protein clusters of a nested taxon from the clustering of the taxon including its proteomes, without running MMseqs2.
+    The clusters are restricted to the proteins of the nested taxon proteomes, then the representativeness ratio is computed and the clusters filtered.
+    The representative and consensus proteins of the clusters are the ones of the including taxon, so they can come from a proteome not in the nested taxon.
+
+    Args:
+        output_folder (str): pathname to the output folder of esmecata clustering
+        including_tax_name (str): name of the taxon including the proteomes of the nested taxon (already clustered)
+        proteomes_tax_name (str): name of the nested taxon
+        observation_name_proteomes (list): list of pathname to each proteomes associated to the nested taxon
+        clust_threshold (float): threshold to select protein cluster according to the representation of protein proteome in the cluster
+        proteome_accession_index (ProteomeAccessionIndex): index mapping protein accessions to proteomes
+    """
+    including_tax_name = including_tax_name.replace(' ', '_')
+    proteomes_tax_name = proteomes_tax_name.replace(' ', '_')
+
+    including_protein_clusters = {}
+    with open(os.path.join(output_folder, 'cluster_founds', including_tax_name+'.tsv'), 'r') as input_file:
+        csvreader = csv.reader(input_file, delimiter='\t')
+        for row in csvreader:
+            including_protein_clusters[row[0]] = row[1:]
+
+    # Keep only the proteins of the proteomes of the nested taxon.
+    if proteome_accession_index is not None and not proteome_accession_index.is_up_to_date(observation_name_proteomes):
+        proteome_accession_index = None
+    if proteome_accession_index is not None:
+        observation_proteomes = [os.path.basename(fasta_file)[:-len('.faa.gz')] for fasta_file in observation_name_proteomes]
+        cluster_proteins = [prot for rep_protein in including_protein_clusters for prot in including_protein_clusters[rep_protein]]
+        protein_proteome_codes = proteome_accession_index.get_proteome_codes(cluster_proteins, observation_proteomes)
+        taxon_proteins = set([prot for prot, proteome_code in zip(cluster_proteins, protein_proteome_codes.tolist()) if proteome_code != -1])
+    else:
+        taxon_proteins = set([protein_accession for fasta_file in observation_name_proteomes for protein_accession in get_proteome_accessions(fasta_file)])
+
+    protein_clusters = {}
+    for rep_protein in including_protein_clusters:
+        cluster_proteins = [prot for prot in including_protein_clusters[rep_protein] if prot in taxon_proteins]
+        if len(cluster_proteins) > 0:
+            protein_clusters[rep_protein] = cluster_proteins
+
+    cluster_proteomes_output_file = os.path.join(output_folder, 'cluster_founds', proteomes_tax_name+'.tsv')
+    with open(cluster_proteomes_output_file, 'w') as output_file:
+        csvwriter = csv.writer(output_file, delimiter='\t')
+        for rep_protein in protein_clusters:
+            csvwriter.writerow([rep_protein, *protein_clusters[rep_protein]])
+
+    computed_threshold_file = os.path.join(output_folder, 'computed_threshold', proteomes_tax_name+'.tsv')
+    number_proteomes, rep_prot_organims, computed_threshold_cluster = compute_proteome_representativeness_ratio(protein_clusters,
+                                                                                                                observation_name_proteomes, computed_threshold_file,
+                                                                                                                proteome_accession_index)
+
+    cluster_proteomes_filtered_output_file = os.path.join(output_folder, 'reference_proteins', proteomes_tax_name+'.tsv')
+    protein_cluster_to_keeps = filter_protein_cluster(protein_clusters, number_proteomes, rep_prot_organims, computed_threshold_cluster,
+                                                    clust_threshold, cluster_proteomes_filtered_output_file)
+
+    logger.info('|EsMeCaTa|clustering| %d protein clusters kept for %s (derived from the clustering of %s).', len(protein_cluster_to_keeps), proteomes_tax_name, including_tax_name)
+
+    # The MMseqs2 fasta files of the including taxon contain all its clusters (not only the ones kept for the including taxon).
+    mmseqs_tmp_cluster_output = os.path.join(output_folder, 'mmseqs_tmp', including_tax_name, 'cluster')
+    representative_fasta_file = os.path.join(output_folder, 'reference_proteins_representative_fasta', proteomes_tax_name+'.faa')
+    write_kept_protein_records(mmseqs_tmp_cluster_output + '_rep_seq.fasta', protein_cluster_to_keeps, representative_fasta_file, proteomes_tax_name)
+    consensus_fasta_file = os.path.join(output_folder, 'reference_proteins_consensus_fasta', proteomes_tax_name+'.faa')
+    write_kept_protein_records(mmseqs_tmp_cluster_output + '_con_seq.fasta', protein_cluster_to_keeps, consensus_fasta_file, proteomes_tax_name)
+
+
+def schedule_taxa_clustering(taxa_proteomes, nb_cpu, clustering_function):
+    """Cluster several taxa at the same time, sharing nb_cpu threads between their MMseqs2 runs.
+    Taxa are started from the largest to the smallest (size of their compressed proteomes, proportional to their number of residues).
+    Each taxon gets one thread by MMSEQS_PROTEOME_SIZE_BY_THREAD bytes of proteomes (or more when less taxa are waiting than free CPUs),
+    so small taxa are clustered together with one thread each and large taxa use many threads.
+
+    Args:
+        taxa_proteomes (dict): taxon name (key) associated with the list of pathnames to its proteomes (value)
+        nb_cpu (int): number of CPUs shared by the clusterings
+        clustering_function (function): function clustering a taxon, called with the taxon name, its proteomes and its number of threads
+
+    Returns:
+        taxa_threads (dict): taxon name (key) associated with the number of threads used for its clustering
+    """
+    taxa_sizes = {tax_name: sum([os.path.getsize(proteome_file) for proteome_file in proteome_files]) for tax_name, proteome_files in taxa_proteomes.items()}
+    waiting_taxa = sorted(taxa_sizes, key=lambda tax_name: taxa_sizes[tax_name], reverse=True)
+
+    taxa_threads = {}
+    free_cpus = nb_cpu
+    running_clusterings = {}
+    with ThreadPoolExecutor(max_workers=nb_cpu) as executor:
+        while len(waiting_taxa) > 0 or len(running_clusterings) > 0:
+            while len(waiting_taxa) > 0 and free_cpus > 0:
+                tax_name = waiting_taxa.pop(0)
+                size_threads = math.ceil(taxa_sizes[tax_name] / MMSEQS_PROTEOME_SIZE_BY_THREAD)
+                # When less taxa are waiting than free CPUs, the free CPUs are shared between them.
+                nb_threads = min(free_cpus, max(1, size_threads, free_cpus // (len(waiting_taxa) + 1)))
+                taxa_threads[tax_name] = nb_threads
+                free_cpus -= nb_threads
+                logger.info('|EsMeCaTa|clustering| Cluster %s with %d threads.', tax_name, nb_threads)
+                running_clusterings[executor.submit(clustering_function, tax_name, taxa_proteomes[tax_name], nb_threads)] = nb_threads
+
+            finished_clusterings, _ = wait(running_clusterings, return_when=FIRST_COMPLETED)
+            for finished_clustering in finished_clusterings:
+                free_cpus += running_clusterings.pop(finished_clustering)
+                # Raise the errors of the clustering.
+                finished_clustering.result()
+
+    return taxa_threads
+
+
+def make_clustering(proteome_folder, output_folder, nb_cpu, clust_threshold, mmseqs_options, linclust, remove_tmp, nested_clustering=None):
     """From the proteomes found by esmecata proteomes, create protein cluster for each taxonomic affiliations.
 
     Args:
@@ -371,6 +884,7 @@ def make_clustering(proteome_folder, output_folder, nb_cpu, clust_threshold, mms
         mmseqs_options (str): use alternative mmseqs option
         linclust (bool): use linclust
         remove_tmp (bool): remove the tmp files
+        nested_clustering (bool): cluster only the taxa not nested in another taxon, the clusters of nested taxa are derived from them
     """
     starttime = time.time()
     logger.info('|EsMeCaTa|clustering| Begin clustering.')
@@ -403,16 +917,44 @@ def make_clustering(proteome_folder, output_folder, nb_cpu, clust_threshold, mms
 
     already_performed_clustering = [reference_protein_file.replace('.tsv', '') for reference_protein_file in os.listdir(reference_proteins_path)]
 
+    # Proteomes of the taxa clustered by the previous run (in the copy of proteome_tax_id.tsv made at the end of the clustering).
+    clustering_taxon_id_file = os.path.join(output_folder, 'proteome_tax_id.tsv')
+    previous_taxa_proteomes = {}
+    if os.path.exists(clustering_taxon_id_file):
+        with open(clustering_taxon_id_file, 'r') as previous_proteome_tax_file:
+            csvreader = csv.DictReader(previous_proteome_tax_file, delimiter='\t')
+            for line in csvreader:
+                previous_taxa_proteomes[line['name']] = set(line['proteome'].split(','))
+    mmseqs_tmp_path = os.path.join(output_folder, 'mmseqs_tmp')
+
     # Create a dictionary with observation_name as key and the pathname to the proteomes associated to this observation_name as value.
     observation_name_fasta_files = {}
+    # Already clustered taxa with new proteomes, the ones containing all their previous proteomes have their clustering updated.
+    changed_taxa = set()
+    updated_taxa = set()
     with open(proteome_tax_id_pathname, 'r') as proteome_tax_file:
         csvreader = csv.DictReader(proteome_tax_file, delimiter='\t')
         for line in csvreader:
             proteomes = line['proteome'].split(',')
             tax_name = line['name']
             proteomes_path = [os.path.join(proteome_folder, 'proteomes', proteome+'.faa.gz') for proteome in proteomes]
-            if tax_name not in already_performed_clustering:
+            # Result files are named with '_' instead of spaces.
+            if tax_name.replace(' ', '_') not in already_performed_clustering:
                 observation_name_fasta_files[tax_name] = proteomes_path
+            elif tax_name in previous_taxa_proteomes and set(proteomes) != previous_taxa_proteomes[tax_name]:
+                observation_name_fasta_files[tax_name] = proteomes_path
+                changed_taxa.add(tax_name)
+                # mmseqs clusterupdate requires the databases of the previous clustering (removed by --remove-tmp) and does not use linclust.
+                # The previous clustering must have been made with the same options, otherwise two sets of options would be mixed.
+                previous_mmseqs_tmp_cluster = os.path.join(mmseqs_tmp_path, tax_name.replace(' ', '_'))
+                if set(proteomes).issuperset(previous_taxa_proteomes[tax_name]) and not linclust \
+                        and has_mmseqs_clustering_options(previous_mmseqs_tmp_cluster, mmseqs_options, linclust) \
+                        and os.path.exists(os.path.join(previous_mmseqs_tmp_cluster, 'db.index')) \
+                        and os.path.exists(os.path.join(previous_mmseqs_tmp_cluster, 'cluster_db.index')):
+                    updated_taxa.add(tax_name)
+                    logger.info('|EsMeCaTa|clustering| New proteomes for %s, update its clustering.', tax_name)
+                else:
+                    logger.info('|EsMeCaTa|clustering| Proteomes of %s have changed, perform clustering again.', tax_name)
             else:
                 logger.info('|EsMeCaTa|clustering| Already performed clustering for %s.', tax_name)
 
@@ -422,7 +964,7 @@ def make_clustering(proteome_folder, output_folder, nb_cpu, clust_threshold, mms
     clustering_metadata = {}
     clustering_metadata['tool_options'] = {'proteome_folder': proteome_folder, 'output_folder': output_folder, 'nb_cpu':nb_cpu,
                                         'clust_threshold':clust_threshold, 'mmseqs_options': mmseqs_options, 'linclust':linclust,
-                                        'remove_tmp': remove_tmp}
+                                        'remove_tmp': remove_tmp, 'nested_clustering': nested_clustering}
 
     clustering_metadata['tool_dependencies'] = {}
     subprocess_output = subprocess.check_output(['mmseqs', 'version'])
@@ -435,7 +977,6 @@ def make_clustering(proteome_folder, output_folder, nb_cpu, clust_threshold, mms
     clustering_metadata['tool_dependencies']['python_package']['esmecata'] = esmecata_version
 
     # Create tmp folder for mmseqs analysis.
-    mmseqs_tmp_path = os.path.join(output_folder, 'mmseqs_tmp')
     is_valid_dir(mmseqs_tmp_path)
 
     # Create output folder containing shared representative proteins.
@@ -446,79 +987,110 @@ def make_clustering(proteome_folder, output_folder, nb_cpu, clust_threshold, mms
     is_valid_dir(reference_proteins_consensus_fasta_path)
 
     proteome_taxon_id_file = os.path.join(proteome_folder, 'proteome_tax_id.tsv')
-    clustering_taxon_id_file = os.path.join(output_folder, 'proteome_tax_id.tsv')
-
-    if os.path.exists(clustering_taxon_id_file):
-        if not os.path.samefile(proteome_taxon_id_file, clustering_taxon_id_file):
-            os.remove(clustering_taxon_id_file)
-            shutil.copyfile(proteome_taxon_id_file, clustering_taxon_id_file)
-    else:
-        shutil.copyfile(proteome_taxon_id_file, clustering_taxon_id_file)
 
     proteomes_taxa_names = get_proteomes_tax_name(proteome_taxon_id_file)
 
+    # Use the proteome accession index created by esmecata proteomes to find the proteome of the clustered proteins.
+    proteome_accession_index_file = os.path.join(proteome_folder, PROTEOME_ACCESSION_INDEX_FILENAME)
+    proteome_accession_index = None
+    if os.path.exists(proteome_accession_index_file):
+        proteome_accession_index = ProteomeAccessionIndex(proteome_accession_index_file)
+
     all_tax_names = set(list(proteomes_taxa_names.values()))
 
     # For each OTU run mmseqs easy-cluster on them to found the clusters that have a protein in each proteome of the OTU.
     # We take the representative protein of a cluster if the cluster contains a protein from all the proteomes of the OTU.
     # If this condition is not satisfied the cluster will be ignored.
     # Then a fasta file containing all the representative proteins for each OTU is written in representative_fasta folder.
-    for proteomes_tax_name in all_tax_names:
-        # Get proteomes associated with taxon name.
-        observation_name_proteomes = observation_name_fasta_files[proteomes_tax_name]
-
-        # Change space with '_' to avoid issue.
-        proteomes_tax_name = proteomes_tax_name.replace(' ', '_')
-        # If the computed threshold file exists, mmseqs has already been run.
-        mmseqs_tmp_cluster = os.path.join(mmseqs_tmp_path, proteomes_tax_name)
-        # Run mmseqs on organism.
-        # Delete previous mmseqs2 run if it exists to avoid overwritting issues.
-        if os.path.exists(mmseqs_tmp_cluster):
-            shutil.rmtree(mmseqs_tmp_cluster)
-        mmseqs_tmp_clustered_tabulated, mmseqs_tmp_representative_fasta, mmseqs_consensus_fasta = run_mmseqs(proteomes_tax_name, observation_name_proteomes, mmseqs_tmp_path, nb_cpu, mmseqs_options, linclust)
-
-        # Extract protein clusters from mmseqs results.
-        cluster_proteomes_output_file = os.path.join(cluster_founds_path, proteomes_tax_name+'.tsv')
-        protein_clusters = extrat_protein_cluster_from_mmseqs(mmseqs_tmp_clustered_tabulated, cluster_proteomes_output_file)
-
-        # Compute proteome representativeness ratio.
-        computed_threshold_file = os.path.join(computed_threshold_path, proteomes_tax_name+'.tsv')
-        number_proteomes, rep_prot_organims, computed_threshold_cluster = compute_proteome_representativeness_ratio(protein_clusters,
-                                                                                                                    observation_name_proteomes, computed_threshold_file)
-
-        # Filter protein cluster for each protein cluster.
-        cluster_proteomes_filtered_output_file = os.path.join(reference_proteins_path, proteomes_tax_name+'.tsv')
-        protein_cluster_to_keeps = filter_protein_cluster(protein_clusters, number_proteomes, rep_prot_organims, computed_threshold_cluster,
-                                                        clust_threshold, cluster_proteomes_filtered_output_file)
-
-        logger.info('|EsMeCaTa|clustering| %d protein clusters kept for %s.', len(protein_cluster_to_keeps), proteomes_tax_name)
-
-        # Create BioPython records with the representative proteins kept.
-        new_records = [record for record in SeqIO.parse(mmseqs_tmp_representative_fasta, 'fasta') if record.id.split('|')[1] in protein_cluster_to_keeps]
-
-        # Do not create fasta file when 0 sequences were kept.
-        if len(new_records) > 0:
-            # Create output proteome file for OTU.
-            representative_fasta_file = os.path.join(reference_proteins_representative_fasta_path, proteomes_tax_name+'.faa')
-            SeqIO.write(new_records, representative_fasta_file, 'fasta')
+    # Several OTUs are clustered at the same time, sharing the CPUs according to the size of their proteomes.
+    # OTUs already clustered (not in observation_name_fasta_files) are skipped.
+    # OTUs with the same proteomes (and options) as an already clustered OTU reuse its results, with the clustering cache.
+    clustering_cache_file = os.path.join(output_folder, CLUSTERING_CACHE_FILENAME)
+    clustering_cache = {}
+    if os.path.exists(clustering_cache_file):
+        with open(clustering_cache_file, 'r') as open_clustering_cache_file:
+            clustering_cache = json.load(open_clustering_cache_file)
+    # Only keep the clusterings whose results are still in the output folder (and are not replaced because of new proteomes).
+    clustering_cache = {clustering_key: already_clustered_tax_name for clustering_key, already_clustered_tax_name in clustering_cache.items()
+                        if os.path.exists(os.path.join(reference_proteins_path, already_clustered_tax_name.replace(' ', '_')+'.tsv'))
+                        and already_clustered_tax_name not in changed_taxa}
+
+    taxa_proteomes = {}
+    taxa_clustering_keys = {}
+    reused_clusterings = {}
+    for proteomes_tax_name in sorted(all_tax_names):
+        if proteomes_tax_name not in observation_name_fasta_files:
+            continue
+        clustering_key = compute_clustering_key(observation_name_fasta_files[proteomes_tax_name], clust_threshold, mmseqs_options, linclust)
+        if clustering_key in clustering_cache:
+            reused_clusterings[proteomes_tax_name] = clustering_cache[clustering_key]
+            reuse_taxon_clustering(output_folder, clustering_cache[clustering_key], proteomes_tax_name)
+        elif clustering_key in taxa_clustering_keys:
+            # Another OTU of this run has the same proteomes, its results will be copied after its clustering.
+            reused_clusterings[proteomes_tax_name] = taxa_clustering_keys[clustering_key]
         else:
-            logger.info('|EsMeCaTa|clustering| 0 protein clusters %s, no fasta created.', proteomes_tax_name)
-        del new_records
-
-        # Create BioPython records with the consensus proteins kept.
-        consensus_new_records = [record for record in SeqIO.parse(mmseqs_consensus_fasta, 'fasta') if record.id.split('|')[1] in protein_cluster_to_keeps]
-
-        # Do not create fasta file when 0 sequences were kept.
-        if len(consensus_new_records) > 0:
-            # Create output proteome file for OTU.
-            consensus_fasta_file = os.path.join(reference_proteins_consensus_fasta_path, proteomes_tax_name+'.faa')
-            SeqIO.write(consensus_new_records, consensus_fasta_file, 'fasta')
-        else:
-            logger.info('|EsMeCaTa|clustering| 0 protein clusters %s, no fasta created.', proteomes_tax_name)
-        del consensus_new_records
-
-        if remove_tmp:
-            shutil.rmtree(mmseqs_tmp_cluster)
+            taxa_clustering_keys[clustering_key] = proteomes_tax_name
+            taxa_proteomes[proteomes_tax_name] = observation_name_fasta_files[proteomes_tax_name]
+
+    # Proteomes are parsed once into a MMseqs2 database, from which the database of each OTU is extracted.
+    mmseqs_db_path = os.path.join(output_folder, 'mmseqs_db')
+    mmseqs_proteomes_db = None
+    proteome_db_keys = None
+    if len(taxa_proteomes) > 0:
+        all_proteome_files = [proteome_file for proteomes_tax_name in taxa_proteomes for proteome_file in taxa_proteomes[proteomes_tax_name]]
+        mmseqs_proteomes_db, proteome_db_keys = create_proteomes_mmseqs_db(all_proteome_files, mmseqs_db_path)
+
+    # With nested clustering, the OTUs whose proteomes are included in the proteomes of another OTU are not clustered with MMseqs2.
+    nested_taxa = {}
+    if nested_clustering:
+        nested_taxa = find_nested_taxa(taxa_proteomes)
+        logger.info('|EsMeCaTa|clustering| %d taxa derived from the clustering of another taxon.', len(nested_taxa))
+    including_taxa = set(nested_taxa.values())
+
+    def clustering_function(proteomes_tax_name, observation_name_proteomes, nb_threads):
+        # MMseqs2 files of including taxa are needed to derive the nested taxa.
+        cluster_taxon_proteomes(proteomes_tax_name, observation_name_proteomes, output_folder, nb_threads, clust_threshold, mmseqs_options, linclust,
+                                remove_tmp and proteomes_tax_name not in including_taxa, proteome_accession_index, mmseqs_proteomes_db, proteome_db_keys,
+                                proteomes_tax_name in updated_taxa)
+
+    clustered_taxa_proteomes = {proteomes_tax_name: taxa_proteomes[proteomes_tax_name] for proteomes_tax_name in taxa_proteomes
+                                if proteomes_tax_name not in nested_taxa}
+    taxa_threads = schedule_taxa_clustering(clustered_taxa_proteomes, nb_cpu, clustering_function)
+    clustering_metadata['updated_clustering'] = sorted([proteomes_tax_name for proteomes_tax_name in updated_taxa if proteomes_tax_name in clustered_taxa_proteomes])
+
+    for proteomes_tax_name in nested_taxa:
+        logger.warning('|EsMeCaTa|clustering| Clusters of %s derived from the clustering of %s, they can differ from a clustering of its proteomes.',
+                       proteomes_tax_name, nested_taxa[proteomes_tax_name])
+        derive_nested_taxon_clustering(output_folder, nested_taxa[proteomes_tax_name], proteomes_tax_name, taxa_proteomes[proteomes_tax_name],
+                                       clust_threshold, proteome_accession_index)
+    # Flag the taxa whose clusters are derived from another taxon.
+    clustering_metadata['nested_clustering'] = nested_taxa
+
+    if remove_tmp:
+        for proteomes_tax_name in including_taxa:
+            shutil.rmtree(os.path.join(mmseqs_tmp_path, proteomes_tax_name.replace(' ', '_')))
+        if os.path.exists(mmseqs_db_path):
+            shutil.rmtree(mmseqs_db_path)
+    clustering_metadata['mmseqs_threads'] = taxa_threads
+
+    for proteomes_tax_name in reused_clusterings:
+        if reused_clusterings[proteomes_tax_name] in taxa_proteomes:
+            reuse_taxon_clustering(output_folder, reused_clusterings[proteomes_tax_name], proteomes_tax_name)
+    clustering_metadata['reused_clustering'] = reused_clusterings
+
+    # Derived clusters differ from a MMseqs2 clustering of the proteomes, so they are not reused.
+    clustering_cache.update({clustering_key: proteomes_tax_name for clustering_key, proteomes_tax_name in taxa_clustering_keys.items()
+                             if proteomes_tax_name not in nested_taxa})
+    with open(clustering_cache_file, 'w') as open_clustering_cache_file:
+        json.dump(clustering_cache, open_clustering_cache_file, indent=4)
+
+    # Copy the proteomes of the taxa after their clustering, it is used to find the taxa with new proteomes in the next run.
+    if os.path.exists(clustering_taxon_id_file):
+        if not os.path.samefile(proteome_taxon_id_file, clustering_taxon_id_file):
+            os.remove(clustering_taxon_id_file)
+            shutil.copyfile(proteome_taxon_id_file, clustering_taxon_id_file)
+    else:
+        shutil.copyfile(proteome_taxon_id_file, clustering_taxon_id_file)
 
     # Compute number of protein clusters kept.
     stat_file = os.path.join(output_folder, 'stat_number_clustering.tsv')
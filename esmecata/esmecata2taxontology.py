@@ -2,10 +2,10 @@ import csv
 import os.path
 
 import plotly.graph_objects as go
-from ete3 import NCBITaxa
 from typing import Dict, List, Set, Tuple
 
 from esmecata_compression import RANK2COL
+from esmecata.taxonomy import get_taxonomy_service
 
 __author__ = "Pauline Hamon-Giraud, Victor Mataigne"
 __email__ = "victor.mataigne@irisa.fr"
@@ -13,7 +13,7 @@ __email__ = "victor.mataigne@irisa.fr"
 
 # CONSTANTS ==========================================================================================================
 
-NCBI = NCBITaxa()
+NCBI = get_taxonomy_service()
 # RANK2COL = {  # KINGDOM (RED)
 #             'superkingdom': '#592d2d', 'kingdom': '#663535', 'subkingdom': '#7b4040',
 #               # PHYLUM (ORANGE)
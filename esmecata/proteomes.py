@@ -13,7 +13,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>
 
-import copy
+import codecs
 import csv
 import gzip
 import json
@@ -26,24 +26,27 @@ import re
 import requests
 import shutil
 import sys
+import tempfile
+import threading
 import time
 import seaborn as sns
 import matplotlib.pyplot as plt
 
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from requests.adapters import HTTPAdapter, Retry
 
 from Bio import __version__ as biopython_version
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
 
 from ete3 import __version__ as ete3_version
 from ete3 import NCBITaxa, is_taxadb_up_to_date
 
 from SPARQLWrapper import __version__ as sparqlwrapper_version
 
-from esmecata.utils import get_rest_uniprot_release, get_sparql_uniprot_release, is_valid_file, is_valid_dir, send_uniprot_sparql_query
+from esmecata.cache import ProteomeMetadataCache, ProteomeStore
+from esmecata.taxonomy import create_taxonomy_index, get_taxonomy_service, log_taxonomy_cache_statistics, TAXONOMY_INDEX_FILENAME
+from esmecata.utils import get_rest_uniprot_release, get_sparql_uniprot_release, is_valid_file, is_valid_dir, send_uniprot_sparql_query, stream_uniprot_sparql_query, TokenBucket, \
+                           get_proteome_accessions_file, scan_fasta_accessions, write_proteome_accessions, update_proteome_accession_index, PROTEOME_ACCESSION_INDEX_FILENAME
 from esmecata import __version__ as esmecata_version
 
 from urllib.parse import unquote
@@ -63,6 +66,55 @@ RANK_LEVEL = OrderedDict({'superkingdom': 1, 'kingdom': 2, 'subkingdom': 3, 'sup
                 'forma specialis': 33, 'subspecies': 34, 'varietas': 35, 'subvariety': 36,
                 'forma': 37, 'serogroup': 38, 'serotype': 39, 'strain': 40, 'isolate': 41})
 
+# Number of distinct taxon names resolved by each bulk query on the ete3 database.
+TAXON_NAME_CHUNK_SIZE = 5000
+
+# Number of threads querying UniProt in parallel to find the proteomes associated with the taxonomic affiliations.
+PROTEOME_QUERY_WORKERS = 8
+# Maximal number of proteome queries sent to UniProt per second by all these threads.
+PROTEOME_QUERY_RATE = 5
+
+# Number of threads downloading proteomes in parallel.
+PROTEOME_DOWNLOAD_WORKERS = 4
+# Maximal number of proteome downloads started per second by all these threads.
+PROTEOME_DOWNLOAD_RATE = 2
+# Number of attempts to download a proteome before giving up.
+PROTEOME_DOWNLOAD_ATTEMPTS = 3
+# Size (in bytes) of the chunks written to disk while downloading a proteome.
+PROTEOME_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Suffix of the temporary files in which proteomes are downloaded before being renamed.
+PROTEOME_TMP_SUFFIX = '.faa.gz.tmp'
+# Number of proteomes downloaded by each SPARQL query.
+PROTEOME_SPARQL_BATCH_SIZE = 10
+# Suffix of the partial files of REST downloads, kept after an interruption to resume the download.
+PROTEOME_PARTIAL_SUFFIX = '.faa.gz.part'
+
+# Fields of the proteome documents requested to UniProt REST API (the other fields of the proteomes are not used by esmecata).
+PROTEOME_QUERY_FIELDS = 'upid,organism_id,busco,genome_assembly,components'
+# Size (in bytes) of the chunks of REST proteome query responses parsed at once.
+PROTEOME_QUERY_CHUNK_SIZE = 64 * 1024
+# Number of taxa of the first SPARQL proteome query, then adapted to the response time of the endpoint.
+PROTEOME_SPARQL_QUERY_BATCH_SIZE = 20
+# Maximal number of taxa by SPARQL proteome query.
+PROTEOME_SPARQL_QUERY_MAX_BATCH_SIZE = 200
+# Response time (in seconds) targeted for SPARQL proteome queries: batches are halved above it and doubled below its half.
+PROTEOME_SPARQL_QUERY_TIME = 10
+
+# Name of the file containing the cost plan written by esmecata check.
+COST_PLAN_FILENAME = 'esmecata_cost_plan.json'
+# Number of proteomes by REST query retrieving the number of proteins of proteomes.
+PROTEOME_COUNT_BATCH_SIZE = 100
+# Average size (in bytes) of a protein in the gzipped fasta files of UniProt, used to estimate the size of the proteomes to download.
+ESTIMATED_COMPRESSED_PROTEIN_SIZE = 250
+# Average length (in amino acids) of UniProt proteins, used to estimate the number of residues clustered by MMseqs2.
+ESTIMATED_PROTEIN_LENGTH = 330
+# Memory used by MMseqs2 prefilter (from MMseqs2 user guide): 7 bytes by residue and 8 bytes by k-mer of the index (21^6 k-mers of size 6).
+MMSEQS_MEMORY_BY_RESIDUE = 7
+MMSEQS_INDEX_MEMORY = 8 * 21**6
+# Number of proteins by UniProt ID mapping job and number of proteomes by SPARQL query in esmecata annotation.
+ANNOTATION_REST_PROTEINS_BY_QUERY = 10000
+ANNOTATION_SPARQL_PROTEOMES_BY_QUERY = 100
+
 
 def get_next_link(headers):
     """ From batch queries, get the next link to request.
@@ -81,19 +133,23 @@ def get_next_link(headers):
             return match.group(1)
 
 
-def get_batch(session, batch_url):
+def get_batch(session, batch_url, stream=False, rate_limiter=None):
     """ Batch queries.
     Function from: https://www.uniprot.org/help/id_mapping
 
     Args:
         session (requests Session object): session used to query UniProt.
         batch_url (str): URL of batch queries.
+        stream (bool): do not read the content of the responses before returning them.
+        rate_limiter (TokenBucket): token bucket limiting the number of queries, a token is used for each page of the batch.
 
     Returns:
         batch_response (requests Response object): response to batch query.
     """
     while batch_url:
-        response = session.get(batch_url)
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        response = session.get(batch_url, stream=stream)
         response.raise_for_status()
         yield response
         batch_url = get_next_link(response.headers)
@@ -123,125 +179,269 @@ def ete3_database_update(ignore_taxadb_update):
             logger.info('|EsMeCaTa|proteomes| --ignore-taxadb-update/ignore_taxadb_update option detected, esmecata will continue with this version.')
 
 
-def update_taxonomy(observation_name, taxonomic_affiliation, ncbi=None):
+def make_taxonomy_index(output_folder, ignore_taxadb_update=None):
+    """ Compile the ete3 NCBI Taxonomy database into a memory-mappable taxonomy index.
+    This index can be given to the other esmecata commands (option --taxonomy-index) to replace ete3 SQLite database.
+
+    Args:
+        output_folder (str): pathname to the output folder
+        ignore_taxadb_update (bool): if True, ignore the need to update database.
+
+    Returns:
+        taxonomy_index_file (str): pathname to the taxonomy index file
+    """
+    starttime = time.time()
+    is_valid_dir(output_folder)
+    ete3_database_update(ignore_taxadb_update)
+
+    taxonomy_index_file = os.path.join(output_folder, TAXONOMY_INDEX_FILENAME)
+    logger.info('|EsMeCaTa|taxonomy_index| Compile ete3 NCBI Taxonomy database into %s.', taxonomy_index_file)
+    index_header = create_taxonomy_index(taxonomy_index_file)
+    logger.info('|EsMeCaTa|taxonomy_index| Taxonomy index created from %s (%d taxon IDs, %d ranks).',
+                index_header['ete3_dbfile'], index_header['arrays']['parents']['length'], len(index_header['ranks']))
+
+    endtime = time.time()
+    duration = endtime - starttime
+    logger.info('|EsMeCaTa|taxonomy_index| Taxonomy index step complete in {0}s.'.format(duration))
+
+    return taxonomy_index_file
+
+
+def get_taxon_lineage(tax_id, ncbi, taxon_lineages=None):
+    """ Get the lineage of a taxon ID as taxon IDs and as taxon names, using taxon_lineages as a memo cache.
+
+    Args:
+        tax_id (int): taxon ID
+        ncbi (ete3.NCBITaxa()): ete3 NCBI database
+        taxon_lineages (dict): taxon ID as key and its lineage as value (filled by this function)
+
+    Returns:
+        lineage (tuple): tuple of taxon IDs from the root to tax_id, tuple of the corresponding taxon names and set of these taxon names
+    """
+    if taxon_lineages is not None and tax_id in taxon_lineages:
+        return taxon_lineages[tax_id]
+
+    tax_id_lineages = ncbi.get_lineage(tax_id)
+    tax_id_translator = ncbi.get_taxid_translator(tax_id_lineages)
+    tax_id_names = tuple(tax_id_translator[tax_lineage] for tax_lineage in tax_id_lineages)
+    lineage = (tuple(tax_id_lineages), tax_id_names, frozenset(tax_id_names))
+
+    if taxon_lineages is not None:
+        taxon_lineages[tax_id] = lineage
+    return lineage
+
+
+def update_taxonomy(observation_name, taxonomic_affiliation, ncbi=None, tax_names_to_ids=None, taxon_lineages=None):
     """ Update the taxonomic affiliation using ete3 and the lowest available taxonomic name.
 
     Args:
         observation_name (str): observation name associated with taxonomic affiliation
         taxonomic_affiliation (str): str with taxon from highest taxon (such as kingdom) to lowest (such as species)
         ncbi (ete3.NCBITaxa()): ete3 NCBI database
+        tax_names_to_ids (dict): taxon name as key and list of taxon IDs as value (output of translate_taxon_names), if None the taxon names are resolved by this function
+        taxon_lineages (dict): memo cache of the lineages (see get_taxon_lineage) shared between calls
 
     Returns:
         new_taxonomic_affiliations (str): str with taxon from highest taxon (such as kingdom) to lowest (such as species)
     """
     if ncbi is None:
-        ncbi = NCBITaxa()
+        ncbi = get_taxonomy_service()
+
+    taxons = [taxon for taxon in taxonomic_affiliation.split(';')]
+    if tax_names_to_ids is None:
+        tax_names_to_ids = translate_taxon_names(taxons, ncbi)
+    set_taxons = set(taxons)
 
     # For each taxon in the affiliation, search for the lineage associated in ete3.
     lineage_all_taxa = []
-    taxons = [taxon for taxon in taxonomic_affiliation.split(';')]
     for taxon in reversed(taxons):
-        # From taxon name to taxon ID.
-        taxon_translations = ncbi.get_name_translator([taxon])
-
-        if taxon in taxon_translations:
-            if len(taxon_translations[taxon]) > 1:
-                # If there are multiple taxon IDs for a taxon name.
-                best_lineage_match = 0
-                best_lineage_matches = []
-
-                # Need to have other taxon in affiliations to find the correct one, if not skip this affiliation.
-                if len(taxons) == 1:
-                    logger.critical('|EsMeCaTa|proteomes| Taxonomy of %s has an ambiguous taxon name but not enoug taxa in its affiliations, skip updating it.', observation_name)
-                    new_taxonomic_affiliations = None
-                    break
-                # Choose the ID matching the lineage of the other taxa in the affiliations.
-                for tax_id in taxon_translations[taxon]:
-                    tax_id_lineages = ncbi.get_lineage(tax_id)
-                    tax_id_translator = ncbi.get_taxid_translator(tax_id_lineages)
-                    tax_id_name = [tax_id_translator[tax_lineage] for tax_lineage in tax_id_lineages]
-                    if len(set(tax_id_name).intersection(set(taxons))) > best_lineage_match:
-                        best_lineage_match = len(set(tax_id_name).intersection(set(taxons)))
-                        best_lineage_matches = tax_id_name
-                lineage_all_taxa.append(best_lineage_matches)
-
-            # If there is only one taxon ID, get its lineage.
-            if len(taxon_translations[taxon]) == 1:
-                tax_id = taxon_translations[taxon][0]
-                tax_id_lineages = ncbi.get_lineage(tax_id)
-                tax_id_translator = ncbi.get_taxid_translator(tax_id_lineages)
-                tax_id_name = [tax_id_translator[tax_lineage] for tax_lineage in tax_id_lineages]
-                lineage_all_taxa.append(tax_id_name)
-
-            # If no taxon found, no possibility to update
-            else:
-                new_taxonomic_affiliations = None
-        else:
-            new_taxonomic_affiliations = None
-
-    if lineage_all_taxa != []:
-        # If it founds new affiliations, check that all lineages found are similar.
-        check_lineage = []
-        for index, lineage_taxon in enumerate(lineage_all_taxa):
-            tmp_check_lineage = []
-            for index_to_compare in range(index, len(lineage_all_taxa)):
-                # Look at the intersection between the current lineage and all the ones found for the other taxon in affiliations.
-                intersection_lineage = set(lineage_taxon).intersection(set(lineage_all_taxa[index_to_compare]))
-                # If this intersection equals to the lineage we use to compare?
-                intersection_lineage_bool = intersection_lineage == set(lineage_all_taxa[index_to_compare])
-                tmp_check_lineage.append(intersection_lineage_bool)
-            check_lineage.append(tmp_check_lineage)
-
-        for index, check_values in enumerate(check_lineage):
-            # If all comparison corresponds, keep the lowest affiliation.
-            if all(check_values) is True:
-                new_taxonomic_affiliations = ';'.join(lineage_all_taxa[index])
-                logger.critical('|EsMeCaTa|proteomes| Taxonomy of %s ("%s") updated into "%s" .', observation_name, taxonomic_affiliation, new_taxonomic_affiliations)
+        # If no taxon found, no possibility to update with this taxon.
+        if taxon not in tax_names_to_ids:
+            continue
+
+        taxon_translations = tax_names_to_ids[taxon]
+        if len(taxon_translations) > 1:
+            # If there are multiple taxon IDs for a taxon name.
+            # Need to have other taxon in affiliations to find the correct one, if not skip this affiliation.
+            if len(taxons) == 1:
+                logger.critical('|EsMeCaTa|proteomes| Taxonomy of %s has an ambiguous taxon name but not enoug taxa in its affiliations, skip updating it.', observation_name)
                 break
-
-    # If no new taxonomic affiliations, keep the old one. 
-    if new_taxonomic_affiliations is None:
+            # Choose the ID matching the lineage of the other taxa in the affiliations.
+            best_lineage_match = 0
+            best_lineage_matches = ((), (), frozenset())
+            for tax_id in taxon_translations:
+                lineage = get_taxon_lineage(tax_id, ncbi, taxon_lineages)
+                lineage_match = len(lineage[2].intersection(set_taxons))
+                if lineage_match > best_lineage_match:
+                    best_lineage_match = lineage_match
+                    best_lineage_matches = lineage
+            lineage_all_taxa.append(best_lineage_matches)
+        else:
+            # If there is only one taxon ID, get its lineage.
+            lineage_all_taxa.append(get_taxon_lineage(taxon_translations[0], ncbi, taxon_lineages))
+
+    # If it founds new affiliations, keep the lowest lineage containing the lineages of all the higher taxa of the affiliation.
+    # Lineages are paths from the root, so the higher lineages can only be contained in a lineage if they are nested:
+    # going from the highest taxon to the lowest, keep their union (the deepest lineage) and check that it is contained in the current lineage.
+    new_taxonomic_affiliations = None
+    deepest_lineage = ()
+    deepest_lineage_ids = set()
+    for lineage_ids, lineage_names, _ in reversed(lineage_all_taxa):
+        lineage_id_set = set(lineage_ids)
+        if deepest_lineage == () or deepest_lineage[-1] in lineage_id_set:
+            new_taxonomic_affiliations = ';'.join(lineage_names)
+            if lineage_ids != ():
+                deepest_lineage = lineage_ids
+                deepest_lineage_ids = lineage_id_set
+        elif lineage_ids != () and lineage_ids[-1] not in deepest_lineage_ids:
+            # The lineages are not nested, no lower lineage can contain all of them.
+            break
+
+    if new_taxonomic_affiliations is not None:
+        logger.critical('|EsMeCaTa|proteomes| Taxonomy of %s ("%s") updated into "%s" .', observation_name, taxonomic_affiliation, new_taxonomic_affiliations)
+    # If no new taxonomic affiliations, keep the old one.
+    else:
         new_taxonomic_affiliations = taxonomic_affiliation
 
     return new_taxonomic_affiliations
 
 
-def taxonomic_affiliation_to_taxon_id(observation_name, taxonomic_affiliation, ncbi=None):
+def translate_taxon_names(taxon_names, ncbi=None, chunk_size=TAXON_NAME_CHUNK_SIZE):
+    """ Resolve taxon names into taxon IDs with bulk queries on the ete3 NCBI database.
+    Each distinct name is queried only once, whatever the number of times it occurs in taxon_names.
+
+    Args:
+        taxon_names (iterable): taxon names to resolve (can contain duplicates)
+        ncbi (ete3.NCBITaxa()): ete3 NCBI database
+        chunk_size (int): number of distinct taxon names resolved by each query
+
+    Returns:
+        tax_names_to_ids (dict): mapping between taxon name and the list of taxon IDs associated with it (names without taxon ID are absent)
+    """
+    if ncbi is None:
+        ncbi = get_taxonomy_service()
+
+    # ete3 matches names without case sensitivity, so names only differing by their case are resolved together.
+    lower_names = {}
+    for taxon_name in taxon_names:
+        lower_names.setdefault(taxon_name.lower(), []).append(taxon_name)
+
+    unique_names = list(lower_names)
+    lower_names_to_ids = {}
+    for index in range(0, len(unique_names), chunk_size):
+        chunk_translations = ncbi.get_name_translator(unique_names[index:index+chunk_size])
+        for taxon_name, tax_ids in chunk_translations.items():
+            lower_names_to_ids[taxon_name.lower()] = tax_ids
+
+    tax_names_to_ids = {}
+    for lower_name, original_names in lower_names.items():
+        if lower_name in lower_names_to_ids:
+            for taxon_name in original_names:
+                tax_names_to_ids[taxon_name] = lower_names_to_ids[lower_name]
+
+    return tax_names_to_ids
+
+
+def taxonomic_affiliation_to_taxon_id(observation_name, taxonomic_affiliation, ncbi=None, tax_names_to_ids=None):
     """ From a taxonomic affiliation (such as cellular organisms;Bacteria;Proteobacteria;Gammaproteobacteria) find corresponding taxon ID for each taxon.
 
     Args:
         observation_name (str): observation name associated with taxonomic affiliation
         taxonomic_affiliation (str): str with taxon from highest taxon (such as kingdom) to lowest (such as species)
         ncbi (ete3.NCBITaxa()): ete3 NCBI database
+        tax_names_to_ids (dict): already resolved mapping between taxon name and taxon IDs (output of translate_taxon_names), if None the taxon names are resolved with ncbi
     Returns:
         tax_ids_to_names (dict): mapping between taxon ID and taxon name
         taxon_ids (dict): mapping between taxon name and taxon ID
     """
-    if ncbi is None:
-        ncbi = NCBITaxa()
-
     taxons = [taxon for taxon in taxonomic_affiliation.split(';')]
-    tax_names_to_ids = ncbi.get_name_translator(taxons)
+
+    if tax_names_to_ids is None:
+        tax_names_to_ids = translate_taxon_names(taxons, ncbi)
+
     taxon_ids = OrderedDict()
+    tax_ids_to_names = {}
     for taxon in taxons:
-        taxon_translations = ncbi.get_name_translator([taxon])
-        if taxon_translations == {}:
+        if taxon in tax_names_to_ids:
+            taxon_ids[taxon] = list(tax_names_to_ids[taxon])
+            for tax_id in tax_names_to_ids[taxon]:
+                tax_ids_to_names[tax_id] = taxon
+        else:
             logger.critical('|EsMeCaTa|proteomes| For %s, no taxon ID has been found associated with the taxon "%s" in the NCBI taxonomy of ete3.', observation_name, taxon)
-            taxon_translations = {taxon: ['not_found']}
-        taxon_ids.update(taxon_translations)
-    tax_ids_to_names = {v: k for k, vs in tax_names_to_ids.items() for v in vs }
+            taxon_ids[taxon] = ['not_found']
 
     return tax_ids_to_names, taxon_ids
 
 
-def associate_taxon_to_taxon_id(taxonomic_affiliations, update_affiliations=None, ncbi=None, output_folder=None):
+def normalise_taxonomic_affiliation(taxonomic_affiliation):
+    """ Normalise a taxonomic affiliation by removing the spaces around the affiliation and around each of its taxon.
+
+    Args:
+        taxonomic_affiliation (str): str with taxon from highest taxon (such as kingdom) to lowest (such as species)
+
+    Returns:
+        normalised_taxonomic_affiliation (str): normalised taxonomic affiliation
+    """
+    normalised_taxonomic_affiliation = ';'.join([taxon.strip() for taxon in taxonomic_affiliation.strip().split(';')])
+
+    return normalised_taxonomic_affiliation
+
+
+def group_identical_affiliations(taxonomic_affiliations):
+    """ Group observation names sharing the same normalised taxonomic affiliation.
+    The first observation name of each group is used as its representative, so taxonomy and proteome searches are performed once per unique affiliation.
+    Observation names without taxonomic affiliation (not str) are ignored.
+
+    Args:
+        taxonomic_affiliations (dict): dictionary with observation name as key and taxonomic affiliation as value
+
+    Returns:
+        unique_taxonomic_affiliations (dict): representative observation name as key and normalised taxonomic affiliation as value
+        observation_representatives (dict): observation name as key and its representative observation name as value (in the input order)
+    """
+    unique_taxonomic_affiliations = {}
+    observation_representatives = {}
+    affiliation_representatives = {}
+
+    for observation_name in taxonomic_affiliations:
+        taxonomic_affiliation = taxonomic_affiliations[observation_name]
+        if isinstance(taxonomic_affiliation, str):
+            normalised_taxonomic_affiliation = normalise_taxonomic_affiliation(taxonomic_affiliation)
+            if normalised_taxonomic_affiliation not in affiliation_representatives:
+                affiliation_representatives[normalised_taxonomic_affiliation] = observation_name
+                unique_taxonomic_affiliations[observation_name] = normalised_taxonomic_affiliation
+            observation_representatives[observation_name] = affiliation_representatives[normalised_taxonomic_affiliation]
+
+    return unique_taxonomic_affiliations, observation_representatives
+
+
+def expand_to_observations(representative_results, observation_representatives):
+    """ Fan out results computed for representative observation names to all the observation names sharing their affiliation.
+
+    Args:
+        representative_results (dict): representative observation name as key and associated result as value
+        observation_representatives (dict): observation name as key and its representative observation name as value
+
+    Returns:
+        observation_results (dict): observation name as key and the result of its representative as value (in the input order)
+    """
+    observation_results = {observation_name: representative_results[representative]
+                           for observation_name, representative in observation_representatives.items()
+                           if representative in representative_results}
+
+    return observation_results
+
+
+def associate_taxon_to_taxon_id(taxonomic_affiliations, update_affiliations=None, ncbi=None, output_folder=None, observation_representatives=None):
     """ From a dictionary containing multiple taxonomic affiliations, find the taxon ID for each.
+    All the distinct taxon names of the affiliations are resolved together with bulk queries, so the number of queries on the ete3 database depends on the number of distinct taxon names and not on the number of observations.
 
     Args:
         taxonomic_affiliations (dict): dictionary with observation name as key and taxonomic affiliation as value
         update_affiliations (str): option to update taxonomic affiliations.
         ncbi (ete3.NCBITaxa()): ete3 NCBI database.
         output_folder (str): pathname to output folder.
+        observation_representatives (dict): observation name associated with its representative observation name (output of group_identical_affiliations), used to write the updated affiliations of all observation names
 
     Returns:
         tax_id_names (dict): mapping between taxon ID and taxon name
@@ -254,19 +454,49 @@ def associate_taxon_to_taxon_id(taxonomic_affiliations, update_affiliations=None
         logger.critical('|EsMeCaTa|proteomes| Empty taxonomy dictionary.')
         return
 
+    if ncbi is None:
+        ncbi = get_taxonomy_service()
+
+    tax_names_to_ids = {}
+    resolved_taxon_names = set()
+    if update_affiliations is not None:
+        # Resolve the taxon names of the input affiliations in bulk and share the resolved names and lineages between all the updates.
+        input_taxon_names = set(taxon for taxonomic_affiliation in taxonomic_affiliations.values()
+                                if isinstance(taxonomic_affiliation, str) for taxon in taxonomic_affiliation.split(';'))
+        tax_names_to_ids = translate_taxon_names(input_taxon_names, ncbi)
+        resolved_taxon_names = input_taxon_names
+        taxon_lineages = {}
+        affiliation_updates = {}
+
     new_taxonomic_affiliations = []
-    # For each taxon find the taxon ID corresponding to each taxon.
+    observation_affiliations = {}
     for observation_name in taxonomic_affiliations:
         taxonomic_affiliation = taxonomic_affiliations[observation_name]
         if isinstance(taxonomic_affiliation, str):
             if update_affiliations is not None:
-                taxonomic_affiliation = update_taxonomy(observation_name, taxonomic_affiliation, ncbi)
+                if taxonomic_affiliation not in affiliation_updates:
+                    affiliation_updates[taxonomic_affiliation] = update_taxonomy(observation_name, taxonomic_affiliation, ncbi,
+                                                                                 tax_names_to_ids, taxon_lineages)
+                taxonomic_affiliation = affiliation_updates[taxonomic_affiliation]
                 new_taxonomic_affiliations.append([observation_name, taxonomic_affiliation])
-            tax_ids_to_names, taxon_ids = taxonomic_affiliation_to_taxon_id(observation_name, taxonomic_affiliation, ncbi)
-            tax_id_names.update(tax_ids_to_names)
-            json_taxonomic_affiliations[observation_name] = taxon_ids
+            observation_affiliations[observation_name] = taxonomic_affiliation
+
+    # Resolve all the distinct taxon names in bulk (only the ones not already resolved for the update).
+    all_taxon_names = set(taxon for taxonomic_affiliation in observation_affiliations.values() for taxon in taxonomic_affiliation.split(';'))
+    tax_names_to_ids.update(translate_taxon_names(all_taxon_names.difference(resolved_taxon_names), ncbi))
+
+    # For each taxon find the taxon ID corresponding to each taxon.
+    for observation_name, taxonomic_affiliation in observation_affiliations.items():
+        tax_ids_to_names, taxon_ids = taxonomic_affiliation_to_taxon_id(observation_name, taxonomic_affiliation, ncbi, tax_names_to_ids)
+        tax_id_names.update(tax_ids_to_names)
+        json_taxonomic_affiliations[observation_name] = taxon_ids
 
     if update_affiliations:
+        if observation_representatives is not None:
+            updated_affiliations = dict(new_taxonomic_affiliations)
+            new_taxonomic_affiliations = [[observation_name, updated_affiliations[representative]]
+                                          for observation_name, representative in observation_representatives.items()
+                                          if representative in updated_affiliations]
         # Write new taxonomic file if update-affiliations.
         new_taxon_file = os.path.join(output_folder, 'new_taxonomic_affiliation.tsv')
         with open(new_taxon_file, 'w') as output_file:
@@ -278,9 +508,40 @@ def associate_taxon_to_taxon_id(taxonomic_affiliations, update_affiliations=None
     return tax_id_names, json_taxonomic_affiliations
 
 
+def find_relevant_taxon_id(taxon_ids, data_lineage, ncbi, candidate_lineages=None):
+    """ Among the taxon IDs associated with an ambiguous taxon name, find the one whose lineage shares the most taxon IDs with the taxonomic affiliation.
+
+    Args:
+        taxon_ids (list): taxon IDs associated with the taxon name
+        data_lineage (set): taxon IDs of the taxa above the taxon name in the taxonomic affiliation
+        ncbi (ete3.NCBITaxa()): ete3 NCBI database
+        candidate_lineages (dict): memo cache with taxon ID as key and the set of taxon IDs of its lineage as value
+
+    Returns:
+        relevant_taxon (int): taxon ID with the most shared taxon IDs (the first one if several have the same number), None if no taxon ID shares taxon IDs with the affiliation
+    """
+    if candidate_lineages is None:
+        candidate_lineages = {}
+
+    relevant_taxon = None
+    previous_nb_shared_ids = 0
+    for taxon_id in taxon_ids:
+        # Extract the known lineage corresponding to one of the taxon ID.
+        if taxon_id not in candidate_lineages:
+            candidate_lineages[taxon_id] = set(ncbi.get_lineage(taxon_id))
+        # Computes the shared taxon ID between the known lineage and the taxonomic affiliation associated with the taxon.
+        nb_shared_ids = len(data_lineage.intersection(candidate_lineages[taxon_id]))
+        if nb_shared_ids > previous_nb_shared_ids:
+            relevant_taxon = taxon_id
+            previous_nb_shared_ids = nb_shared_ids
+
+    return relevant_taxon
+
+
 def disambiguate_taxon(json_taxonomic_affiliations, ncbi):
     """ From json_taxonomic_affiliations (output of associate_taxon_to_taxon_id), disambiguate taxon name having multiples taxon IDs.
     For example, Yersinia is associated with both taxon ID 629 and 444888. By using the other taxon in the taxonomic affiliation, this function selects the correct taxon ID.
+    The same ambiguous taxon names occur in many observations, so the selected taxon ID is computed once for each taxon name and set of taxon IDs above it in the affiliation (decision table) and applied to all the observations.
 
     Args:
         json_taxonomic_affiliations (dict): observation name and dictionary with mapping betwenn taxon name and taxon ID
@@ -290,39 +551,29 @@ def disambiguate_taxon(json_taxonomic_affiliations, ncbi):
     """
     # If there is multiple taxon ID for a taxon, use the taxon ID lineage to find the most relevant taxon.
     # The most relevant taxon is the one with the most overlapping lineage with the taxonomic affiliation.
+    decision_table = {}
+    candidate_lineages = {}
     taxon_to_modify = {}
 
     for observation_name in json_taxonomic_affiliations:
-        observation_name_taxons = list(json_taxonomic_affiliations[observation_name].values())
-
-        for index, taxon in enumerate(json_taxonomic_affiliations[observation_name]):
-            taxon_ids = json_taxonomic_affiliations[observation_name][taxon]
+        # Taxon IDs of the taxa above the current taxon in the taxonomic affiliation.
+        data_lineage = set()
+        for taxon, taxon_ids in json_taxonomic_affiliations[observation_name].items():
             # If a taxon name is associated with more than one taxon ID, search for the one matching with the other taxon in the taxonomic affiliation.
             if len(taxon_ids) > 1:
-                taxon_shared_ids = {}
-                for taxon_id in taxon_ids:
-                    # Extract the other taxon present in the taxonomic affiliation.
-                    data_lineage = [tax_id for tax_id_lists in observation_name_taxons[0:index] for tax_id in tax_id_lists]
-                    # Extract the known lineage corresponding to one of the taxon ID.
-                    lineage = ncbi.get_lineage(taxon_id)
-                    # Computes the shared taxon ID between the known lineage and the taxonomic affiliation associated with the taxon.
-                    nb_shared_ids = len(set(data_lineage).intersection(set(lineage)))
-                    taxon_shared_ids[taxon_id] = nb_shared_ids
+                decision_key = (taxon, tuple(taxon_ids), frozenset(data_lineage))
+                if decision_key not in decision_table:
+                    decision_table[decision_key] = find_relevant_taxon_id(taxon_ids, data_lineage, ncbi, candidate_lineages)
+                relevant_taxon = decision_table[decision_key]
 
                 # If there is no match with the lineage for all the multiple taxon ID, it is not possible to decipher, stop esmecata.
-                if all(shared_id==0 for shared_id in taxon_shared_ids.values()):
-                    taxids = ','.join([str(taxid) for taxid in list(taxon_shared_ids.keys())])
+                if relevant_taxon is None:
+                    taxids = ','.join([str(taxid) for taxid in taxon_ids])
                     logger.critical('|EsMeCaTa|proteomes| It is not possible to find the taxon ID for the taxon named "%s" (associated with "%s") as there are multiple taxIDs possible (%s), please add a more detailed taxonomic classification to help finding the correct one.', taxon, observation_name, taxids)
                     sys.exit()
                 # If there is some matches, take the taxon ID with the most match and it will be the "correct one".
-                else:
-                    previous_nb_shared_ids = 0
-                    for taxon_id in taxon_shared_ids:
-                        if taxon_shared_ids[taxon_id] > previous_nb_shared_ids:
-                            relevant_taxon = taxon_id
-                            taxon_to_modify[observation_name] = {}
-                            taxon_to_modify[observation_name][taxon] = [relevant_taxon]
-                        previous_nb_shared_ids = nb_shared_ids
+                taxon_to_modify.setdefault(observation_name, {})[taxon] = [relevant_taxon]
+            data_lineage.update(taxon_ids)
 
     for observation_name in taxon_to_modify:
         for taxon in taxon_to_modify[observation_name]:
@@ -343,61 +594,45 @@ def filter_rank_limit(json_taxonomic_affiliations, ncbi, rank_limit):
         output_json_taxonomic_affiliations (dict): observation name and dictionary with mapping betwenn taxon name and taxon ID (with remove rank specified)
     """
     unclassified_rank = ['unclassified '+rank for rank in RANK_LEVEL]
-    non_hierarchical_ranks = ['clade', 'environmental samples', 'incertae sedis', 'no rank'] + unclassified_rank
+    non_hierarchical_ranks = set(['clade', 'environmental samples', 'incertae sedis', 'no rank'] + unclassified_rank)
 
     rank_limit_level = RANK_LEVEL[rank_limit]
-    rank_to_keeps = [rank for rank in RANK_LEVEL if RANK_LEVEL[rank] >= rank_limit_level]
-
-    # Create a deep copy of the input dictionary, as we will modified this dictionary.
-    output_json_taxonomic_affiliations = copy.deepcopy(json_taxonomic_affiliations)
-    for observation_name in output_json_taxonomic_affiliations:
-        observation_name_taxons = output_json_taxonomic_affiliations[observation_name]
-        tax_keep = []
-        tax_ranks = {}
-        tax_names = {}
-        tax_rank_position = {}
-        tax_ids = []
-        for index, tax_name in enumerate(observation_name_taxons):
-            tax_id = observation_name_taxons[tax_name][0]
-            tax_ids.append(tax_id)
-            if tax_id != 'not_found':
-                tax_rank = ncbi.get_rank([tax_id])[tax_id]
-                tax_rank_position[tax_rank] = index
-                if tax_rank in rank_to_keeps:
-                    tax_ranks[tax_rank] = tax_id
-                tax_names[tax_id] = tax_name
-                # If the rank is below the rank to remove keep it.
-                if tax_rank in rank_to_keeps:
-                    tax_keep.append(True)
-                elif tax_rank in non_hierarchical_ranks:
-                    # If a nonhierarchical rank is below a rank that has been checked as being below the rank to remove, keep it.
-                    if any(tax_keep):
-                        tax_keep.append(True)
-                    # If not remove it.
-                    else:
-                        tax_keep.append(False)
-                else:
-                    tax_keep.append(False)
-            else:
-                tax_keep.append(False)
+    rank_to_keeps = set(rank for rank in RANK_LEVEL if RANK_LEVEL[rank] >= rank_limit_level)
+
+    # Query the ranks of all the taxon IDs of all the observations at once.
+    all_tax_ids = set(taxon_ids[0] for observation_name_taxons in json_taxonomic_affiliations.values()
+                      for taxon_ids in observation_name_taxons.values() if taxon_ids[0] != 'not_found')
+    tax_id_ranks = ncbi.get_rank(list(all_tax_ids))
+
+    # Create a new dictionary (with the kept taxa) instead of modifying the input dictionary.
+    output_json_taxonomic_affiliations = {}
+    for observation_name, observation_name_taxons in json_taxonomic_affiliations.items():
+        tax_names = list(observation_name_taxons.keys())
+        tax_ids = [observation_name_taxons[tax_name][0] for tax_name in tax_names]
+        tax_ranks = [tax_id_ranks[tax_id] if tax_id != 'not_found' else None for tax_id in tax_ids]
 
         # If the rank limit is in the tax_ranks, keep all the rank below this rank and this rank.
         if rank_limit in tax_ranks:
-            tax_rank_max_index = tax_rank_position[rank_limit]
-            keep_tax_ids = [tax_id[0] for _, tax_id in list(observation_name_taxons.items())[tax_rank_max_index:]]
+            tax_rank_max_index = len(tax_ranks) - 1 - tax_ranks[::-1].index(rank_limit)
+            keep_tax_ids = set(tax_ids[tax_rank_max_index:])
         # If not find all the rank below this rank (by using rank_level and rank_to_keeps) in the list and keep them.
-        # Use the tax_keep to keep non_hierarchical_ranks below the rank to remove.
+        # Keep non_hierarchical_ranks below the rank to remove.
         # But they need to be below a hierarchical rank that has been checked as being below the rank to remove.
         else:
-            keep_tax_ids = [tax_ids[tax_index] for tax_index, bool_choice in enumerate(tax_keep) if bool_choice is True]
-
-        tax_ids_wo_not_found = [tax_id for tax_id in tax_ids if tax_id != 'not_found']
-        tax_id_to_deletes = set(tax_ids_wo_not_found) - set(keep_tax_ids)
+            keep_tax_ids = set()
+            below_kept_rank = False
+            for tax_id, tax_rank in zip(tax_ids, tax_ranks):
+                if tax_rank in rank_to_keeps:
+                    keep_tax_ids.add(tax_id)
+                    below_kept_rank = True
+                elif tax_rank in non_hierarchical_ranks and below_kept_rank:
+                    keep_tax_ids.add(tax_id)
 
-        # Delete the remvoed rank and all its superior.
-        for tax_id in tax_id_to_deletes:
-            tax_name = tax_names[tax_id]
-            del output_json_taxonomic_affiliations[observation_name][tax_name]
+        # Remove the taxa with a rank superior to the rank limit.
+        tax_id_names = {tax_id: tax_name for tax_name, tax_id in zip(tax_names, tax_ids)}
+        tax_names_to_deletes = set(tax_id_names[tax_id] for tax_id in tax_ids if tax_id != 'not_found' and tax_id not in keep_tax_ids)
+        output_json_taxonomic_affiliations[observation_name] = OrderedDict((tax_name, list(observation_name_taxons[tax_name]))
+                                                                           for tax_name in tax_names if tax_name not in tax_names_to_deletes)
 
     return output_json_taxonomic_affiliations
 
@@ -432,9 +667,57 @@ def requests_query(http_str, nb_retry=5):
         return response
 
 
+def iter_json_results(response, chunk_size=PROTEOME_QUERY_CHUNK_SIZE):
+    """Parse incrementally the results of a UniProt REST JSON response ({"results": [...]}).
+    The response is read by chunks and each result is yielded as soon as it has been received,
+    so the whole response is never stored in memory.
+
+    Args:
+        response (requests Response object): streamed response of a UniProt REST query in JSON format
+        chunk_size (int): number of bytes read at once
+
+    Returns:
+        result (dict): each element of the results list of the response
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    results_position = None
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        buffer += text_decoder.decode(chunk)
+        position = 0
+        if results_position is None:
+            results_key_position = buffer.find('"results"')
+            if results_key_position == -1:
+                continue
+            results_position = buffer.find('[', results_key_position)
+            if results_position == -1:
+                results_position = None
+                continue
+            position = results_position + 1
+
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position == len(buffer):
+                break
+            if buffer[position] == ']':
+                return
+            try:
+                result, position_end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The result is not complete, wait for the next chunk.
+                break
+            yield result
+            position = position_end
+        buffer = buffer[position:]
+
+    raise ValueError('Incomplete JSON response from {0}.'.format(response.url))
+
+
 def rest_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_keep,
                          all_proteomes, session=None, option_bioservices=None,
-                         minimal_number_proteomes=1):
+                         minimal_number_proteomes=1, rate_limiter=None):
     """REST query on UniProt to get the proteomes associated with a taxon.
 
     Args:
@@ -446,6 +729,7 @@ def rest_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_ke
         session: request session object
         option_bioservices (bool): use bioservices instead of manual queries.
         minimal_number_proteomes (int): minimal number of proteomes required to be associated with a taxon for the taoxn to be kept.
+        rate_limiter (TokenBucket): token bucket limiting the number of queries sent to UniProt
 
     Returns:
         proteomes (list): list of proteome IDs associated with the taxon ID
@@ -461,25 +745,27 @@ def rest_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_ke
         # Find proteomes associated with taxon.
         # Search for both representative and non-representative proteomes (with proteome_type%3A2 for non-representative proteome (or Other proteome) and proteome_type%3A1) for representative proteome).
         # Remove redundant and excluded proteomes.
-        httpt_str = 'https://rest.uniprot.org/proteomes/stream?query=(taxonomy_id%3A{0})AND((proteome_type%3A2)OR(proteome_type%3A1))&format=json&size=500'.format(tax_id)
-
-        data = {}
-        data['results'] = []
-        for batch_reponse in get_batch(session, httpt_str):
-            batch_json = batch_reponse.json()
-            data['results'].extend(batch_json['results'])
+        # Only the fields used by esmecata are requested (requests asks for a gzip compressed response) and the responses are parsed while they are received.
+        # As the proteome type is not one of these fields, representative and non-representative proteomes are searched by two queries.
+        def iter_proteome_documents():
+            for proteome_type, representative_proteome in [(1, True), (2, False)]:
+                httpt_str = 'https://rest.uniprot.org/proteomes/stream?query=(taxonomy_id%3A{0})AND(proteome_type%3A{1})&fields={2}&format=json'.format(tax_id, proteome_type, PROTEOME_QUERY_FIELDS)
+                for batch_reponse in get_batch(session, httpt_str, stream=True, rate_limiter=rate_limiter):
+                    with batch_reponse:
+                        for proteome_data in iter_json_results(batch_reponse):
+                            yield proteome_data, representative_proteome
+        proteome_documents = iter_proteome_documents()
     else:
         import bioservices
+        if rate_limiter is not None:
+            rate_limiter.acquire()
         uniprot_bioservices = bioservices.UniProt()
         data = uniprot_bioservices.search(f'(taxonomy_id={tax_id})AND((proteome_type=2)OR(proteome_type=1))',
                                             database='proteomes', frmt='json', progress=False)
+        proteome_documents = [(proteome_data, None) for proteome_data in data['results']]
 
-    organism_ids = {}
     proteomes_data = []
-    representative_proteomes = []
-    other_proteomes = []
-
-    for proteome_data in data['results']:
+    for proteome_data, representative_proteome in proteome_documents:
         proteome_id = proteome_data['id']
         if 'proteomeCompletenessReport' in proteome_data:
             if 'buscoReport' in proteome_data['proteomeCompletenessReport']:
@@ -493,14 +779,14 @@ def rest_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_ke
         else:
             busco_score = None
 
-        if 'level' in proteome_data['genomeAssembly']:
+        if 'level' in proteome_data.get('genomeAssembly', {}):
             assembly_level = proteome_data['genomeAssembly']['level']
         else:
             assembly_level = ''
         org_tax_id = str(proteome_data['taxonomy']['taxonId'])
 
-        # Check proteome type for representative or non-representative.
-        proteome_type = proteome_data['proteomeType']
+        # Check proteome type for representative or non-representative (when it is not known from the query).
+        proteome_type = proteome_data.get('proteomeType')
 
         if proteome_type in ['Representative proteome', 'Reference and representative proteome', 'Reference proteome']:
             representative_proteome = True
@@ -516,29 +802,69 @@ def rest_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_ke
         else:
             component_elements = None
 
-        if busco_percentage_keep:
-            if busco_score and busco_score >= busco_percentage_keep and assembly_level == 'full':
-                if representative_proteome is True:
-                    representative_proteomes.append(proteome_id)
-                elif representative_proteome is False:
-                    other_proteomes.append(proteome_id)
+        proteomes_data.append([proteome_id, busco_score, assembly_level, org_tax_id, representative_proteome, component_elements])
 
-                if org_tax_id not in organism_ids:
-                    organism_ids[org_tax_id] = [proteome_id]
-                else:
-                    organism_ids[org_tax_id].append(proteome_id)
+    proteomes, organism_ids = select_proteomes(observation_name, tax_id, tax_name, proteomes_data, busco_percentage_keep,
+                                               all_proteomes, minimal_number_proteomes)
+
+    return proteomes, organism_ids, proteomes_data
+
+
+def select_proteomes(observation_name, tax_id, tax_name, proteomes_data, busco_percentage_keep,
+                     all_proteomes, minimal_number_proteomes=1, sparql_proteomes=None):
+    """Select the proteomes of a taxon according to their BUSCO score, their assembly level and their type (reference or not).
+
+    Args:
+        observation_name (str): observation name associated with the taxonomic affiliation
+        tax_id (str): taxon ID from a taxon of the taxonomic affiliation
+        tax_name (str): taxon name associated with the tax_id
+        proteomes_data (list): list of lists with proteome_id, busco_score, assembly_level, org_tax_id, reference_proteome, component_elements
+        busco_percentage_keep (float): BUSCO score to filter proteomes (proteomes selected will have a higher BUSCO score than this threshold)
+        all_proteomes (bool): Option to select all the proteomes (and not only preferentially reference proteomes)
+        minimal_number_proteomes (int): minimal number of proteomes required to be associated with a taxon for the taoxn to be kept.
+        sparql_proteomes (bool): proteomes_data comes from SPARQL queries (where reference proteomes are also non-reference proteomes)
+
+    Returns:
+        proteomes (list): list of proteome IDs associated with the taxon ID
+        organism_ids (dict): organism ID (key) associated with each proteomes (values)
+    """
+    organism_ids = {}
+    representative_proteomes = []
+    other_proteomes = []
+
+    for proteome_id, busco_score, assembly_level, org_tax_id, representative_proteome, _ in proteomes_data:
+        if busco_percentage_keep:
+            keep_proteome = busco_score and busco_score >= busco_percentage_keep and assembly_level == 'full'
         else:
-            if assembly_level == 'full':
-                if representative_proteome is True:
-                    representative_proteomes.append(proteome_id)
-                elif representative_proteome is False:
-                    other_proteomes.append(proteome_id)
+            keep_proteome = assembly_level == 'full'
+
+        if keep_proteome:
+            if representative_proteome is True:
+                representative_proteomes.append(proteome_id)
+            elif representative_proteome is False:
+                other_proteomes.append(proteome_id)
+            # In SPARQL, reference proteomes are also labelled as non-reference proteome.
+            if sparql_proteomes is not None and representative_proteome is True:
+                other_proteomes.append(proteome_id)
+
+            if org_tax_id not in organism_ids:
+                organism_ids[org_tax_id] = [proteome_id]
+            else:
+                organism_ids[org_tax_id].append(proteome_id)
 
-                if org_tax_id not in organism_ids:
-                    organism_ids[org_tax_id] = [proteome_id]
-                else:
-                    organism_ids[org_tax_id].append(proteome_id)
-        proteomes_data.append([proteome_id, busco_score, assembly_level, org_tax_id, representative_proteome, component_elements])
+    if sparql_proteomes is not None:
+        # To use both reference and non-reference proteomes, use only other_proteomes.
+        other_proteomes = set(other_proteomes)
+        representative_proteomes = set(representative_proteomes)
+        if all_proteomes is not None:
+            proteomes = other_proteomes
+        else:
+            if len(representative_proteomes) == 0 or len(representative_proteomes) < minimal_number_proteomes:
+                logger.info('|EsMeCaTa|proteomes| %s: No reference proteomes found for %s (%s) try non-reference proteomes.', observation_name, tax_id, tax_name)
+                proteomes = other_proteomes
+            else:
+                proteomes = representative_proteomes
+        return proteomes, organism_ids
 
     # In REST queries, reference proteomes are not associated with non-reference proteome tag (compared to SPARQL query).
     # So to have both of them with all_proteomes otpion, we need to add other_proteomes to representative_proteomes.
@@ -554,7 +880,7 @@ def rest_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_ke
         else:
             proteomes = representative_proteomes
 
-    return proteomes, organism_ids, proteomes_data
+    return proteomes, organism_ids
 
 
 def sparql_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_keep,
@@ -575,10 +901,30 @@ def sparql_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_
         organism_ids (dict): organism ID (key) associated with each proteomes (values)
         proteomes_data (list): list of lists with proteome_id, busco_score, assembly_level, org_tax_id, reference_proteome, component_elements
     """
+    return sparql_query_proteomes_batch({tax_id: (observation_name, tax_name)}, busco_percentage_keep, all_proteomes,
+                                        uniprot_sparql_endpoint, minimal_number_proteomes)[tax_id]
+
+
+def sparql_query_proteomes_batch(taxa, busco_percentage_keep, all_proteomes, uniprot_sparql_endpoint='https://sparql.uniprot.org/sparql',
+                                 minimal_number_proteomes=1):
+    """SPARQL query on UniProt to get the proteomes associated with several taxa in one query.
+    The taxa are bound with VALUES and each line of the answer is tagged with its queried taxon, to split the answer by taxon.
+
+    Args:
+        taxa (dict): taxon ID (key) associated with the observation name and the taxon name (value)
+        busco_percentage_keep (float): BUSCO score to filter proteomes (proteomes selected will have a higher BUSCO score than this threshold)
+        all_proteomes (bool): Option to select all the proteomes (and not only preferentially reference proteomes)
+        uniprot_sparql_endpoint (str): uniprot SPARQL endpoint to query (by default query Uniprot SPARQL endpoint)
+        minimal_number_proteomes (int): minimal number of proteomes required to be associated with a taxon for the taoxn to be kept.
+
+    Returns:
+        tax_id_proteomes (dict): taxon ID (key) associated with the proteomes, organism_ids and proteomes_data of the taxon (value, see sparql_query_proteomes)
+    """
     # SPARQL query to retrieve proteome
     # First FILTER NOT EXISTS to avoid redundant proteomes.
     # Second FILTER NOT EXISTS to avoid excluded proteomes.
     # OPTIONAL allows to retrive reference and non reference proteomes and split them.
+    # VALUES binds the queried taxa, ?taxon tags each line with the queried taxon of the organism.
     # From: uniprot graph location https://sparql.uniprot.org/.well-known/void%3E
     uniprot_sparql_query = """PREFIX up: <http://purl.uniprot.org/core/>
     PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
@@ -586,13 +932,14 @@ def sparql_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_
     PREFIX busco: <http://busco.ezlab.org/schema#>
     PREFIX taxon: <http://purl.uniprot.org/taxonomy/>
 
-    SELECT DISTINCT ?proteome ?score ?fragmented ?missing ?organism ?completion ?type ?component ?componentName
+    SELECT DISTINCT ?proteome ?score ?fragmented ?missing ?organism ?completion ?type ?component ?componentName ?taxon
 
     WHERE
     {{
         ?proteome rdf:type up:Proteome .
         ?proteome up:organism ?organism .
-        ?organism rdfs:subClassOf taxon:{0} .
+        VALUES ?taxon {{ {0} }}
+        ?organism rdfs:subClassOf ?taxon .
         OPTIONAL {{
             ?proteome busco:has_score ?busco .
             ?busco busco:complete ?score .
@@ -616,10 +963,90 @@ def sparql_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_
             ?proteome skos:narrower ?component .
             ?component rdfs:comment ?componentName .
         }}
-    }}""".format(tax_id)
+    }}""".format(' '.join(['taxon:{0}'.format(tax_id) for tax_id in taxa]))
+
+    # Taxon IDs can be given as int or str, lines are associated with them as str.
+    tax_id_lines = {str(tax_id): [] for tax_id in taxa}
+    for line in send_uniprot_sparql_query(uniprot_sparql_query, uniprot_sparql_endpoint):
+        tax_id_lines[line[9].split('/')[-1]].append(line)
+
+    tax_id_proteomes = {}
+    for tax_id, (observation_name, tax_name) in taxa.items():
+        tax_id_proteomes[tax_id] = parse_sparql_proteomes(observation_name, tax_id, tax_name, tax_id_lines[str(tax_id)], busco_percentage_keep,
+                                                          all_proteomes, minimal_number_proteomes)
+
+    return tax_id_proteomes
+
+
+def sparql_query_proteomes_batches(taxa, busco_percentage_keep, all_proteomes, uniprot_sparql_endpoint='https://sparql.uniprot.org/sparql',
+                                   minimal_number_proteomes=1, batch_size=PROTEOME_SPARQL_QUERY_BATCH_SIZE, rate_limiter=None):
+    """Query the proteomes of taxa with SPARQL batch queries, the number of taxa by query being adapted to the response time of the endpoint.
+    The batch size is halved when a query takes more than PROTEOME_SPARQL_QUERY_TIME seconds or fails (the taxa of a failed query are
+    queried again in smaller batches) and doubled when a query takes less than half of this time.
+
+    Args:
+        taxa (dict): taxon ID (key) associated with the observation name and the taxon name (value)
+        busco_percentage_keep (float): BUSCO score to filter proteomes (proteomes selected will have a higher BUSCO score than this threshold)
+        all_proteomes (bool): Option to select all the proteomes (and not only preferentially reference proteomes)
+        uniprot_sparql_endpoint (str): uniprot SPARQL endpoint to query (by default query Uniprot SPARQL endpoint)
+        minimal_number_proteomes (int): minimal number of proteomes required to be associated with a taxon for the taoxn to be kept.
+        batch_size (int): number of taxa of the first query
+        rate_limiter (TokenBucket): token bucket limiting the number of queries sent to the endpoint
+
+    Returns:
+        tax_id_proteomes (dict): taxon ID (key) associated with the proteomes, organism_ids and proteomes_data of the taxon (value, see sparql_query_proteomes)
+        batch_size (int): batch size adapted to the endpoint, to use for the next queries
+    """
+    tax_ids = list(taxa)
+    tax_id_proteomes = {}
+    position = 0
+    # After a failed query, the batch size is not increased again up to the size of the failed query.
+    max_batch_size = PROTEOME_SPARQL_QUERY_MAX_BATCH_SIZE
+    while position < len(tax_ids):
+        batch_tax_ids = tax_ids[position:position+batch_size]
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        query_start = time.time()
+        try:
+            batch_proteomes = sparql_query_proteomes_batch({tax_id: taxa[tax_id] for tax_id in batch_tax_ids}, busco_percentage_keep,
+                                                           all_proteomes, uniprot_sparql_endpoint, minimal_number_proteomes)
+        except Exception as error:
+            if len(batch_tax_ids) == 1:
+                raise
+            batch_size = len(batch_tax_ids) // 2
+            max_batch_size = batch_size
+            logger.warning('|EsMeCaTa|proteomes| SPARQL query on %d taxa failed (%s), esmecata will query them by batches of %d taxa.', len(batch_tax_ids), error, batch_size)
+            continue
+        query_duration = time.time() - query_start
+        tax_id_proteomes.update(batch_proteomes)
+        position += len(batch_tax_ids)
+
+        if query_duration > PROTEOME_SPARQL_QUERY_TIME:
+            batch_size = max(1, len(batch_tax_ids) // 2)
+        elif query_duration < PROTEOME_SPARQL_QUERY_TIME / 2 and len(batch_tax_ids) == batch_size:
+            batch_size = min(max_batch_size, batch_size * 2)
+
+    return tax_id_proteomes, batch_size
+
+
+def parse_sparql_proteomes(observation_name, tax_id, tax_name, csvreader, busco_percentage_keep,
+                           all_proteomes, minimal_number_proteomes=1):
+    """Select the proteomes of a taxon from the lines of the answer of a SPARQL proteome query.
 
-    csvreader = send_uniprot_sparql_query(uniprot_sparql_query, uniprot_sparql_endpoint)
+    Args:
+        observation_name (str): observation name associated with the taxonomic affiliation
+        tax_id (str): taxon ID from a taxon of the taxonomic affiliation
+        tax_name (str): taxon name associated with the tax_id
+        csvreader (list): lines of the answer of the SPARQL query associated with the taxon
+        busco_percentage_keep (float): BUSCO score to filter proteomes (proteomes selected will have a higher BUSCO score than this threshold)
+        all_proteomes (bool): Option to select all the proteomes (and not only preferentially reference proteomes)
+        minimal_number_proteomes (int): minimal number of proteomes required to be associated with a taxon for the taoxn to be kept.
 
+    Returns:
+        proteomes (list): list of proteome IDs associated with the taxon ID
+        organism_ids (dict): organism ID (key) associated with each proteomes (values)
+        proteomes_data (list): list of lists with proteome_id, busco_score, assembly_level, org_tax_id, reference_proteome, component_elements
+    """
     proteomes = []
     proteomes_data = []
     organism_ids = {}
@@ -839,7 +1266,7 @@ def create_taxon_heatmap_from_complete_run(esmecata_proteome_folder):
     with open(json_log, 'r') as input_json_file:
         json_taxonomic_affiliations = json.load(input_json_file)
 
-    ncbi = NCBITaxa()
+    ncbi = get_taxonomy_service()
     # Create heatmap comparing input taxon and taxon used by esmecata to find proteomes.
     taxon_rank_comparison = compare_input_taxon_with_esmecata(json_taxonomic_affiliations, proteomes_ids, ncbi)
     create_taxon_heatmap(taxon_rank_comparison, esmecata_proteome_folder)
@@ -854,37 +1281,52 @@ def subsampling_proteomes(organism_ids, limit_maximal_number_proteomes, ncbi):
     Args:
         organism_ids (dict): organism ID as key and the proteome IDs associated with it as value
         limit_maximal_number_proteomes (int): int threshold after which a subsampling will be performed on the data
-        ncbi (ete3.NCBITaxa()): ete3 NCBI database
+        ncbi (ete3.NCBITaxa()): ete3 NCBI database (or esmecata taxonomy index)
 
     Returns:
         selected_proteomes (list): subsample proteomes selected by the methods
     """
-    try:
-        tree = ncbi.get_topology([org_tax_id for org_tax_id in organism_ids])
-    except KeyError:
-        logger.critical('|EsMeCaTa|proteomes| UniProt tax ID not in ete3 NCBI Taxonomy database. Try to update it with the following command: python3 -c "from ete3 import NCBITaxa; ncbi = NCBITaxa(); ncbi.update_taxonomy_database()".')
-        raise KeyError()
+    # Reconstruct the taxonomic tree of the organisms from their lineages (such as ete3 get_topology but without requiring ete3 tree),
+    # so taxonomy index can be used instead of ete3 NCBITaxa.
+    organism_lineages = {}
+    for org_tax_id in organism_ids:
+        try:
+            organism_lineages[org_tax_id] = ncbi.get_lineage(org_tax_id)
+        except ValueError:
+            logger.critical('|EsMeCaTa|proteomes| UniProt tax ID not in ete3 NCBI Taxonomy database. Try to update it with the following command: python3 -c "from ete3 import NCBITaxa; ncbi = NCBITaxa(); ncbi.update_taxonomy_database()".')
+            raise KeyError()
+        # Use the organism ID instead of the last taxon ID of the lineage (which differs for merged taxon IDs).
+        organism_lineages[org_tax_id][-1] = int(org_tax_id)
+
+    node_childs = {}
+    for lineage in organism_lineages.values():
+        for parent_tax_id, child_tax_id in zip(lineage, lineage[1:]):
+            node_childs.setdefault(parent_tax_id, {})[child_tax_id] = None
+    organism_tax_ids = set(organism_lineages[org_tax_id][-1] for org_tax_id in organism_lineages)
+
+    def collapse_node(tax_id):
+        # Like ete3 get_topology, skip intermediate taxa having only one child and not associated with proteomes.
+        while tax_id not in organism_tax_ids and len(node_childs.get(tax_id, {})) == 1:
+            tax_id = next(iter(node_childs[tax_id]))
+        return tax_id
+
+    # Root of the tree: the lowest common ancestor of the organisms (or the root of the taxonomy if it has several childs).
+    tree_root = 1
+    if len(node_childs.get(tree_root, {})) == 1:
+        tree_root = collapse_node(next(iter(node_childs[tree_root])))
 
     # For each direct descendant taxon of the tree root (our tax_id), we will look for the proteomes inside these subtaxons.
     childs = {}
-    for parent_node in tree.get_children():
-        parent_tax_id = str(parent_node.taxid)
-        if parent_node.get_descendants() != []:
-            for child_node in parent_node.get_descendants():
-                child_tax_id = str(child_node.taxid)
-                if parent_tax_id not in childs:
-                    if child_tax_id in organism_ids:
-                        childs[parent_tax_id] = organism_ids[child_tax_id]
-                else:
-                    if child_tax_id in organism_ids:
-                        childs[parent_tax_id].extend(organism_ids[child_tax_id])
+    for parent_node in node_childs.get(tree_root, {}):
+        parent_node = collapse_node(parent_node)
+        parent_tax_id = str(parent_node)
+        if parent_node in node_childs:
+            for org_tax_id, lineage in organism_lineages.items():
+                if parent_node in lineage[:-1]:
+                    childs.setdefault(parent_tax_id, []).extend(organism_ids[org_tax_id])
         else:
-            if parent_tax_id not in childs:
-                if parent_tax_id in organism_ids:
-                    childs[parent_tax_id] = organism_ids[parent_tax_id]
-            else:
-                if parent_tax_id in organism_ids:
-                    childs[parent_tax_id].extend(organism_ids[parent_tax_id])
+            if parent_tax_id in organism_ids:
+                childs.setdefault(parent_tax_id, []).extend(organism_ids[parent_tax_id])
 
     # For each direct descendant taxon, compute the number of proteomes in their childrens.
     elements = [v for k,v in childs.items()]
@@ -908,11 +1350,74 @@ def subsampling_proteomes(organism_ids, limit_maximal_number_proteomes, ncbi):
     return selected_proteomes
 
 
+def find_subtree_taxa(json_taxonomic_affiliations, ncbi, subtree_rank):
+    """For each observation, find the taxon at subtree_rank in its taxonomic affiliation and the taxa below it (descending from it).
+
+    Args:
+        json_taxonomic_affiliations (dict): observation name and dictionary with mapping between taxon name and taxon ID (with remove rank specified)
+        ncbi (ete3.NCBITaxa()): ete3 NCBI database
+        subtree_rank (str): rank of the taxa whose proteomes are fetched to resolve the proteomes of the taxa below them (such as family)
+
+    Returns:
+        subtree_taxa (dict): observation name (key) associated with the subtree taxon (tax_id, tax_name) and the list of (tax_id, tax_name) of the taxa below it
+    """
+    all_tax_ids = set(taxon_ids[0] for observation_name_taxons in json_taxonomic_affiliations.values()
+                      for taxon_ids in observation_name_taxons.values() if taxon_ids[0] != 'not_found')
+    tax_id_ranks = ncbi.get_rank(list(all_tax_ids))
+
+    subtree_taxa = {}
+    for observation_name, observation_name_taxons in json_taxonomic_affiliations.items():
+        tax_names = list(observation_name_taxons.keys())
+        tax_ids = [observation_name_taxons[tax_name][0] for tax_name in tax_names]
+        subtree_index = None
+        for index in reversed(range(len(tax_ids))):
+            if tax_ids[index] != 'not_found' and tax_id_ranks.get(tax_ids[index]) == subtree_rank:
+                subtree_index = index
+                break
+        if subtree_index is None:
+            continue
+
+        subtree_tax_id = tax_ids[subtree_index]
+        lower_taxa = [(tax_id, tax_name) for tax_id, tax_name in zip(tax_ids[subtree_index+1:], tax_names[subtree_index+1:])
+                      if tax_id != 'not_found' and subtree_tax_id in ncbi.get_lineage(tax_id)]
+        subtree_taxa[observation_name] = ((subtree_tax_id, tax_names[subtree_index]), lower_taxa)
+
+    return subtree_taxa
+
+
+def get_organism_lineages(org_tax_ids, ncbi):
+    """Get the lineage of the organisms associated with proteomes.
+
+    Args:
+        org_tax_ids (iterable): organism taxon IDs
+        ncbi (ete3.NCBITaxa()): ete3 NCBI database
+
+    Returns:
+        organism_lineages (dict): organism taxon ID (str) as key and set of taxon IDs of its lineage as value (empty for taxon IDs missing in the database)
+    """
+    organism_lineages = {}
+    for org_tax_id in org_tax_ids:
+        try:
+            organism_lineages[org_tax_id] = set(ncbi.get_lineage(org_tax_id))
+        except ValueError:
+            logger.info('|EsMeCaTa|proteomes| Organism taxon ID %s is not in ete3 NCBI Taxonomy database, its proteomes can not be associated with lower taxa.', org_tax_id)
+            organism_lineages[org_tax_id] = set()
+    return organism_lineages
+
+
 def find_proteomes_tax_ids(json_taxonomic_affiliations, ncbi, proteomes_description_folder,
                         busco_percentage_keep=None, all_proteomes=None, uniprot_sparql_endpoint=None,
                         limit_maximal_number_proteomes=99, minimal_number_proteomes=1, session=None,
-                        option_bioservices=None):
-    """Find proteomes associated with taxonomic affiliations
+                        option_bioservices=None, nb_workers=PROTEOME_QUERY_WORKERS, query_rate=PROTEOME_QUERY_RATE,
+                        subtree_rank=None, proteome_cache=None, uniprot_release=None):
+    """Find proteomes associated with taxonomic affiliations.
+    The observations are searched in parallel by nb_workers threads, each taxon ID is queried only once (threads needing a taxon ID
+    being queried by another thread wait for its answer) and the queries are limited to query_rate per second with a token bucket.
+    With subtree_rank, the proteomes of the taxa at this rank are fetched first and the proteomes of the taxa below them are
+    resolved locally (with the lineages of the organisms of the proteomes) instead of being queried.
+    With proteome_cache, the answers stored for the UniProt release are used instead of querying UniProt and new answers are stored.
+    With uniprot_sparql_endpoint, the taxa are queried by rounds of the rank-walk (the next taxon of each observation without enough proteomes)
+    with SPARQL batch queries, whose number of taxa is adapted to the response time of the endpoint.
 
     Args:
         json_taxonomic_affiliations (dict): observation name and dictionary with mapping between taxon name and taxon ID (with remove rank specified)
@@ -925,96 +1430,235 @@ def find_proteomes_tax_ids(json_taxonomic_affiliations, ncbi, proteomes_descript
         minimal_number_proteomes (int): minimal number of proteomes required to be associated with a taxon for the taoxn to be kept
         session: request session object
         option_bioservices (bool): use bioservices instead of manual queries.
+        nb_workers (int): number of threads querying UniProt in parallel
+        query_rate (float): maximal number of queries sent to UniProt per second
+        subtree_rank (str): rank of the taxa (such as family) whose proteomes are used to resolve the proteomes of the lower taxa
+        proteome_cache (ProteomeMetadataCache): cache of the answers of the proteome queries
+        uniprot_release (str): UniProt release used as key of the proteome cache
 
     Returns:
         proteomes_ids (dict): observation name (key) associated with proteome IDs
         single_proteomes (dict): observation name (key) associated with proteome ID (when there is only one proteome)
-        tax_id_not_founds (dict): mapping between taxon ID and taxon name for taxon ID without proteomes
+        tax_id_not_founds (dict): mapping between taxon ID and taxon name (in a list) for taxon ID without proteomes reached by the rank-walk of an observation
     """
     # Query the Uniprot proteomes to find all the proteome IDs associated with taxonomic affiliation.
     # If there is more than limit_maximal_number_proteomes proteomes a method is applied to extract a subset of the data.
     logger.info('|EsMeCaTa|proteomes| Find proteome ID associated with taxonomic affiliation')
     proteomes_ids = {}
-    proteome_data = {}
     single_proteomes = {}
     tax_id_not_founds = {}
-    tax_id_without_minimal_proteomes_number = {}
     tax_id_founds = {}
 
-    for observation_name in json_taxonomic_affiliations:
+    rate_limiter = TokenBucket(query_rate)
+    # Answer of the query for each taxon ID (a Future, as the query can be in progress in another thread).
+    tax_id_queries = {}
+    tax_id_queries_lock = threading.Lock()
+
+    # Options modifying the answer of a query, used with the taxon ID and the UniProt release as key of the proteome cache.
+    if uniprot_sparql_endpoint:
+        query_system = uniprot_sparql_endpoint
+    elif option_bioservices is not None:
+        query_system = 'bioservices'
+    else:
+        query_system = 'rest'
+    query_options = {'query_system': query_system, 'busco_percentage_keep': busco_percentage_keep,
+                     'all_proteomes': all_proteomes, 'minimal_number_proteomes': minimal_number_proteomes}
+
+    def get_tax_id_answer(tax_id, tax_name, proteomes, organism_ids, data_proteomes):
+        proteomes_descriptions = [[tax_id, tax_name, *data_proteome] for data_proteome in data_proteomes]
+        return (tax_name, proteomes, organism_ids, proteomes_descriptions)
+
+    def query_tax_id(observation_name, tax_id, tax_name):
+        with tax_id_queries_lock:
+            tax_id_query = tax_id_queries.get(tax_id)
+            query_owner = tax_id_query is None
+            if query_owner:
+                tax_id_query = Future()
+                tax_id_queries[tax_id] = tax_id_query
+        # If tax_id is already (or being) queried by another observation, use its answer without new requests.
+        if not query_owner:
+            return tax_id_query.result()
+
+        try:
+            cached_answer = None
+            if proteome_cache is not None:
+                cached_answer = proteome_cache.get(tax_id, query_options, uniprot_release)
+            if cached_answer is not None:
+                proteomes, organism_ids, data_proteomes = cached_answer
+                # SPARQL queries return a set of proteomes.
+                if uniprot_sparql_endpoint:
+                    proteomes = set(proteomes)
+            else:
+                if uniprot_sparql_endpoint:
+                    rate_limiter.acquire()
+                    proteomes, organism_ids, data_proteomes = sparql_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_keep, all_proteomes, uniprot_sparql_endpoint, minimal_number_proteomes)
+                else:
+                    # Each page of the REST queries uses a token of the rate limiter.
+                    proteomes, organism_ids, data_proteomes = rest_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_keep, all_proteomes, session, option_bioservices,
+                                                                                   minimal_number_proteomes, rate_limiter)
+                if proteome_cache is not None:
+                    proteome_cache.put(tax_id, query_options, uniprot_release, [list(proteomes), organism_ids, data_proteomes])
+            tax_id_answer = get_tax_id_answer(tax_id, tax_name, proteomes, organism_ids, data_proteomes)
+        except BaseException as error:
+            tax_id_query.set_exception(error)
+            raise
+        tax_id_query.set_result(tax_id_answer)
+        return tax_id_answer
+
+    # Query the taxa with SPARQL batch queries (or from the proteome cache) and store their answers.
+    def query_sparql_tax_ids(taxa, batch_size):
+        uncached_taxa = {}
+        for tax_id, (observation_name, tax_name) in taxa.items():
+            cached_answer = None
+            if proteome_cache is not None:
+                cached_answer = proteome_cache.get(tax_id, query_options, uniprot_release)
+            if cached_answer is not None:
+                proteomes, organism_ids, data_proteomes = cached_answer
+                tax_id_query = Future()
+                tax_id_query.set_result(get_tax_id_answer(tax_id, tax_name, set(proteomes), organism_ids, data_proteomes))
+                tax_id_queries[tax_id] = tax_id_query
+            else:
+                uncached_taxa[tax_id] = (observation_name, tax_name)
+
+        tax_id_proteomes, batch_size = sparql_query_proteomes_batches(uncached_taxa, busco_percentage_keep, all_proteomes, uniprot_sparql_endpoint,
+                                                                      minimal_number_proteomes, batch_size, rate_limiter)
+        for tax_id, (proteomes, organism_ids, data_proteomes) in tax_id_proteomes.items():
+            if proteome_cache is not None:
+                proteome_cache.put(tax_id, query_options, uniprot_release, [list(proteomes), organism_ids, data_proteomes])
+            tax_id_query = Future()
+            tax_id_query.set_result(get_tax_id_answer(tax_id, uncached_taxa[tax_id][1], proteomes, organism_ids, data_proteomes))
+            tax_id_queries[tax_id] = tax_id_query
+
+        return batch_size
+
+    # Rank-walk of an observation: from the lowest taxon to the highest, find the first taxon with enough proteomes.
+    # ete3 database can not be used in these threads, the subsampling of proteomes is performed afterward.
+    def find_observation_proteomes(observation_name):
         proteomes_descriptions = []
+        observation_tax_id = None
+        # Taxa of the rank-walk without proteomes.
+        observation_tax_id_not_founds = []
         for tax_name in reversed(json_taxonomic_affiliations[observation_name]):
             tax_id = json_taxonomic_affiliations[observation_name][tax_name][0]
 
-            # If tax_id has already been found use the corresponding proteomes without new requests.
-            if tax_id in tax_id_founds:
-                proteomes_ids[observation_name] = (tax_id, tax_id_founds[tax_id])
-                proteomes_descriptions.append(proteome_data[tax_id])
-                if len(tax_id_founds[tax_id]) == 1:
-                    single_proteomes[observation_name] = (tax_id, tax_id_founds[tax_id])
-                logger.info('|EsMeCaTa|proteomes| "%s" already associated with proteomes, %s will be associated with the taxon "%s" with %d proteomes.', tax_name, observation_name, tax_name, len(tax_id_founds[tax_id]))
-                break
-
-            # If tax_id has not been found with a request do not try a new request with the same tax_id.
-            if tax_id in tax_id_not_founds or tax_id in tax_id_without_minimal_proteomes_number:
-                continue
-
             # If tax_id not found because the tax_name has no tax_id associated avoid it.
             if tax_id == 'not_found':
                 continue
 
-            if uniprot_sparql_endpoint:
-                proteomes, organism_ids, data_proteomes = sparql_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_keep, all_proteomes, uniprot_sparql_endpoint, minimal_number_proteomes)
-            else:
-                proteomes, organism_ids, data_proteomes = rest_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_keep, all_proteomes, session, option_bioservices, minimal_number_proteomes)
-
-            for data_proteome in data_proteomes:
-                proteomes_descriptions.append([tax_id, tax_name, *data_proteome])
-            proteome_data[tax_id] = proteomes_descriptions
+            _, proteomes, _, tax_id_descriptions = query_tax_id(observation_name, tax_id, tax_name)
+            proteomes_descriptions.extend(tax_id_descriptions)
 
             # Answer is empty no corresponding proteomes to the tax_id.
             if len(proteomes) == 0:
-                if tax_id not in tax_id_not_founds:
-                    tax_id_not_founds[tax_id] = [tax_name]
-                else:
-                    tax_id_not_founds[tax_id].append(tax_name)
+                observation_tax_id_not_founds.append((tax_id, tax_name))
                 continue
-
             # Check if the number of proteomes is inferior to the minimal_number_proteomes.
             elif len(proteomes) < minimal_number_proteomes:
                 logger.info('|EsMeCaTa|proteomes| Less than %d proteomes (%d) are associated with the taxa %s associated with %s, esmecata will use a higher taxonomic rank to find proteomes.', minimal_number_proteomes, len(proteomes), tax_name, observation_name)
-                if tax_id not in tax_id_without_minimal_proteomes_number:
-                    tax_id_without_minimal_proteomes_number[tax_id] = [tax_name]
-                else:
-                    tax_id_without_minimal_proteomes_number[tax_id].append(tax_name)
                 continue
-
-            elif len(proteomes) >= minimal_number_proteomes and len(proteomes) <= limit_maximal_number_proteomes:
-                logger.info('|EsMeCaTa|proteomes| %s will be associated with the taxon "%s" with %d proteomes.', observation_name, tax_name, len(proteomes))
-                proteomes_ids[observation_name] = (tax_id, proteomes)
-                tax_id_founds[tax_id] = proteomes
-                if len(proteomes) == 1:
-                    single_proteomes[observation_name] = (tax_id, proteomes)
-                break
-
-            elif len(proteomes) > limit_maximal_number_proteomes:
-                logger.info('|EsMeCaTa|proteomes| More than {0} proteomes ({1}) are associated with the taxa {2} associated with {3}, esmecata will randomly select around {0} proteomes with respect to the taxonomic diversity.'.format(limit_maximal_number_proteomes, len(proteomes), tax_name, observation_name))
-                selected_proteomes = subsampling_proteomes(organism_ids, limit_maximal_number_proteomes, ncbi)
-                proteomes_ids[observation_name] = (tax_id, selected_proteomes)
-                tax_id_founds[tax_id] = selected_proteomes
-                logger.info('|EsMeCaTa|proteomes| %s will be associated with the taxon "%s" with %d proteomes.', observation_name, tax_name, len(selected_proteomes))
+            else:
+                observation_tax_id = tax_id
                 break
 
-            time.sleep(1)
-
         proteomes_description_file = os.path.join(proteomes_description_folder, observation_name+'.tsv')
-
         with open(proteomes_description_file, 'w') as proteome_output:
             csvwriter = csv.writer(proteome_output, delimiter='\t')
             csvwriter.writerow(['tax_id', 'tax_name', 'proteome_id', 'busco_percentage', 'completness', 'org_tax_id', 'reference_proteome', 'components'])
             for proteomes_description in proteomes_descriptions:
                 csvwriter.writerow(proteomes_description)
 
+        return observation_tax_id, observation_tax_id_not_founds
+
+    if subtree_rank is not None:
+        subtree_taxa = find_subtree_taxa(json_taxonomic_affiliations, ncbi, subtree_rank)
+        subtree_tax_ids = {}
+        for observation_name, ((subtree_tax_id, subtree_tax_name), _) in subtree_taxa.items():
+            if subtree_tax_id not in subtree_tax_ids:
+                subtree_tax_ids[subtree_tax_id] = (observation_name, subtree_tax_name)
+        logger.info('|EsMeCaTa|proteomes| Fetch the proteomes of %d taxa at rank %s to resolve the proteomes of their lower taxa.', len(subtree_tax_ids), subtree_rank)
+
+        # Fetch the proteomes of each subtree taxon once.
+        with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+            subtree_searches = {subtree_tax_id: executor.submit(query_tax_id, observation_name, subtree_tax_id, subtree_tax_name)
+                                for subtree_tax_id, (observation_name, subtree_tax_name) in subtree_tax_ids.items()}
+        subtree_descriptions = {subtree_tax_id: subtree_search.result()[3] for subtree_tax_id, subtree_search in subtree_searches.items()}
+        organism_lineages = get_organism_lineages(set(proteomes_description[5] for proteomes_descriptions in subtree_descriptions.values()
+                                                      for proteomes_description in proteomes_descriptions), ncbi)
+
+        # Associate proteomes to the lower taxa with the lineage of their organisms and store them as answers of these taxon IDs.
+        for observation_name, ((subtree_tax_id, _), lower_taxa) in subtree_taxa.items():
+            for tax_id, tax_name in lower_taxa:
+                if tax_id in tax_id_queries:
+                    continue
+                proteomes_descriptions = [[tax_id, tax_name, *proteomes_description[2:]] for proteomes_description in subtree_descriptions[subtree_tax_id]
+                                          if tax_id in organism_lineages[proteomes_description[5]]]
+                proteomes, organism_ids = select_proteomes(observation_name, tax_id, tax_name, [proteomes_description[2:] for proteomes_description in proteomes_descriptions],
+                                                           busco_percentage_keep, all_proteomes, minimal_number_proteomes, uniprot_sparql_endpoint)
+                tax_id_query = Future()
+                tax_id_query.set_result((tax_name, proteomes, organism_ids, proteomes_descriptions))
+                tax_id_queries[tax_id] = tax_id_query
+
+    if uniprot_sparql_endpoint:
+        # Rank-walk of all the observations by rounds: at each round, the next taxa of the observations without enough proteomes
+        # are queried together with SPARQL batch queries. Then find_observation_proteomes uses these answers without new queries.
+        observation_taxa = {observation_name: [(json_taxonomic_affiliations[observation_name][tax_name][0], tax_name)
+                                               for tax_name in reversed(json_taxonomic_affiliations[observation_name])
+                                               if json_taxonomic_affiliations[observation_name][tax_name][0] != 'not_found']
+                            for observation_name in json_taxonomic_affiliations}
+        walk_positions = {observation_name: 0 for observation_name in observation_taxa}
+        batch_size = PROTEOME_SPARQL_QUERY_BATCH_SIZE
+        while len(walk_positions) > 0:
+            round_taxa = {}
+            for observation_name in list(walk_positions):
+                taxa = observation_taxa[observation_name]
+                position = walk_positions[observation_name]
+                # Skip the taxa already answered without enough proteomes.
+                while position < len(taxa) and taxa[position][0] in tax_id_queries:
+                    proteomes = tax_id_queries[taxa[position][0]].result()[1]
+                    if len(proteomes) > 0 and len(proteomes) >= minimal_number_proteomes:
+                        break
+                    position += 1
+                if position == len(taxa) or taxa[position][0] in tax_id_queries:
+                    del walk_positions[observation_name]
+                else:
+                    walk_positions[observation_name] = position
+                    tax_id, tax_name = taxa[position]
+                    if tax_id not in round_taxa:
+                        round_taxa[tax_id] = (observation_name, tax_name)
+            if len(round_taxa) > 0:
+                logger.info('|EsMeCaTa|proteomes| Query the proteomes of %d taxa with SPARQL batch queries.', len(round_taxa))
+                batch_size = query_sparql_tax_ids(round_taxa, batch_size)
+
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        observation_searches = {observation_name: executor.submit(find_observation_proteomes, observation_name)
+                                for observation_name in json_taxonomic_affiliations}
+    # Raise the errors of the threads.
+    observation_tax_ids = {}
+    for observation_name, observation_search in observation_searches.items():
+        observation_tax_ids[observation_name], observation_tax_id_not_founds = observation_search.result()
+        # As before the parallel rank-walks, a taxon ID without proteomes is associated with the taxon name of the first observation reaching it.
+        for tax_id, tax_name in observation_tax_id_not_founds:
+            if tax_id not in tax_id_not_founds:
+                tax_id_not_founds[tax_id] = [tax_name]
+
+    for observation_name, tax_id in observation_tax_ids.items():
+        if tax_id is None:
+            continue
+        tax_name, proteomes, organism_ids, _ = tax_id_queries[tax_id].result()
+
+        # If tax_id has already been selected for another observation use the same proteomes.
+        if tax_id not in tax_id_founds:
+            if len(proteomes) > limit_maximal_number_proteomes:
+                logger.info('|EsMeCaTa|proteomes| More than {0} proteomes ({1}) are associated with the taxa {2} associated with {3}, esmecata will randomly select around {0} proteomes with respect to the taxonomic diversity.'.format(limit_maximal_number_proteomes, len(proteomes), tax_name, observation_name))
+                tax_id_founds[tax_id] = subsampling_proteomes(organism_ids, limit_maximal_number_proteomes, ncbi)
+            else:
+                tax_id_founds[tax_id] = proteomes
+
+        logger.info('|EsMeCaTa|proteomes| %s will be associated with the taxon "%s" with %d proteomes.', observation_name, tax_name, len(tax_id_founds[tax_id]))
+        proteomes_ids[observation_name] = (tax_id, tax_id_founds[tax_id])
+        if len(proteomes) == 1:
+            single_proteomes[observation_name] = (tax_id, tax_id_founds[tax_id])
+
     return proteomes_ids, single_proteomes, tax_id_not_founds
 
 
@@ -1025,7 +1669,25 @@ def sparql_get_protein_seq(proteome, output_proteome_file, uniprot_sparql_endpoi
         proteome (str): proteome ID
         output_proteome_file (str): pathname to the proteome fasta file
         uniprot_sparql_endpoint (str): uniprot SPARQL endpoint to query (by default query Uniprot SPARQL endpoint)
+
+    Returns:
+        nb_records (int): number of protein sequences written in the proteome fasta file
+    """
+    return sparql_get_protein_seqs({proteome: output_proteome_file}, uniprot_sparql_endpoint)[proteome]
+
+
+def sparql_get_protein_seqs(output_proteome_files, uniprot_sparql_endpoint='https://sparql.uniprot.org/sparql'):
+    """ Single SPARQL query to find the protein sequences associated with several proteomes.
+    The answer is read line by line and each protein sequence is written directly in the gzipped fasta file of its proteome.
+
+    Args:
+        output_proteome_files (dict): proteome ID (key) associated with the pathname to its gzipped fasta file (value)
+        uniprot_sparql_endpoint (str): uniprot SPARQL endpoint to query (by default query Uniprot SPARQL endpoint)
+
+    Returns:
+        nb_records (dict): proteome ID (key) associated with the number of protein sequences written in its fasta file (value)
     """
+    proteome_values = ' '.join(['(proteome:{0})'.format(proteome) for proteome in output_proteome_files])
     # Implementation of the rdf:type up:Simple_Sequence to check for canonical sequence?
     # But is the rdf:type up:Simple_Sequence really associated with canonical sequence?
     uniprot_sparql_query = """PREFIX up: <http://purl.uniprot.org/core/>
@@ -1033,7 +1695,7 @@ def sparql_get_protein_seq(proteome, output_proteome_file, uniprot_sparql_endpoi
     PREFIX proteome: <http://purl.uniprot.org/proteomes/>
     PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
 
-    SELECT ?protein ?name ?isoform ?sequenceaa ?review
+    SELECT ?proteome ?protein ?name ?isoform ?sequenceaa ?review
 
     WHERE
     {{
@@ -1044,39 +1706,338 @@ def sparql_get_protein_seq(proteome, output_proteome_file, uniprot_sparql_endpoi
         ?proteome skos:narrower ?genomicComponent .
         ?protein up:sequence ?isoform .
         ?isoform rdf:value ?sequenceaa .
-        VALUES (?proteome) {{ (proteome:{0}) }}
-    }}""".format(proteome)
+        VALUES (?proteome) {{ {0} }}
+    }}""".format(proteome_values)
 
-    csvreader = send_uniprot_sparql_query(uniprot_sparql_query, uniprot_sparql_endpoint)
+    nb_records = {proteome: 0 for proteome in output_proteome_files}
+    output_files = {}
+    try:
+        for proteome, output_proteome_file in output_proteome_files.items():
+            output_files[proteome] = gzip.open(output_proteome_file, 'wt')
+
+        for line in stream_uniprot_sparql_query(uniprot_sparql_query, uniprot_sparql_endpoint):
+            proteome = line[0].split('/')[-1]
+            protein_id = line[1].split('/')[-1]
+            protein_name = line[2]
+            protein_isoform = line[3].split('/')[-1]
+            protein_seq = line[4]
+            prot_review = line[5].split('^^')[0]
+            # Check protein review.
+            # If review == Swissprot else Trembl.
+            if prot_review == 'true' or prot_review == '1':
+                prefix_record = 'sp'
+            elif prot_review == 'false' or prot_review == '0':
+                prefix_record = 'tr'
+
+            # Take only the canonical sequences (ending with -1):
+            if protein_isoform.endswith('-1'):
+                record_id = f'{prefix_record}|{protein_id}|{protein_name}'
+                # Sequence lines of 60 characters, as written by Bio.SeqIO.
+                sequence_lines = ''.join([protein_seq[index:index+60] + '\n' for index in range(0, len(protein_seq), 60)])
+                output_files[proteome].write(f'>{record_id}\n{sequence_lines}')
+                nb_records[proteome] += 1
+    finally:
+        for output_file in output_files.values():
+            output_file.close()
+
+    return nb_records
+
+
+def sparql_count_protein_seqs(proteomes, uniprot_sparql_endpoint='https://sparql.uniprot.org/sparql'):
+    """ SPARQL query counting the canonical protein sequences of several proteomes.
+    It is sent independently of the query downloading the sequences, so a download truncated between two sequences is detected.
 
-    records = []
-    already_added_proteins = []
-    for line in csvreader:
-        protein_id = line[0].split('/')[-1]
-        protein_name = line[1]
-        protein_isoform = line[2].split('/')[-1]
-        protein_seq = line[3]
-        prot_review = line[4].split('^^')[0]
-        # Check protein review.
-        # If review == Swissprot else Trembl.
-        if prot_review == 'true' or prot_review == '1':
-            prefix_record = 'sp'
-        elif prot_review == 'false' or prot_review == '0':
-            prefix_record = 'tr'
-
-        # Take only the canonical sequences (ending with -1):
-        if protein_isoform.endswith('-1'):
-            record_id = f'{prefix_record}|{protein_id}|{protein_name}'
-            records.append(SeqRecord(Seq(protein_seq), id=record_id, description=''))
-            already_added_proteins.append(protein_id)
-
-    intermediary_file = output_proteome_file[:-3]
-    SeqIO.write(records, intermediary_file, 'fasta')
-
-    with open(intermediary_file, 'rb') as input_file:
-        with gzip.open(output_proteome_file, 'wb') as output_file:
-            shutil.copyfileobj(input_file, output_file)
-    os.remove(intermediary_file)
+    Args:
+        proteomes (list): proteome IDs
+        uniprot_sparql_endpoint (str): uniprot SPARQL endpoint to query (by default query Uniprot SPARQL endpoint)
+
+    Returns:
+        nb_protein_seqs (dict): proteome ID (key) associated with its number of canonical protein sequences (value)
+    """
+    proteome_values = ' '.join(['(proteome:{0})'.format(proteome) for proteome in proteomes])
+    # Same patterns as the query of sparql_get_protein_seqs, with the canonical sequences (ending with -1) selected by a filter.
+    uniprot_sparql_query = """PREFIX up: <http://purl.uniprot.org/core/>
+    PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+    PREFIX proteome: <http://purl.uniprot.org/proteomes/>
+    PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+
+    SELECT ?proteome (COUNT(?isoform) AS ?nb_isoforms)
+
+    WHERE
+    {{
+        ?protein a up:Protein ;
+                up:mnemonic ?name ;
+                up:reviewed ?review ;
+                up:proteome ?genomicComponent .
+        ?proteome skos:narrower ?genomicComponent .
+        ?protein up:sequence ?isoform .
+        ?isoform rdf:value ?sequenceaa .
+        FILTER(STRENDS(STR(?isoform), "-1"))
+        VALUES (?proteome) {{ {0} }}
+    }}
+    GROUP BY ?proteome""".format(proteome_values)
+
+    nb_protein_seqs = {proteome: 0 for proteome in proteomes}
+    for line in stream_uniprot_sparql_query(uniprot_sparql_query, uniprot_sparql_endpoint):
+        nb_protein_seqs[line[0].split('/')[-1]] = int(line[1].split('^^')[0])
+
+    return nb_protein_seqs
+
+
+def check_proteome_file(proteome_file, expected_nb_records=None):
+    """ Read a gzipped proteome fasta file to check its integrity and get the accessions of its protein sequences.
+
+    Args:
+        proteome_file (str): pathname to the gzipped proteome fasta file
+        expected_nb_records (int): number of protein sequences expected in the file (not checked if None)
+
+    Returns:
+        accessions (list): accessions of the protein sequences in the file
+    """
+    # Reading the whole file checks the CRC and the size stored at the end of the gzip file.
+    accessions = scan_fasta_accessions(proteome_file)
+
+    if expected_nb_records is not None and len(accessions) != expected_nb_records:
+        raise ValueError('{0} protein sequences found in {1} instead of {2}.'.format(len(accessions), proteome_file, expected_nb_records))
+
+    return accessions
+
+
+def rest_download_proteome(http_str, partial_proteome_file, session, download_statistics=None):
+    """ Stream a proteome from UniProt REST API into a partial file, resuming a previous partial download with a HTTP Range request.
+    A download is resumed only if the server answered with a validator (ETag or Last-Modified) used in the If-Range header,
+    so the server sends the whole proteome again if it has changed or does not support Range requests.
+    If the range is not satisfiable (HTTP 416), the partial file is removed and the proteome is downloaded again.
+
+    Args:
+        http_str (str): http address of the proteome
+        partial_proteome_file (str): pathname to the partial proteome file (kept between attempts and runs)
+        session: request session object
+        download_statistics (dict): counts of resumed downloads, resumed bytes and re-downloaded bytes updated by the function
+
+    Returns:
+        expected_nb_records (int): number of protein sequences given by UniProt (None if not given)
+    """
+    validator_file = partial_proteome_file + '.json'
+    partial_size = 0
+    headers = {}
+    if os.path.exists(partial_proteome_file):
+        partial_size = os.path.getsize(partial_proteome_file)
+        if partial_size > 0 and os.path.exists(validator_file):
+            with open(validator_file, 'r') as input_json_file:
+                partial_download = json.load(input_json_file)
+            if partial_download['url'] == http_str:
+                headers['Range'] = 'bytes={0}-'.format(partial_size)
+                headers['If-Range'] = partial_download['validator']
+
+    proteome_response = session.get(http_str, headers=headers, stream=True, timeout=600)
+    if 'Range' in headers and proteome_response.status_code == 416:
+        # The partial file is not smaller than the proteome (download interrupted before its check or proteome modified),
+        # so it can not be resumed and the proteome is downloaded again from the start.
+        proteome_response.close()
+        logger.info('|EsMeCaTa|proteomes| Range not satisfiable for the partial download %s (%d bytes), download it again.', partial_proteome_file, partial_size)
+        os.remove(partial_proteome_file)
+        os.remove(validator_file)
+        if download_statistics is not None:
+            with download_statistics['lock']:
+                download_statistics['redownloaded_bytes'] += partial_size
+        return rest_download_proteome(http_str, partial_proteome_file, session, download_statistics)
+
+    with proteome_response:
+        proteome_response.raise_for_status()
+        resume_download = 'Range' in headers and proteome_response.status_code == 206
+        if resume_download and not proteome_response.headers.get('Content-Range', '').startswith('bytes {0}-'.format(partial_size)):
+            os.remove(partial_proteome_file)
+            raise ValueError('Content-Range "{0}" does not start at the end of the partial download ({1} bytes).'.format(proteome_response.headers.get('Content-Range'), partial_size))
+
+        if resume_download:
+            file_mode = 'ab'
+            statistic_updates = {'resumed_downloads': 1, 'resumed_bytes': partial_size}
+        else:
+            file_mode = 'wb'
+            statistic_updates = {'redownloaded_bytes': partial_size}
+            validator = proteome_response.headers.get('ETag', proteome_response.headers.get('Last-Modified'))
+            if validator is not None:
+                with open(validator_file, 'w') as output_json_file:
+                    json.dump({'url': http_str, 'validator': validator}, output_json_file)
+            elif os.path.exists(validator_file):
+                os.remove(validator_file)
+        if download_statistics is not None:
+            with download_statistics['lock']:
+                for statistic_name, statistic_value in statistic_updates.items():
+                    download_statistics[statistic_name] += statistic_value
+
+        expected_nb_records = None
+        if 'X-Total-Results' in proteome_response.headers:
+            expected_nb_records = int(proteome_response.headers['X-Total-Results'])
+        with open(partial_proteome_file, file_mode) as f:
+            for chunk in proteome_response.iter_content(chunk_size=PROTEOME_DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+    return expected_nb_records
+
+
+def download_proteome(proteome, output_proteome_file, session, uniprot_sparql_endpoint=None, option_bioservices=None, download_statistics=None):
+    """ Download the protein sequences of a proteome with REST queries, bioservices or SPARQL queries.
+
+    Args:
+        proteome (str): proteome ID
+        output_proteome_file (str): pathname to the proteome fasta file
+        session: request session object
+        uniprot_sparql_endpoint (str): uniprot SPARQL endpoint to query (by default query Uniprot SPARQL endpoint)
+        option_bioservices (bool): use bioservices instead of manual queries.
+        download_statistics (dict): counts of resumed downloads, resumed bytes and re-downloaded bytes of REST downloads
+    """
+    proteome_folder = os.path.dirname(output_proteome_file)
+    if uniprot_sparql_endpoint is not None:
+        sparql_download_proteomes([proteome], proteome_folder, uniprot_sparql_endpoint)
+        return
+
+    # Write the proteome in a temporary file and rename it once checked, so an interrupted download never leaves an incomplete proteome file.
+    # For REST queries, the temporary file is kept after a failure to resume the download.
+    if option_bioservices is None:
+        tmp_proteome_file = os.path.join(proteome_folder, '.'+proteome+PROTEOME_PARTIAL_SUFFIX)
+        keep_tmp_file = True
+    else:
+        file_descriptor, tmp_proteome_file = tempfile.mkstemp(prefix='.'+proteome+'_', suffix=PROTEOME_TMP_SUFFIX, dir=proteome_folder)
+        os.close(file_descriptor)
+        keep_tmp_file = False
+
+    try:
+        expected_nb_records = None
+        if option_bioservices is None:
+            http_str = 'https://rest.uniprot.org/uniprotkb/stream?query=proteome:{0}&format=fasta&compressed=true'.format(proteome)
+            expected_nb_records = rest_download_proteome(http_str, tmp_proteome_file, session, download_statistics)
+        else:
+            import bioservices
+            uniprot_bioservices = bioservices.UniProt()
+            data_fasta = uniprot_bioservices.search(f'(proteome:{proteome})', database='uniprot',
+                                                    frmt='fasta', compress=True, progress=False)
+            with open(tmp_proteome_file, 'wb') as f:
+                f.write(data_fasta)
+
+        try:
+            accessions = check_proteome_file(tmp_proteome_file, expected_nb_records)
+        except (OSError, EOFError, ValueError, IndexError):
+            # A complete but invalid download can not be resumed.
+            keep_tmp_file = False
+            raise
+        os.replace(tmp_proteome_file, output_proteome_file)
+        # List the protein accessions next to the proteome, so they are read without decompressing the proteome.
+        write_proteome_accessions(get_proteome_accessions_file(output_proteome_file), accessions)
+    finally:
+        if not keep_tmp_file and os.path.exists(tmp_proteome_file):
+            os.remove(tmp_proteome_file)
+        if not os.path.exists(tmp_proteome_file) and os.path.exists(tmp_proteome_file + '.json'):
+            os.remove(tmp_proteome_file + '.json')
+
+
+def sparql_download_proteomes(proteomes, proteomes_folder, uniprot_sparql_endpoint='https://sparql.uniprot.org/sparql'):
+    """ Download the protein sequences of several proteomes with a single SPARQL query.
+    Proteomes are written in temporary files renamed once they are all checked against the number of sequences given by a counting query.
+
+    Args:
+        proteomes (list): proteome IDs
+        proteomes_folder (str): pathname to the folder containing the proteome fasta files
+        uniprot_sparql_endpoint (str): uniprot SPARQL endpoint to query (by default query Uniprot SPARQL endpoint)
+    """
+    tmp_proteome_files = {}
+    try:
+        for proteome in proteomes:
+            file_descriptor, tmp_proteome_files[proteome] = tempfile.mkstemp(prefix='.'+proteome+'_', suffix=PROTEOME_TMP_SUFFIX, dir=proteomes_folder)
+            os.close(file_descriptor)
+
+        expected_nb_records = sparql_count_protein_seqs(proteomes, uniprot_sparql_endpoint)
+        sparql_get_protein_seqs(tmp_proteome_files, uniprot_sparql_endpoint)
+
+        proteome_accessions = {}
+        for proteome, tmp_proteome_file in tmp_proteome_files.items():
+            proteome_accessions[proteome] = check_proteome_file(tmp_proteome_file, expected_nb_records[proteome])
+        for proteome, tmp_proteome_file in tmp_proteome_files.items():
+            output_proteome_file = os.path.join(proteomes_folder, proteome+'.faa.gz')
+            os.replace(tmp_proteome_file, output_proteome_file)
+            write_proteome_accessions(get_proteome_accessions_file(output_proteome_file), proteome_accessions[proteome])
+    finally:
+        for tmp_proteome_file in tmp_proteome_files.values():
+            if os.path.exists(tmp_proteome_file):
+                os.remove(tmp_proteome_file)
+
+
+def download_proteomes(proteome_to_download, proteomes_folder, session=None, uniprot_sparql_endpoint=None, option_bioservices=None,
+                       nb_workers=PROTEOME_DOWNLOAD_WORKERS, download_rate=PROTEOME_DOWNLOAD_RATE, nb_attempts=PROTEOME_DOWNLOAD_ATTEMPTS):
+    """ Download proteomes in parallel with nb_workers threads sharing a pool of connections.
+    The downloads started are limited to download_rate per second with a token bucket and each proteome is downloaded at most nb_attempts times.
+    With SPARQL queries, the proteomes are downloaded by batches of PROTEOME_SPARQL_BATCH_SIZE proteomes.
+
+    Args:
+        proteome_to_download (set): proteome IDs to download
+        proteomes_folder (str): pathname to the folder containing the proteome fasta files
+        session: request session object
+        uniprot_sparql_endpoint (str): uniprot SPARQL endpoint to query (by default query Uniprot SPARQL endpoint)
+        option_bioservices (bool): use bioservices instead of manual queries.
+        nb_workers (int): number of threads downloading proteomes in parallel
+        download_rate (float): maximal number of downloads started per second
+        nb_attempts (int): number of attempts to download a proteome
+
+    Returns:
+        failed_proteomes (list): proteome IDs that could not be downloaded
+        download_statistics (dict): number of resumed downloads, number of bytes not downloaded again thanks to resumed downloads and number of bytes downloaded again after an interruption
+    """
+    # Keep enough connections in the pool for all the threads.
+    retries = Retry(total=5, backoff_factor=0.25, status_forcelist=[429, 500, 502, 503, 504])
+    if session is None:
+        session = requests.Session()
+    session.mount('https://', HTTPAdapter(max_retries=retries, pool_connections=nb_workers, pool_maxsize=nb_workers))
+
+    rate_limiter = TokenBucket(download_rate)
+    download_statistics = {'resumed_downloads': 0, 'resumed_bytes': 0, 'redownloaded_bytes': 0, 'lock': threading.Lock()}
+
+    # Remove the temporary files left by interrupted runs, partial downloads are kept only for the proteomes to download.
+    partial_proteome_files = set('.'+proteome+PROTEOME_PARTIAL_SUFFIX for proteome in proteome_to_download)
+    partial_proteome_files.update([partial_proteome_file + '.json' for partial_proteome_file in partial_proteome_files])
+    for proteome_filename in os.listdir(proteomes_folder):
+        if proteome_filename.startswith('.') and proteome_filename not in partial_proteome_files:
+            if proteome_filename.endswith((PROTEOME_TMP_SUFFIX, PROTEOME_PARTIAL_SUFFIX, PROTEOME_PARTIAL_SUFFIX + '.json')):
+                os.remove(os.path.join(proteomes_folder, proteome_filename))
+
+    def download_with_attempts(proteome_batch):
+        for attempt in range(1, nb_attempts+1):
+            rate_limiter.acquire()
+            try:
+                if uniprot_sparql_endpoint is not None:
+                    sparql_download_proteomes(proteome_batch, proteomes_folder, uniprot_sparql_endpoint)
+                else:
+                    output_proteome_file = os.path.join(proteomes_folder, proteome_batch[0]+'.faa.gz')
+                    download_proteome(proteome_batch[0], output_proteome_file, session, uniprot_sparql_endpoint, option_bioservices, download_statistics)
+                return True
+            except Exception as error:
+                logger.warning('|EsMeCaTa|proteomes| Attempt %d on %d to download %s failed: %s', attempt, nb_attempts, ', '.join(proteome_batch), error)
+                if attempt < nb_attempts:
+                    time.sleep(2**attempt)
+        return False
+
+    sorted_proteomes = sorted(proteome_to_download)
+    batch_size = PROTEOME_SPARQL_BATCH_SIZE if uniprot_sparql_endpoint is not None else 1
+    proteome_batches = [sorted_proteomes[index:index+batch_size] for index in range(0, len(sorted_proteomes), batch_size)]
+
+    failed_proteomes = []
+    nb_downloaded_proteomes = 0
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        proteome_downloads = {executor.submit(download_with_attempts, proteome_batch): proteome_batch for proteome_batch in proteome_batches}
+        for proteome_download in as_completed(proteome_downloads):
+            proteome_batch = proteome_downloads[proteome_download]
+            if proteome_download.result() is False:
+                failed_proteomes.extend(proteome_batch)
+            else:
+                nb_downloaded_proteomes += len(proteome_batch)
+            logger.info('|EsMeCaTa|proteomes| Downloaded %d on %d proteomes', nb_downloaded_proteomes, len(proteome_to_download))
+
+    del download_statistics['lock']
+    if download_statistics['resumed_downloads'] > 0 or download_statistics['redownloaded_bytes'] > 0:
+        logger.info('|EsMeCaTa|proteomes| %d downloads resumed (%d bytes not downloaded again), %d bytes downloaded again after interruptions.',
+                    download_statistics['resumed_downloads'], download_statistics['resumed_bytes'], download_statistics['redownloaded_bytes'])
+
+    return failed_proteomes, download_statistics
 
 
 def compute_stat_proteomes(proteomes_folder, stat_file=None):
@@ -1089,7 +2050,7 @@ def compute_stat_proteomes(proteomes_folder, stat_file=None):
     Returns:
         proteome_numbers (dict): dict containing observation names (as key) associated with the number of proteomes
     """
-    ncbi = NCBITaxa()
+    ncbi = get_taxonomy_service()
     proteome_numbers = {}
 
     json_log = os.path.join(proteomes_folder, 'association_taxon_taxID.json')
@@ -1149,7 +2110,7 @@ def create_comp_taxonomy_file(association_taxon_id_json, proteomes_ids, tax_id_n
         tax_id_names (dict): associate tax id to tax name
         output_dir (str): pathname to the output folder
     """
-    ncbi = NCBITaxa()
+    ncbi = get_taxonomy_service()
 
     d_tax = dict()
     for observation_name in proteomes_ids:
@@ -1185,7 +2146,8 @@ def create_comp_taxonomy_file(association_taxon_id_json, proteomes_ids, tax_id_n
 def check_proteomes(input_file, output_folder, busco_percentage_keep=80,
                         ignore_taxadb_update=None, all_proteomes=None, uniprot_sparql_endpoint=None,
                         limit_maximal_number_proteomes=99, rank_limit=None, minimal_number_proteomes=1,
-                        update_affiliations=None, option_bioservices=None):
+                        update_affiliations=None, option_bioservices=None, subtree_rank=None, proteome_cache_file=None,
+                        proteome_store_folder=None, cost_plan=None):
     """From a tsv file with taxonomic affiliations check the associated proteomes for the taxa.
 
     Args:
@@ -1200,6 +2162,10 @@ def check_proteomes(input_file, output_folder, busco_percentage_keep=80,
         minimal_number_proteomes (int): minimal number of proteomes required to be associated with a taxon for the taxon to be kept.
         update_affiliations (str): option to update taxonomic affiliations.
         option_bioservices (bool): use bioservices instead of manual queries.
+        subtree_rank (str): fetch the proteomes of the taxa at this rank (such as family) once and resolve the proteomes of their lower taxa locally.
+        proteome_cache_file (str): pathname to a SQLite file storing the answers of the proteome queries between runs.
+        proteome_store_folder (str): pathname to a folder storing the proteomes shared between runs (proteomes in it are not counted in the cost plan download).
+        cost_plan (bool): estimate the cost of the download, clustering and annotation steps and write it in esmecata_cost_plan.json.
     """
     check_starttime = time.time()
 
@@ -1215,6 +2181,10 @@ def check_proteomes(input_file, output_folder, busco_percentage_keep=80,
 
     ete3_database_update(ignore_taxadb_update)
 
+    if subtree_rank is not None and subtree_rank not in RANK_LEVEL:
+        logger.critical('|EsMeCaTa|proteomes| Error subtree_rank (%s) is not a known taxonomic rank (%s).', subtree_rank, ', '.join(RANK_LEVEL))
+        sys.exit()
+
     if minimal_number_proteomes >= limit_maximal_number_proteomes:
         logger.critical('|EsMeCaTa|proteomes| Error minimal_number_proteomes (%d) can not be superior or equal to limit_maximal_number_proteomes (%d).', minimal_number_proteomes, limit_maximal_number_proteomes)
         sys.exit()
@@ -1247,32 +2217,61 @@ def check_proteomes(input_file, output_folder, busco_percentage_keep=80,
     # taxonomic_affiliation is the column containing the taxonomic affiliation separated by ';': phylum;class;order;family;genus;genus + species
     taxonomies = df.to_dict()['taxonomic_affiliation']
 
+    # Observation names with the same affiliation are searched once, using a representative observation name.
+    unique_taxonomies, observation_representatives = group_identical_affiliations(taxonomies)
+    logger.info('|EsMeCaTa|proteomes| %d observation names associated with %d unique taxonomic affiliations.', len(observation_representatives), len(unique_taxonomies))
+
     proteome_tax_id_file = os.path.join(output_folder, 'proteome_tax_id.tsv')
 
     if not os.path.exists(proteome_tax_id_file):
-        ncbi = NCBITaxa()
+        ncbi = get_taxonomy_service()
 
-        tax_id_names, json_taxonomic_affiliations = associate_taxon_to_taxon_id(taxonomies, update_affiliations, ncbi, output_folder)
+        tax_id_names, unique_json_taxonomic_affiliations = associate_taxon_to_taxon_id(unique_taxonomies, update_affiliations, ncbi, output_folder, observation_representatives)
 
-        json_taxonomic_affiliations = disambiguate_taxon(json_taxonomic_affiliations, ncbi)
+        unique_json_taxonomic_affiliations = disambiguate_taxon(unique_json_taxonomic_affiliations, ncbi)
 
         if rank_limit:
-            json_taxonomic_affiliations = filter_rank_limit(json_taxonomic_affiliations, ncbi, rank_limit)
+            unique_json_taxonomic_affiliations = filter_rank_limit(unique_json_taxonomic_affiliations, ncbi, rank_limit)
+
+        json_taxonomic_affiliations = expand_to_observations(unique_json_taxonomic_affiliations, observation_representatives)
 
         json_log = os.path.join(output_folder, 'association_taxon_taxID.json')
         with open(json_log, 'w') as ouput_file:
             json.dump(json_taxonomic_affiliations, ouput_file, indent=4)
 
+    proteome_cache = None
     if not os.path.exists(proteome_tax_id_file):
-        proteomes_ids, single_proteomes, tax_id_not_founds = find_proteomes_tax_ids(json_taxonomic_affiliations, ncbi, proteomes_description_folder,
+        uniprot_release = None
+        if proteome_cache_file is not None:
+            proteome_cache = ProteomeMetadataCache(proteome_cache_file)
+            # The UniProt release is stored in the cache to avoid querying UniProt when all the answers are in the cache.
+            query_system = uniprot_sparql_endpoint if uniprot_sparql_endpoint else 'rest'
+            uniprot_release = proteome_cache.get_uniprot_release(query_system, lambda: get_uniprot_release_number(uniprot_sparql_endpoint))
+            logger.info('|EsMeCaTa|proteomes| Use proteome cache %s for UniProt release %s.', proteome_cache_file, uniprot_release)
+
+        unique_proteomes_ids, unique_single_proteomes, tax_id_not_founds = find_proteomes_tax_ids(unique_json_taxonomic_affiliations, ncbi, proteomes_description_folder,
                                                         busco_percentage_keep, all_proteomes, uniprot_sparql_endpoint,
-                                                        limit_maximal_number_proteomes, minimal_number_proteomes, session, option_bioservices)
+                                                        limit_maximal_number_proteomes, minimal_number_proteomes, session, option_bioservices,
+                                                        subtree_rank=subtree_rank, proteome_cache=proteome_cache, uniprot_release=uniprot_release)
+
+        proteomes_ids = expand_to_observations(unique_proteomes_ids, observation_representatives)
+        single_proteomes = expand_to_observations(unique_single_proteomes, observation_representatives)
+
+        # Proteome description files have been created for the representative observation names, copy them for the other observation names.
+        for observation_name, representative in observation_representatives.items():
+            if observation_name != representative:
+                representative_description_file = os.path.join(proteomes_description_folder, representative+'.tsv')
+                if os.path.exists(representative_description_file):
+                    shutil.copyfile(representative_description_file, os.path.join(proteomes_description_folder, observation_name+'.tsv'))
 
         proteome_to_download = []
-        for proteomes_id in proteomes_ids:
-            proteome_to_download.extend(proteomes_ids[proteomes_id][1])
+        for proteomes_id in unique_proteomes_ids:
+            proteome_to_download.extend(unique_proteomes_ids[proteomes_id][1])
         proteome_to_download = set(proteome_to_download)
 
+        # Query the rank of all the selected taxon IDs at once.
+        tax_id_ranks = ncbi.get_rank([int(unique_proteomes_ids[observation_name][0]) for observation_name in unique_proteomes_ids])
+
         # Write for each taxon the corresponding tax ID, the name of the taxon and the proteome associated with them.
         with open(proteome_tax_id_file, 'w') as out_file:
             csvwriter = csv.writer(out_file, delimiter='\t')
@@ -1280,7 +2279,7 @@ def check_proteomes(input_file, output_folder, busco_percentage_keep=80,
             for observation_name in proteomes_ids:
                 tax_id = int(proteomes_ids[observation_name][0])
                 tax_name = tax_id_names[tax_id]
-                tax_rank = ncbi.get_rank([tax_id])[tax_id]
+                tax_rank = tax_id_ranks[tax_id]
                 csvwriter.writerow([observation_name, tax_name, tax_id, tax_rank, ','.join(proteomes_ids[observation_name][1])])
 
         create_comp_taxonomy_file(association_taxon_id_json=json_taxonomic_affiliations,
@@ -1313,6 +2312,25 @@ def check_proteomes(input_file, output_folder, busco_percentage_keep=80,
     # Create heatmap comparing input taxon and taxon used by esmecata to find proteomes.
     create_taxon_heatmap_from_complete_run(output_folder)
 
+    if cost_plan:
+        proteome_store = None
+        store_release = None
+        if proteome_store_folder is not None:
+            proteome_store = ProteomeStore(proteome_store_folder)
+            store_release = get_uniprot_release_number(uniprot_sparql_endpoint)
+        all_proteomes_ids = set([proteome for _, proteomes in proteomes_ids.values() for proteome in proteomes])
+        proteome_protein_counts = get_proteome_protein_counts(all_proteomes_ids, session)
+        create_cost_plan(proteome_tax_id_file, proteome_protein_counts, proteomes_folder, os.path.join(output_folder, COST_PLAN_FILENAME),
+                         uniprot_sparql_endpoint, proteome_store, store_release)
+        if proteome_store is not None:
+            proteome_store.close()
+
+    log_taxonomy_cache_statistics('proteomes')
+    if proteome_cache is not None:
+        proteome_cache_statistics = proteome_cache.cache_statistics()
+        logger.info('|EsMeCaTa|proteomes| Proteome cache: %d hits, %d misses.', proteome_cache_statistics['hits'], proteome_cache_statistics['misses'])
+        proteome_cache.close()
+
     check_endtime = time.time()
     check_duration = check_endtime - check_starttime
     logger.info('|EsMeCaTa|proteomes| Check step complete in {0}s.'.format(check_duration))
@@ -1320,10 +2338,133 @@ def check_proteomes(input_file, output_folder, busco_percentage_keep=80,
     return proteome_to_download, session
 
 
+def get_proteome_protein_counts(proteomes, session):
+    """Get the number of proteins of proteomes with REST queries on UniProt Proteomes (only the protein_count field is requested).
+    If a query fails, the proteomes of this query have no protein count (listed as proteomes_without_protein_count in the cost plan).
+
+    Args:
+        proteomes (list): list of proteome IDs
+        session (requests Session object): session used to query UniProt
+
+    Returns:
+        proteome_protein_counts (dict): proteome ID (key) associated with its number of proteins (value)
+    """
+    proteome_protein_counts = {}
+    proteomes = sorted(proteomes)
+    for position in range(0, len(proteomes), PROTEOME_COUNT_BATCH_SIZE):
+        proteome_query = 'OR'.join(['(upid%3A{0})'.format(proteome) for proteome in proteomes[position:position+PROTEOME_COUNT_BATCH_SIZE]])
+        httpt_str = 'https://rest.uniprot.org/proteomes/stream?query={0}&fields=upid,protein_count&format=tsv'.format(proteome_query)
+        try:
+            for batch_reponse in get_batch(session, httpt_str):
+                csvreader = csv.reader(batch_reponse.text.splitlines(), delimiter='\t')
+                # Avoid header.
+                next(csvreader, None)
+                for line in csvreader:
+                    proteome_protein_counts[line[0]] = int(line[1])
+        except requests.exceptions.RequestException as error:
+            logger.warning('|EsMeCaTa|proteomes| Protein counts of proteomes could not be retrieved from UniProt: %s.', error)
+
+    return proteome_protein_counts
+
+
+def create_cost_plan(proteome_tax_id_file, proteome_protein_counts, proteomes_folder, cost_plan_file,
+                     uniprot_sparql_endpoint=None, proteome_store=None, uniprot_release=None):
+    """Estimate the cost of the next steps of esmecata (download, clustering and annotation) and write it in a JSON file.
+    Proteomes already in the proteomes folder (or in the proteome store) are not counted in the bytes to download.
+    The numbers of proteins clustered and annotated are upper bounds (all the proteins of the proteomes of a taxon).
+
+    Args:
+        proteome_tax_id_file (str): pathname to the proteome_tax_id.tsv file
+        proteome_protein_counts (dict): proteome ID (key) associated with its number of proteins (value)
+        proteomes_folder (str): pathname to the folder containing the downloaded proteomes
+        cost_plan_file (str): pathname to the JSON output file
+        uniprot_sparql_endpoint (str): uniprot SPARQL endpoint used by esmecata annotation (REST queries if None)
+        proteome_store (ProteomeStore): proteome store from which proteomes are linked instead of being downloaded
+        uniprot_release (str): UniProt release of the proteomes of the store
+
+    Returns:
+        cost_plan (dict): cost plan written in cost_plan_file
+    """
+    # Clustering and annotation are performed by taxon name, for all the observation names associated with it.
+    taxa = OrderedDict()
+    with open(proteome_tax_id_file, 'r') as proteome_tax_file:
+        csvreader = csv.DictReader(proteome_tax_file, delimiter='\t')
+        for line in csvreader:
+            if line['name'] not in taxa:
+                taxa[line['name']] = {'tax_id': line['tax_id'], 'tax_rank': line['tax_rank'], 'observation_names': [],
+                                      'proteomes': line['proteome'].split(',')}
+            taxa[line['name']]['observation_names'].append(line['observation_name'])
+
+    proteomes = set([proteome for taxon in taxa.values() for proteome in taxon['proteomes']])
+    local_proteomes = set()
+    for proteome in proteomes:
+        if os.path.exists(os.path.join(proteomes_folder, proteome+'.faa.gz')):
+            local_proteomes.add(proteome)
+        elif proteome_store is not None and proteome_store.get_size(proteome, uniprot_release) is not None:
+            local_proteomes.add(proteome)
+    proteomes_without_protein_count = sorted(proteomes - set(proteome_protein_counts))
+    if len(proteomes_without_protein_count) > 0:
+        logger.warning('|EsMeCaTa|proteomes| No protein count found for %d proteomes, they are not included in the cost plan estimations.', len(proteomes_without_protein_count))
+
+    taxa_plans = OrderedDict()
+    for tax_name, taxon in taxa.items():
+        nb_proteins = sum([proteome_protein_counts.get(proteome, 0) for proteome in taxon['proteomes']])
+        nb_residues = nb_proteins * ESTIMATED_PROTEIN_LENGTH
+        if uniprot_sparql_endpoint:
+            nb_annotation_queries = math.ceil(len(taxon['proteomes']) / ANNOTATION_SPARQL_PROTEOMES_BY_QUERY)
+        else:
+            nb_annotation_queries = math.ceil(nb_proteins / ANNOTATION_REST_PROTEINS_BY_QUERY)
+        taxa_plans[tax_name] = {'tax_id': taxon['tax_id'], 'tax_rank': taxon['tax_rank'], 'observation_names': taxon['observation_names'],
+                                'number_proteomes': len(taxon['proteomes']), 'estimated_proteins': nb_proteins,
+                                'estimated_mmseqs_residues': nb_residues,
+                                'estimated_mmseqs_memory_bytes': MMSEQS_INDEX_MEMORY + MMSEQS_MEMORY_BY_RESIDUE * nb_residues,
+                                'estimated_annotation_queries': nb_annotation_queries}
+
+    proteomes_to_download = proteomes - local_proteomes
+    cost_plan = OrderedDict()
+    cost_plan['download'] = {'number_proteomes': len(proteomes), 'number_local_proteomes': len(local_proteomes),
+                             'number_proteomes_to_download': len(proteomes_to_download),
+                             'estimated_download_bytes': sum([proteome_protein_counts.get(proteome, 0) for proteome in proteomes_to_download]) * ESTIMATED_COMPRESSED_PROTEIN_SIZE,
+                             'proteomes_without_protein_count': proteomes_without_protein_count}
+    cost_plan['clustering'] = {'number_clusterings': len(taxa_plans),
+                               'estimated_proteins': sum([taxon_plan['estimated_proteins'] for taxon_plan in taxa_plans.values()]),
+                               'estimated_residues': sum([taxon_plan['estimated_mmseqs_residues'] for taxon_plan in taxa_plans.values()]),
+                               'estimated_max_memory_bytes': max([taxon_plan['estimated_mmseqs_memory_bytes'] for taxon_plan in taxa_plans.values()], default=0)}
+    cost_plan['annotation'] = {'query_system': 'sparql' if uniprot_sparql_endpoint else 'rest',
+                               'estimated_max_proteins': cost_plan['clustering']['estimated_proteins'],
+                               'estimated_queries': sum([taxon_plan['estimated_annotation_queries'] for taxon_plan in taxa_plans.values()])}
+    cost_plan['taxa'] = taxa_plans
+
+    with open(cost_plan_file, 'w') as output_file:
+        json.dump(cost_plan, output_file, indent=4)
+
+    logger.info('|EsMeCaTa|proteomes| Cost plan: %d proteomes to download (around %d MB), %d clusterings of around %d proteins, %d annotation queries. Written in %s.',
+                len(proteomes_to_download), cost_plan['download']['estimated_download_bytes'] // 10**6, len(taxa_plans),
+                cost_plan['clustering']['estimated_proteins'], cost_plan['annotation']['estimated_queries'], cost_plan_file)
+
+    return cost_plan
+
+
+def get_uniprot_release_number(uniprot_sparql_endpoint=None):
+    """Get the number of the current UniProt release.
+
+    Args:
+        uniprot_sparql_endpoint (str): uniprot SPARQL endpoint to query (REST queries if None)
+
+    Returns:
+        uniprot_release (str): UniProt release number
+    """
+    if uniprot_sparql_endpoint:
+        return get_sparql_uniprot_release(uniprot_sparql_endpoint, {})['uniprot_release']
+    else:
+        return get_rest_uniprot_release({})['uniprot_release']
+
+
 def retrieve_proteomes(input_file, output_folder, busco_percentage_keep=80,
                         ignore_taxadb_update=None, all_proteomes=None, uniprot_sparql_endpoint=None,
                         limit_maximal_number_proteomes=99, rank_limit=None, minimal_number_proteomes=1,
-                        update_affiliations=None, option_bioservices=None):
+                        update_affiliations=None, option_bioservices=None, subtree_rank=None, proteome_cache_file=None,
+                        proteome_store_folder=None):
     """From a tsv file with taxonomic affiliations find the associated proteomes and download them.
 
     Args:
@@ -1338,13 +2479,16 @@ def retrieve_proteomes(input_file, output_folder, busco_percentage_keep=80,
         minimal_number_proteomes (int): minimal number of proteomes required to be associated with a taxon for the taxon to be kept.
         update_affiliations (str): option to update taxonomic affiliations.
         option_bioservices (bool): use bioservices instead of manual queries.
+        subtree_rank (str): fetch the proteomes of the taxa at this rank (such as family) once and resolve the proteomes of their lower taxa locally.
+        proteome_cache_file (str): pathname to a SQLite file storing the answers of the proteome queries between runs.
+        proteome_store_folder (str): pathname to a folder storing the proteomes shared between runs, linked in the output folder instead of being downloaded again.
     """
     starttime = time.time()
 
     proteome_to_download, session = check_proteomes(input_file, output_folder, busco_percentage_keep,
                             ignore_taxadb_update, all_proteomes, uniprot_sparql_endpoint,
                             limit_maximal_number_proteomes, rank_limit, minimal_number_proteomes,
-                            update_affiliations, option_bioservices)
+                            update_affiliations, option_bioservices, subtree_rank, proteome_cache_file)
 
     logger.info('|EsMeCaTa|proteomes| Start downloading proteomes.')
 
@@ -1352,41 +2496,52 @@ def retrieve_proteomes(input_file, output_folder, busco_percentage_keep=80,
     is_valid_dir(proteomes_folder)
 
     # Download all the proteomes in proteome folder.
-    proteomes_already_downloaded = set([proteome_filename.replace('.faa.gz', '') for proteome_filename in os.listdir(proteomes_folder)])
+    # Broken symbolic links (made by previous versions to a proteome store on another file system, then evicted from it) are downloaded again.
+    proteomes_already_downloaded = set()
+    for proteome_filename in os.listdir(proteomes_folder):
+        if proteome_filename.endswith('.faa.gz'):
+            proteome_file = os.path.join(proteomes_folder, proteome_filename)
+            if os.path.exists(proteome_file):
+                proteomes_already_downloaded.add(proteome_filename.replace('.faa.gz', ''))
+            else:
+                os.remove(proteome_file)
     proteome_to_download = proteome_to_download - proteomes_already_downloaded
 
+    proteome_store = None
+    if proteome_store_folder is not None and len(proteome_to_download) > 0:
+        proteome_store = ProteomeStore(proteome_store_folder)
+        store_release = get_uniprot_release_number(uniprot_sparql_endpoint)
+        linked_proteomes = set([proteome for proteome in proteome_to_download
+                                if proteome_store.link(proteome, store_release, os.path.join(proteomes_folder, proteome+'.faa.gz'))])
+        logger.info('|EsMeCaTa|proteomes| %d proteomes linked from the proteome store %s.', len(linked_proteomes), proteome_store_folder)
+        proteome_to_download = proteome_to_download - linked_proteomes
+
     if len(proteome_to_download) == 0:
         logger.info('|EsMeCaTa|proteomes| All proteomes already downloaded.')
     else:
         logger.info('|EsMeCaTa|proteomes| Downloading %d proteomes', len(proteome_to_download))
 
-    for index, proteome in enumerate(proteome_to_download):
-        output_proteome_file = os.path.join(proteomes_folder, proteome+'.faa.gz')
-        if not os.path.exists(output_proteome_file):
-            if uniprot_sparql_endpoint is not None:
-                sparql_get_protein_seq(proteome, output_proteome_file, uniprot_sparql_endpoint)
-            else:
-                if option_bioservices is None:
-                    http_str = 'https://rest.uniprot.org/uniprotkb/stream?query=proteome:{0}&format=fasta&compressed=true'.format(proteome)
-                    proteome_response = session.get(http_str)
-                    with open(output_proteome_file, 'wb') as f:
-                        f.write(proteome_response.content)
-                else:
-                    import bioservices
-                    uniprot_bioservices = bioservices.UniProt()
-                    data_fasta = uniprot_bioservices.search(f'(proteome:{proteome})', database='uniprot',
-                                                            frmt='fasta', compress=True, progress=False)
-                    with open(output_proteome_file, 'wb') as f:
-                        f.write(data_fasta)
+    failed_proteomes, download_statistics = download_proteomes(proteome_to_download, proteomes_folder, session, uniprot_sparql_endpoint, option_bioservices)
+    if len(failed_proteomes) > 0:
+        logger.critical('|EsMeCaTa|proteomes| %d proteomes could not be downloaded: %s.', len(failed_proteomes), ', '.join(failed_proteomes))
+        sys.exit('Some proteomes could not be downloaded, so esmecata has been stopped. You may try to relaunch it using the same command esmecata should resume.')
+
+    if proteome_store is not None:
+        for proteome in proteome_to_download:
+            proteome_store.add(proteome, store_release, os.path.join(proteomes_folder, proteome+'.faa.gz'))
+        proteome_store.evict()
 
-            logger.info('|EsMeCaTa|proteomes| Downloaded %d on %d proteomes',index+1, len(proteome_to_download))
-        time.sleep(1)
+    # Index the protein accessions of the downloaded proteomes for the clustering.
+    proteome_accession_index_file = os.path.join(output_folder, PROTEOME_ACCESSION_INDEX_FILENAME)
+    if update_proteome_accession_index(proteomes_folder, proteome_accession_index_file):
+        logger.info('|EsMeCaTa|proteomes| Proteome accession index written in %s.', proteome_accession_index_file)
 
     # Download Uniprot metadata and create a json file containing them.
     options = {'input_file': input_file, 'output_folder': output_folder, 'busco_percentage_keep': busco_percentage_keep,
                     'ignore_taxadb_update': ignore_taxadb_update, 'all_proteomes': all_proteomes, 'uniprot_sparql_endpoint': uniprot_sparql_endpoint,
                     'limit_maximal_number_proteomes': limit_maximal_number_proteomes, 'rank_limit': rank_limit,
-                    'minimal_number_proteomes': minimal_number_proteomes}
+                    'minimal_number_proteomes': minimal_number_proteomes, 'subtree_rank': subtree_rank,
+                    'proteome_cache_file': proteome_cache_file, 'proteome_store_folder': proteome_store_folder}
 
     # Collect dependencies metadata.
     options['tool_dependencies'] = {}
@@ -1411,6 +2566,12 @@ def retrieve_proteomes(input_file, output_folder, busco_percentage_keep=80,
     stat_file = os.path.join(output_folder, 'stat_number_proteome.tsv')
     compute_stat_proteomes(output_folder, stat_file)
 
+    uniprot_releases['taxonomy_cache_statistics'] = get_taxonomy_service().cache_statistics()
+    uniprot_releases['proteome_download_statistics'] = download_statistics
+    if proteome_store is not None:
+        uniprot_releases['proteome_store_statistics'] = proteome_store.cache_statistics()
+        proteome_store.close()
+
     endtime = time.time()
     duration = endtime - starttime
     uniprot_releases['esmecata_proteomes_duration'] = duration
@@ -6,13 +6,13 @@ import os
 import json
 import numpy as np
 import pandas as pd
-from ete3 import NCBITaxa
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.io import write_json
 from plotly.subplots import make_subplots
 from  ontosunburst.ontosunburst import ec_ontosunburst
 from esmecata_compression import RANK2COL
+from esmecata.taxonomy import get_taxonomy_service
 
 # from statistics import NormalDist
 # import matplotlib.pyplot as plt
@@ -112,7 +112,7 @@ def _format_taxo(proteome_tax_id):
     "species subgroup","species","forma specialis","subspecies","varietas",
     "subvariety","forma","serogroup","serotype","strain","isolate"]
 
-    ncbi = NCBITaxa()
+    ncbi = get_taxonomy_service()
 
     ranks = {}
     names = {}
@@ -368,7 +368,7 @@ def compare_ranks_in_out(proteome_tax_id, association_taxon_tax_id, results_path
     rank_list = ['species', 'genus', 'family', 'order', 'class', 'phylum', 'kingdom', 'superkingdom', 'clade', 'no rank']
 
     d_in = dict()
-    ncbi = NCBITaxa()
+    ncbi = get_taxonomy_service()
 
     # Loop on each input (=each key of 0_proteomes/association_taxon_taxID.json)
     for taxa in association_taxon_tax_id.keys():
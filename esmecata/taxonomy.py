@@ -0,0 +1,566 @@
+# Copyright (C) 2021-2024 Arnaud Belcour - Inria, Univ Rennes, CNRS, IRISA Dyliss
+# Univ. Grenoble Alpes, Inria, Microcosme
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import sqlite3
+
+from collections import OrderedDict
+
+from ete3 import NCBITaxa
+
+logger = logging.getLogger(__name__)
+
+# Maximal number of entries kept by each memo cache of the taxonomy service.
+TAXONOMY_CACHE_SIZE = 500000
+
+# Value stored in memo caches for keys absent from the database.
+NOT_IN_DATABASE = object()
+
+TAXONOMY_SERVICE = None
+
+# Taxonomy index file used by the taxonomy service instead of the ete3 SQLite database (see set_taxonomy_index).
+TAXONOMY_INDEX_FILE = None
+
+# Default name of the taxonomy index file created by esmecata taxonomy_index.
+TAXONOMY_INDEX_FILENAME = 'esmecata_taxonomy_index.bin'
+
+# Identify the taxonomy index format, the file starts with these bytes followed by the JSON header size.
+TAXONOMY_INDEX_MAGIC = b'ESMTAXI1'
+TAXONOMY_INDEX_VERSION = 1
+
+# Arrays of the taxonomy index start at offsets multiple of this value.
+TAXONOMY_INDEX_ALIGNMENT = 64
+
+# Rank code of the taxon IDs absent from the taxonomy index.
+MISSING_RANK_CODE = 255
+
+
+class LRUCache:
+    """ Memo cache with a bounded number of entries, the least recently used entries are removed first.
+    It counts the hits and misses of the lookups.
+    """
+    def __init__(self, maxsize=TAXONOMY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Get the value associated with a key.
+
+        Args:
+            key: key to search in the cache
+
+        Returns:
+            value: value associated with the key or None if key is not in the cache
+        """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """ Add a value to the cache and remove the least recently used entries if the cache is full.
+
+        Args:
+            key: key to add
+            value: value associated with the key
+        """
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class CachedNCBITaxa:
+    """ Wrapper around ete3 NCBITaxa serving get_lineage, get_rank, get_taxid_translator and get_name_translator from LRU memo caches.
+    It can be used everywhere an ete3 NCBITaxa object is expected, other methods are forwarded to the NCBITaxa object.
+    """
+    def __init__(self, ncbi=None, cache_size=TAXONOMY_CACHE_SIZE):
+        if ncbi is None:
+            ncbi = NCBITaxa()
+        self.ncbi = ncbi
+        self.lineage_cache = LRUCache(cache_size)
+        self.rank_cache = LRUCache(cache_size)
+        self.taxid_name_cache = LRUCache(cache_size)
+        self.name_taxid_cache = LRUCache(cache_size)
+
+    def __getattr__(self, attribute):
+        # Avoid infinite recursion if ncbi is not set yet.
+        if attribute == 'ncbi':
+            raise AttributeError(attribute)
+        return getattr(self.ncbi, attribute)
+
+    def _cached_translation(self, keys, cache, query_function):
+        """ Search keys in a cache and query the missing ones with a single call to query_function.
+
+        Args:
+            keys (dict): key in cache as key and key given to query_function as value
+            cache (LRUCache): memo cache
+            query_function (function): NCBITaxa method returning a dictionary for a list of keys
+
+        Returns:
+            translations (dict): cache key as key and associated value as value (keys absent from the database are not returned)
+        """
+        translations = {}
+        missing_keys = {}
+        for cache_key, query_key in keys.items():
+            value = cache.get(cache_key)
+            if value is None:
+                missing_keys[cache_key] = query_key
+            elif value is not NOT_IN_DATABASE:
+                translations[cache_key] = value
+
+        if missing_keys:
+            query_results = query_function(list(missing_keys.values()))
+            for cache_key, query_key in missing_keys.items():
+                value = query_results.get(query_key, NOT_IN_DATABASE)
+                cache.put(cache_key, value)
+                if value is not NOT_IN_DATABASE:
+                    translations[cache_key] = value
+
+        return translations
+
+    def get_lineage(self, taxid):
+        """ Return the lineage of a taxon ID, from the root to the taxon.
+
+        Args:
+            taxid (int): taxon ID
+
+        Returns:
+            lineage (list): list of taxon IDs
+        """
+        if not taxid:
+            return None
+        taxid = int(taxid)
+        lineage = self.lineage_cache.get(taxid)
+        if lineage is None:
+            # Let ete3 raise the ValueError for unknown taxon IDs.
+            lineage = tuple(self.ncbi.get_lineage(taxid))
+            self.lineage_cache.put(taxid, lineage)
+        return list(lineage)
+
+    def get_rank(self, taxids):
+        """ Return the rank of each taxon ID.
+
+        Args:
+            taxids (list): list of taxon IDs
+
+        Returns:
+            id2rank (dict): taxon ID (int) as key and rank as value
+        """
+        keys = {}
+        for taxid in taxids:
+            # Like ete3, ignore values that are not taxon IDs (such as 'not_found').
+            try:
+                keys[int(taxid)] = int(taxid)
+            except (TypeError, ValueError):
+                continue
+        return self._cached_translation(keys, self.rank_cache, self.ncbi.get_rank)
+
+    def get_taxid_translator(self, taxids, try_synonyms=True):
+        """ Return the scientific name of each taxon ID.
+
+        Args:
+            taxids (list): list of taxon IDs
+            try_synonyms (bool): search for merged taxon IDs if a taxon ID is not found
+
+        Returns:
+            id2name (dict): taxon ID (int) as key and scientific name as value
+        """
+        if try_synonyms is False:
+            return self.ncbi.get_taxid_translator(taxids, try_synonyms=False)
+        keys = {int(taxid): int(taxid) for taxid in taxids}
+        return self._cached_translation(keys, self.taxid_name_cache, self.ncbi.get_taxid_translator)
+
+    def get_name_translator(self, names):
+        """ Return the taxon IDs associated with each taxon name (names are case insensitive like in ete3).
+
+        Args:
+            names (list): list of taxon names
+
+        Returns:
+            name2ids (dict): taxon name as key and list of taxon IDs as value
+        """
+        lower_names = {}
+        for name in names:
+            lower_names.setdefault(name.lower(), []).append(name)
+        keys = {lower_name: lower_name for lower_name in lower_names}
+        translations = self._cached_translation(keys, self.name_taxid_cache, self.ncbi.get_name_translator)
+
+        name2ids = {}
+        for lower_name, tax_ids in translations.items():
+            for name in lower_names[lower_name]:
+                name2ids[name] = list(tax_ids)
+        return name2ids
+
+    def cache_statistics(self):
+        """ Return the number of hits and misses of each memo cache.
+
+        Returns:
+            statistics (dict): method name as key and dictionary with hits, misses and size as value
+        """
+        caches = {'get_lineage': self.lineage_cache, 'get_rank': self.rank_cache,
+                  'get_taxid_translator': self.taxid_name_cache, 'get_name_translator': self.name_taxid_cache}
+        statistics = {}
+        for method_name, cache in caches.items():
+            statistics[method_name] = {'hits': cache.hits, 'misses': cache.misses, 'size': len(cache.entries)}
+        return statistics
+
+
+def hash_taxon_name(name):
+    """ Compute the 64 bits hash of a lowercase taxon name used by the name to taxon ID table of the taxonomy index.
+    Contrary to the Python hash function, it is stable between processes.
+
+    Args:
+        name (str): taxon name
+
+    Returns:
+        name_hash (int): hash of the lowercase taxon name
+    """
+    return int.from_bytes(hashlib.blake2b(name.lower().encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def create_name_table(names, taxids):
+    """ Create the arrays of a name to taxon ID table sorted by name hash (then by taxon ID).
+
+    Args:
+        names (list): list of taxon names
+        taxids (list): list of taxon IDs associated with the names
+
+    Returns:
+        name_arrays (dict): hashes, taxids, offsets and blob arrays of the table
+    """
+    name_hashes = np.fromiter((hash_taxon_name(name) for name in names), dtype=np.uint64, count=len(names))
+    name_taxids = np.array(taxids, dtype=np.int32)
+    order = np.lexsort((name_taxids, name_hashes))
+
+    encoded_names = [names[index].lower().encode('utf-8') for index in order]
+    name_offsets = np.zeros(len(encoded_names) + 1, dtype=np.int64)
+    name_offsets[1:] = np.cumsum([len(encoded_name) for encoded_name in encoded_names], dtype=np.int64)
+
+    return {'hashes': name_hashes[order], 'taxids': name_taxids[order],
+            'offsets': name_offsets, 'blob': np.frombuffer(b''.join(encoded_names), dtype=np.uint8)}
+
+
+def create_taxonomy_index(index_file, ete3_dbfile=None):
+    """ Compile the ete3 NCBI Taxonomy SQLite database into a binary taxonomy index read with TaxonomyIndex.
+    The file contains a JSON header followed by arrays: parent and rank code indexed by taxon ID,
+    scientific names (offsets and blob indexed by taxon ID), name to taxon ID tables sorted by name hash
+    (for scientific names and synonyms) and merged taxon IDs.
+
+    Args:
+        index_file (str): pathname to the taxonomy index file to create
+        ete3_dbfile (str): pathname to the ete3 taxa.sqlite database (by default, the one of ete3 NCBITaxa)
+
+    Returns:
+        index_header (dict): header of the taxonomy index
+    """
+    if ete3_dbfile is None:
+        ete3_dbfile = NCBITaxa().dbfile
+
+    connection = sqlite3.connect(ete3_dbfile)
+    species = connection.execute('SELECT taxid, parent, spname, rank FROM species').fetchall()
+    synonyms = connection.execute('SELECT taxid, spname FROM synonym').fetchall()
+    merged = connection.execute('SELECT taxid_old, taxid_new FROM merged ORDER BY taxid_old').fetchall()
+    connection.close()
+
+    max_taxid = max(taxid for taxid, _, _, _ in species)
+    parents = np.full(max_taxid + 1, -1, dtype=np.int32)
+    rank_codes = np.full(max_taxid + 1, MISSING_RANK_CODE, dtype=np.uint8)
+    name_lengths = np.zeros(max_taxid + 1, dtype=np.int64)
+    ranks = {}
+    encoded_names = {}
+    for taxid, parent, spname, rank in species:
+        # ete3 stores the root (taxon ID 1) with an empty parent, the root is its own parent in the index.
+        if parent in ('', None):
+            parent = 1
+        parents[taxid] = int(parent)
+        if rank not in ranks:
+            ranks[rank] = len(ranks)
+        rank_codes[taxid] = ranks[rank]
+        encoded_names[taxid] = spname.encode('utf-8')
+        name_lengths[taxid] = len(encoded_names[taxid])
+    if len(ranks) >= MISSING_RANK_CODE:
+        raise ValueError('Too many taxonomic ranks ({0}) in {1} to be stored in the taxonomy index.'.format(len(ranks), ete3_dbfile))
+
+    # Scientific names are stored in taxon ID order, name_offsets[taxid] to name_offsets[taxid+1] delimits the name of taxid.
+    name_offsets = np.zeros(max_taxid + 2, dtype=np.int64)
+    name_offsets[1:] = np.cumsum(name_lengths)
+    name_blob = np.frombuffer(b''.join(encoded_names[taxid] for taxid in sorted(encoded_names)), dtype=np.uint8)
+
+    species_table = create_name_table([spname for _, _, spname, _ in species], [taxid for taxid, _, _, _ in species])
+    synonym_table = create_name_table([spname for _, spname in synonyms], [taxid for taxid, _ in synonyms])
+
+    arrays = {'parents': parents, 'rank_codes': rank_codes,
+              'name_offsets': name_offsets, 'name_blob': name_blob,
+              'merged_old': np.array([taxid_old for taxid_old, _ in merged], dtype=np.int32),
+              'merged_new': np.array([taxid_new for _, taxid_new in merged], dtype=np.int32)}
+    for table_name, table in [('species', species_table), ('synonym', synonym_table)]:
+        for array_name, array in table.items():
+            arrays['{0}_{1}'.format(table_name, array_name)] = array
+
+    # Offsets of arrays are relative to the start of the data section.
+    array_descriptions = {}
+    data_size = 0
+    for array_name, array in arrays.items():
+        array_descriptions[array_name] = {'dtype': array.dtype.str, 'offset': data_size, 'length': len(array)}
+        data_size += -(-array.nbytes // TAXONOMY_INDEX_ALIGNMENT) * TAXONOMY_INDEX_ALIGNMENT
+
+    index_header = {'version': TAXONOMY_INDEX_VERSION, 'ete3_dbfile': os.path.abspath(ete3_dbfile),
+                    'ete3_dbfile_mtime': os.path.getmtime(ete3_dbfile), 'ranks': list(ranks),
+                    'arrays': array_descriptions}
+    encoded_header = json.dumps(index_header).encode('utf-8')
+    header_size = len(TAXONOMY_INDEX_MAGIC) + 8 + len(encoded_header)
+    data_start = -(-header_size // TAXONOMY_INDEX_ALIGNMENT) * TAXONOMY_INDEX_ALIGNMENT
+
+    # Write in a temporary file, then rename it, so processes reading the index never see a partial file.
+    tmp_index_file = index_file + '.tmp'
+    with open(tmp_index_file, 'wb') as output_file:
+        output_file.write(TAXONOMY_INDEX_MAGIC)
+        output_file.write(len(encoded_header).to_bytes(8, 'little'))
+        output_file.write(encoded_header)
+        output_file.write(b'\0' * (data_start - header_size))
+        for array_name, array in arrays.items():
+            output_file.seek(data_start + array_descriptions[array_name]['offset'])
+            output_file.write(array.tobytes())
+        output_file.truncate(data_start + data_size)
+    os.replace(tmp_index_file, index_file)
+
+    return index_header
+
+
+class TaxonomyIndex:
+    """ Read-only taxonomy index created by create_taxonomy_index.
+    The file is memory-mapped so the index is loaded lazily and its pages are shared between processes.
+    It answers get_lineage, get_rank, get_taxid_translator and get_name_translator like ete3 NCBITaxa
+    and can be used instead of it in esmecata functions.
+    """
+    def __init__(self, index_file):
+        self.index_file = index_file
+        with open(index_file, 'rb') as input_file:
+            magic = input_file.read(len(TAXONOMY_INDEX_MAGIC))
+            if magic != TAXONOMY_INDEX_MAGIC:
+                raise ValueError('{0} is not an esmecata taxonomy index.'.format(index_file))
+            header_length = int.from_bytes(input_file.read(8), 'little')
+            self.header = json.loads(input_file.read(header_length).decode('utf-8'))
+        if self.header['version'] != TAXONOMY_INDEX_VERSION:
+            raise ValueError('Taxonomy index {0} has version {1}, esmecata expects version {2}. Recreate it with esmecata taxonomy_index.'.format(index_file, self.header['version'], TAXONOMY_INDEX_VERSION))
+
+        ete3_dbfile = self.header['ete3_dbfile']
+        if os.path.exists(ete3_dbfile) and os.path.getmtime(ete3_dbfile) > self.header['ete3_dbfile_mtime']:
+            logger.warning('|EsMeCaTa|taxonomy| WARNING: ete3 database %s has been modified after the creation of taxonomy index %s, recreate it with esmecata taxonomy_index.', ete3_dbfile, index_file)
+
+        header_size = len(TAXONOMY_INDEX_MAGIC) + 8 + header_length
+        data_start = -(-header_size // TAXONOMY_INDEX_ALIGNMENT) * TAXONOMY_INDEX_ALIGNMENT
+        self.memory_map = np.memmap(index_file, dtype=np.uint8, mode='r')
+        self.arrays = {}
+        for array_name, array_description in self.header['arrays'].items():
+            dtype = np.dtype(array_description['dtype'])
+            start = data_start + array_description['offset']
+            end = start + array_description['length'] * dtype.itemsize
+            self.arrays[array_name] = self.memory_map[start:end].view(dtype)
+
+        self.parents = self.arrays['parents']
+        self.rank_codes = self.arrays['rank_codes']
+        self.ranks = self.header['ranks']
+
+    def _is_in_index(self, taxid):
+        return 0 < taxid < len(self.parents) and self.parents[taxid] != -1
+
+    def _translate_merged(self, taxid):
+        """ Return the new taxon ID of a merged taxon ID.
+
+        Args:
+            taxid (int): taxon ID
+
+        Returns:
+            new_taxid (int): new taxon ID or None if taxid has not been merged
+        """
+        merged_old = self.arrays['merged_old']
+        position = np.searchsorted(merged_old, taxid)
+        if position < len(merged_old) and merged_old[position] == taxid:
+            return int(self.arrays['merged_new'][position])
+        return None
+
+    def _get_name(self, taxid):
+        name_offsets = self.arrays['name_offsets']
+        return self.arrays['name_blob'][name_offsets[taxid]:name_offsets[taxid+1]].tobytes().decode('utf-8')
+
+    def _search_name(self, table_name, lower_name):
+        """ Search the taxon IDs associated with a lowercase taxon name in a name table of the index.
+
+        Args:
+            table_name (str): species (scientific names) or synonym
+            lower_name (str): lowercase taxon name
+
+        Returns:
+            taxids (list): list of taxon IDs associated with the name
+        """
+        name_hashes = self.arrays[table_name + '_hashes']
+        name_hash = np.uint64(hash_taxon_name(lower_name))
+        start = np.searchsorted(name_hashes, name_hash, side='left')
+        end = np.searchsorted(name_hashes, name_hash, side='right')
+
+        # Check the names to exclude hash collisions.
+        encoded_name = lower_name.encode('utf-8')
+        name_offsets = self.arrays[table_name + '_offsets']
+        name_blob = self.arrays[table_name + '_blob']
+        taxids = []
+        for position in range(start, end):
+            if name_blob[name_offsets[position]:name_offsets[position+1]].tobytes() == encoded_name:
+                taxids.append(int(self.arrays[table_name + '_taxids'][position]))
+        return taxids
+
+    def get_lineage(self, taxid):
+        """ Return the lineage of a taxon ID, from the root to the taxon.
+
+        Args:
+            taxid (int): taxon ID
+
+        Returns:
+            lineage (list): list of taxon IDs
+        """
+        if not taxid:
+            return None
+        taxid = int(taxid)
+        if not self._is_in_index(taxid):
+            new_taxid = self._translate_merged(taxid)
+            if new_taxid is None or not self._is_in_index(new_taxid):
+                raise ValueError('{0} taxid not found'.format(taxid))
+            taxid = new_taxid
+
+        lineage = [taxid]
+        while taxid != 1:
+            parent = int(self.parents[taxid])
+            if not self._is_in_index(parent):
+                raise ValueError('Parent {0} of taxid {1} not found in taxonomy index {2}'.format(parent, taxid, self.index_file))
+            # A lineage can not be longer than the number of taxa, except with a parent cycle in a corrupted ete3 database.
+            if len(lineage) >= len(self.parents):
+                raise ValueError('Parent cycle in the lineage of taxid {0} in taxonomy index {1}'.format(lineage[0], self.index_file))
+            taxid = parent
+            lineage.append(taxid)
+        lineage.reverse()
+        return lineage
+
+    def get_rank(self, taxids):
+        """ Return the rank of each taxon ID.
+
+        Args:
+            taxids (list): list of taxon IDs
+
+        Returns:
+            id2rank (dict): taxon ID (int) as key and rank as value
+        """
+        id2rank = {}
+        for taxid in taxids:
+            # Like ete3, ignore values that are not taxon IDs (such as 'not_found').
+            try:
+                taxid = int(taxid)
+            except (TypeError, ValueError):
+                continue
+            if self._is_in_index(taxid):
+                id2rank[taxid] = self.ranks[self.rank_codes[taxid]]
+        return id2rank
+
+    def get_taxid_translator(self, taxids, try_synonyms=True):
+        """ Return the scientific name of each taxon ID.
+
+        Args:
+            taxids (list): list of taxon IDs
+            try_synonyms (bool): search for merged taxon IDs if a taxon ID is not found
+
+        Returns:
+            id2name (dict): taxon ID (int) as key and scientific name as value
+        """
+        id2name = {}
+        for taxid in taxids:
+            taxid = int(taxid)
+            if self._is_in_index(taxid):
+                id2name[taxid] = self._get_name(taxid)
+            elif try_synonyms:
+                new_taxid = self._translate_merged(taxid)
+                if new_taxid is not None and self._is_in_index(new_taxid):
+                    id2name[taxid] = self._get_name(new_taxid)
+        return id2name
+
+    def get_name_translator(self, names):
+        """ Return the taxon IDs associated with each taxon name (names are case insensitive like in ete3).
+        Scientific names are searched first, then synonyms.
+
+        Args:
+            names (list): list of taxon names
+
+        Returns:
+            name2ids (dict): taxon name as key and list of taxon IDs as value
+        """
+        name2ids = {}
+        for name in names:
+            lower_name = name.lower()
+            taxids = self._search_name('species', lower_name)
+            if taxids == []:
+                taxids = self._search_name('synonym', lower_name)
+            if taxids != []:
+                name2ids[name] = taxids
+        return name2ids
+
+
+def set_taxonomy_index(index_file):
+    """ Use a taxonomy index created by esmecata taxonomy_index as the backend of the shared taxonomy service.
+
+    Args:
+        index_file (str): pathname to the taxonomy index file (None to use the ete3 database)
+    """
+    global TAXONOMY_INDEX_FILE, TAXONOMY_SERVICE
+    TAXONOMY_INDEX_FILE = index_file
+    TAXONOMY_SERVICE = None
+
+
+def get_taxonomy_service():
+    """ Return the taxonomy service shared by the whole process, the taxonomy index or the ete3 database is opened at the first call.
+
+    Returns:
+        taxonomy_service (CachedNCBITaxa): shared taxonomy service
+    """
+    global TAXONOMY_SERVICE
+    if TAXONOMY_SERVICE is None:
+        if TAXONOMY_INDEX_FILE is not None:
+            TAXONOMY_SERVICE = CachedNCBITaxa(TaxonomyIndex(TAXONOMY_INDEX_FILE))
+        else:
+            TAXONOMY_SERVICE = CachedNCBITaxa()
+    return TAXONOMY_SERVICE
+
+
+def log_taxonomy_cache_statistics(esmecata_step):
+    """ Log the hits and misses of the shared taxonomy service memo caches.
+
+    Args:
+        esmecata_step (str): esmecata step name used in the log message
+
+    Returns:
+        statistics (dict): method name as key and dictionary with hits, misses and size as value (empty if the service has not been used)
+    """
+    if TAXONOMY_SERVICE is None:
+        return {}
+    statistics = TAXONOMY_SERVICE.cache_statistics()
+    for method_name, method_statistics in statistics.items():
+        logger.info('|EsMeCaTa|%s| Taxonomy cache %s: %d hits, %d misses.', esmecata_step, method_name, method_statistics['hits'], method_statistics['misses'])
+    return statistics
@@ -16,13 +16,18 @@
 import argparse
 import csv
 import datetime
+import gzip
+import json
 import logging
+import numpy as np
 import os
 import urllib.request
 import sys
+import tempfile
+import threading
 import time
 
-from io import StringIO
+from io import StringIO, TextIOWrapper
 from SPARQLWrapper import SPARQLWrapper, TSV
 from socket import timeout
 
@@ -32,9 +37,53 @@ MIN_VAL = 0
 MAX_VAL = 1
 URLLIB_HEADERS = {'User-Agent': 'EsMeCaTa annotation v' + esmecata_version + ', request by urllib package v' + urllib.request.__version__}
 
+# Suffix of the files listing the protein accessions of a proteome, written next to the proteome fasta file (proteome_id.faa.gz).
+PROTEOME_ACCESSIONS_SUFFIX = '.accessions'
+
+# Index mapping protein accessions to proteomes, written by esmecata proteomes in its output folder.
+PROTEOME_ACCESSION_INDEX_FILENAME = 'proteome_accession_index.bin'
+
+# Magic bytes and version of the proteome accession index file.
+PROTEOME_ACCESSION_INDEX_MAGIC = b'ESMACCI1'
+PROTEOME_ACCESSION_INDEX_VERSION = 1
+
+# Arrays of the proteome accession index are aligned on this number of bytes.
+PROTEOME_ACCESSION_INDEX_ALIGNMENT = 64
+
 logger = logging.getLogger(__name__)
 
 
+class TokenBucket:
+    """Thread-safe token bucket limiting the number of queries sent to UniProt.
+    Tokens are added at rate per second up to capacity, each query consumes one token and waits if there is none.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a token is available and consume it.
+
+        Returns:
+            waiting_time (float): time waited (in seconds) for the token
+        """
+        waiting_time = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waiting_time
+                sleep_time = (1 - self.tokens) / self.rate
+            time.sleep(sleep_time)
+            waiting_time += sleep_time
+
+
 def range_limited_float_type(arg):
     """Type function for argparse - a float within some predefined bounds
 
@@ -244,3 +293,292 @@ def send_uniprot_sparql_query(sparql_query, uniprot_sparql_endpoint):
         csvreader = []
 
     return csvreader
+
+
+def stream_uniprot_sparql_query(sparql_query, uniprot_sparql_endpoint):
+    """Send a SPARQL query and read its TSV answer line by line while it is received, without keeping the whole answer in memory.
+
+    Args:
+        sparql_query (str): string containing SPARQL query
+        uniprot_sparql_endpoint (str): SPARQL endpoint to uniprot database
+
+    Yields:
+        line (list): values of a line of the answer (without the header)
+    """
+    sparql = SPARQLWrapper(uniprot_sparql_endpoint)
+    sparql.agent = 'EsMeCaTa proteomes v' + esmecata_version + ', wrapper=' + sparql.agent
+
+    sparql.setQuery(sparql_query)
+    sparql.setReturnFormat(TSV)
+
+    query_response = sparql.query().response
+    try:
+        csvreader = csv.reader(TextIOWrapper(query_response, encoding='utf-8'), delimiter='\t')
+        # Avoid header.
+        next(csvreader, None)
+        for line in csvreader:
+            yield line
+    finally:
+        query_response.close()
+
+
+def scan_fasta_accessions(fasta_file):
+    """Read the protein accessions of a gzipped UniProt fasta file (sp|accession|name) from its header lines only, without parsing the sequences.
+
+    Args:
+        fasta_file (str): pathname to the gzipped fasta file
+
+    Returns:
+        accessions (list): protein accessions in the order of the file
+    """
+    accessions = []
+    with gzip.open(fasta_file, 'rb') as fasta_handle:
+        for line in fasta_handle:
+            if line.startswith(b'>'):
+                # Same ID as Bio.SeqIO: the first word of the header.
+                accessions.append(line[1:].split(None, 1)[0].split(b'|')[1].decode('utf-8'))
+    return accessions
+
+
+def get_proteome_accessions_file(proteome_file):
+    """Get the pathname to the file listing the protein accessions of a proteome.
+
+    Args:
+        proteome_file (str): pathname to the proteome fasta file (proteome_id.faa.gz)
+
+    Returns:
+        accessions_file (str): pathname to the accession file (proteome_id.accessions)
+    """
+    return proteome_file[:-len('.faa.gz')] + PROTEOME_ACCESSIONS_SUFFIX
+
+
+def write_proteome_accessions(accessions_file, accessions):
+    """Write the protein accessions of a proteome, one by line.
+    The file is written with a temporary name and renamed, so it is never read incomplete.
+
+    Args:
+        accessions_file (str): pathname to the accession file
+        accessions (list): protein accessions
+    """
+    file_descriptor, tmp_accessions_file = tempfile.mkstemp(prefix='.', suffix=PROTEOME_ACCESSIONS_SUFFIX, dir=os.path.dirname(accessions_file) or '.')
+    try:
+        with os.fdopen(file_descriptor, 'w') as output_file:
+            for accession in accessions:
+                output_file.write(accession + '\n')
+        os.replace(tmp_accessions_file, accessions_file)
+    finally:
+        if os.path.exists(tmp_accessions_file):
+            os.remove(tmp_accessions_file)
+
+
+def get_proteome_accessions(proteome_file):
+    """Get the protein accessions of a proteome from the accession file written at download time.
+    If this file is missing or older than the proteome, the header lines of the proteome are scanned and the accession file is written.
+
+    Args:
+        proteome_file (str): pathname to the proteome fasta file (proteome_id.faa.gz)
+
+    Returns:
+        accessions (list): protein accessions of the proteome
+    """
+    accessions_file = get_proteome_accessions_file(proteome_file)
+    if os.path.exists(accessions_file) and os.path.getmtime(accessions_file) >= os.path.getmtime(proteome_file):
+        with open(accessions_file, 'r') as input_file:
+            return input_file.read().splitlines()
+
+    accessions = scan_fasta_accessions(proteome_file)
+    try:
+        write_proteome_accessions(accessions_file, accessions)
+    except OSError as error:
+        logger.warning('|EsMeCaTa|utils| Accession file %s can not be written: %s', accessions_file, error)
+    return accessions
+
+
+def create_proteome_accession_index(index_file, proteome_files):
+    """Create the index mapping protein accessions to proteomes, read with ProteomeAccessionIndex.
+    Proteomes are numbered by their order in the sorted list of proteome IDs. The file contains a JSON header
+    (with the proteome IDs) followed by two arrays: the protein accessions (fixed-width bytes, sorted)
+    and the number of the proteome of each accession.
+
+    Args:
+        index_file (str): pathname to the index file to create
+        proteome_files (list): pathnames to the proteome fasta files (proteome_id.faa.gz)
+
+    Returns:
+        index_header (dict): header of the proteome accession index
+    """
+    proteome_files = sorted(proteome_files, key=lambda proteome_file: os.path.basename(proteome_file))
+    proteomes = [os.path.basename(proteome_file)[:-len('.faa.gz')] for proteome_file in proteome_files]
+
+    proteome_accessions = []
+    proteome_codes = []
+    for proteome_code, proteome_file in enumerate(proteome_files):
+        accessions = np.array([accession.encode('utf-8') for accession in get_proteome_accessions(proteome_file)], dtype=np.bytes_)
+        proteome_accessions.append(accessions)
+        proteome_codes.append(np.full(len(accessions), proteome_code, dtype=np.int32))
+
+    if len(proteome_accessions) > 0:
+        accession_width = max(1, max(accessions.dtype.itemsize for accessions in proteome_accessions))
+        accessions = np.concatenate([accessions.astype('S{0}'.format(accession_width)) for accessions in proteome_accessions])
+        accession_proteomes = np.concatenate(proteome_codes)
+    else:
+        accessions = np.array([], dtype='S1')
+        accession_proteomes = np.array([], dtype=np.int32)
+    # Stable sort: an accession found in several proteomes keeps its proteomes in increasing order.
+    accession_order = np.argsort(accessions, kind='stable')
+    arrays = {'accessions': accessions[accession_order], 'proteome_codes': accession_proteomes[accession_order]}
+
+    # Offsets of arrays are relative to the start of the data section.
+    array_descriptions = {}
+    data_size = 0
+    for array_name, array in arrays.items():
+        array_descriptions[array_name] = {'dtype': array.dtype.str, 'offset': data_size, 'length': len(array)}
+        data_size += -(-array.nbytes // PROTEOME_ACCESSION_INDEX_ALIGNMENT) * PROTEOME_ACCESSION_INDEX_ALIGNMENT
+
+    index_header = {'version': PROTEOME_ACCESSION_INDEX_VERSION, 'proteomes': proteomes, 'arrays': array_descriptions}
+    encoded_header = json.dumps(index_header).encode('utf-8')
+    header_size = len(PROTEOME_ACCESSION_INDEX_MAGIC) + 8 + len(encoded_header)
+    data_start = -(-header_size // PROTEOME_ACCESSION_INDEX_ALIGNMENT) * PROTEOME_ACCESSION_INDEX_ALIGNMENT
+
+    # Write in a temporary file, then rename it, so processes reading the index never see a partial file.
+    file_descriptor, tmp_index_file = tempfile.mkstemp(prefix='.', suffix='.bin', dir=os.path.dirname(index_file) or '.')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as output_file:
+            output_file.write(PROTEOME_ACCESSION_INDEX_MAGIC)
+            output_file.write(len(encoded_header).to_bytes(8, 'little'))
+            output_file.write(encoded_header)
+            output_file.write(b'\0' * (data_start - header_size))
+            for array_name, array in arrays.items():
+                output_file.seek(data_start + array_descriptions[array_name]['offset'])
+                output_file.write(array.tobytes())
+            output_file.truncate(data_start + data_size)
+        os.replace(tmp_index_file, index_file)
+    finally:
+        if os.path.exists(tmp_index_file):
+            os.remove(tmp_index_file)
+
+    return index_header
+
+
+def update_proteome_accession_index(proteomes_folder, index_file):
+    """Create the proteome accession index if it is missing or if the proteomes of the folder have changed since its creation.
+
+    Args:
+        proteomes_folder (str): pathname to the folder containing the proteome fasta files
+        index_file (str): pathname to the proteome accession index file
+
+    Returns:
+        index_created (bool): True if the index has been (re)created
+    """
+    proteome_files = [os.path.join(proteomes_folder, proteome_filename) for proteome_filename in os.listdir(proteomes_folder)
+                      if proteome_filename.endswith('.faa.gz') and not proteome_filename.startswith('.')]
+    if os.path.exists(index_file):
+        proteome_index = ProteomeAccessionIndex(index_file)
+        is_up_to_date = proteome_index.is_up_to_date(proteome_files) and len(proteome_index.proteomes) == len(proteome_files)
+        proteome_index.close()
+        if is_up_to_date:
+            return False
+
+    create_proteome_accession_index(index_file, proteome_files)
+    return True
+
+
+class ProteomeAccessionIndex:
+    """Read-only index mapping protein accessions to proteomes, created by create_proteome_accession_index.
+    The file is memory-mapped and accessions are searched with a binary search, so no Python object is created for the accessions of the index.
+    """
+    def __init__(self, index_file):
+        self.index_file = index_file
+        with open(index_file, 'rb') as input_file:
+            magic = input_file.read(len(PROTEOME_ACCESSION_INDEX_MAGIC))
+            if magic != PROTEOME_ACCESSION_INDEX_MAGIC:
+                raise ValueError('{0} is not an esmecata proteome accession index.'.format(index_file))
+            header_length = int.from_bytes(input_file.read(8), 'little')
+            self.header = json.loads(input_file.read(header_length).decode('utf-8'))
+        if self.header['version'] != PROTEOME_ACCESSION_INDEX_VERSION:
+            raise ValueError('Proteome accession index {0} has version {1}, esmecata expects version {2}. Recreate it with esmecata proteomes.'.format(index_file, self.header['version'], PROTEOME_ACCESSION_INDEX_VERSION))
+
+        header_size = len(PROTEOME_ACCESSION_INDEX_MAGIC) + 8 + header_length
+        data_start = -(-header_size // PROTEOME_ACCESSION_INDEX_ALIGNMENT) * PROTEOME_ACCESSION_INDEX_ALIGNMENT
+        self.memory_map = np.memmap(index_file, dtype=np.uint8, mode='r')
+        self.arrays = {}
+        for array_name, array_description in self.header['arrays'].items():
+            dtype = np.dtype(array_description['dtype'])
+            start = data_start + array_description['offset']
+            end = start + array_description['length'] * dtype.itemsize
+            self.arrays[array_name] = self.memory_map[start:end].view(dtype)
+
+        self.accessions = self.arrays['accessions']
+        self.proteome_codes = self.arrays['proteome_codes']
+        self.proteomes = self.header['proteomes']
+
+    def close(self):
+        """Release the memory map of the index."""
+        self.arrays = {}
+        self.accessions = None
+        self.proteome_codes = None
+        self.memory_map = None
+
+    def is_up_to_date(self, proteome_files):
+        """Check that the index contains the proteomes and has been created after their last modification.
+
+        Args:
+            proteome_files (list): pathnames to the proteome fasta files (proteome_id.faa.gz)
+
+        Returns:
+            is_up_to_date (bool): True if the index can be used for these proteomes
+        """
+        index_proteomes = set(self.proteomes)
+        index_mtime = os.path.getmtime(self.index_file)
+        for proteome_file in proteome_files:
+            if os.path.basename(proteome_file)[:-len('.faa.gz')] not in index_proteomes:
+                return False
+            if os.path.getmtime(proteome_file) > index_mtime:
+                return False
+        return True
+
+    def get_proteome_codes(self, accessions, proteomes=None):
+        """Get the number of the proteome of each protein accession.
+        If an accession is found in several proteomes, the last one in the proteomes list is returned.
+
+        Args:
+            accessions (list): protein accessions
+            proteomes (list): proteome IDs in which the accessions are searched (by default, all the proteomes of the index)
+
+        Returns:
+            accession_proteome_codes (numpy.ndarray): number of the proteome (position in self.proteomes) of each accession, -1 if the accession is not found
+        """
+        if proteomes is None:
+            proteomes = self.proteomes
+        # Rank of each proteome in the proteomes list (-1 for proteomes not searched).
+        proteome_ranks = np.full(len(self.proteomes), -1, dtype=np.int64)
+        proteome_positions = {proteome: proteome_code for proteome_code, proteome in enumerate(self.proteomes)}
+        for proteome_rank, proteome in enumerate(proteomes):
+            if proteome in proteome_positions:
+                proteome_ranks[proteome_positions[proteome]] = proteome_rank
+
+        accession_proteome_codes = np.full(len(accessions), -1, dtype=np.int32)
+        if len(accessions) == 0 or len(self.accessions) == 0:
+            return accession_proteome_codes
+
+        searched_accessions = np.array([accession.encode('utf-8') for accession in accessions], dtype=np.bytes_)
+        # Accessions longer than the ones of the index can not be found, they are not truncated to avoid false matches.
+        too_long = np.char.str_len(searched_accessions) > self.accessions.dtype.itemsize
+        searched_accessions = searched_accessions.astype(self.accessions.dtype)
+        starts = np.searchsorted(self.accessions, searched_accessions, side='left')
+        ends = np.searchsorted(self.accessions, searched_accessions, side='right')
+        ends[too_long] = starts[too_long]
+
+        # Most accessions belong to one proteome.
+        single_matches = np.flatnonzero(ends - starts == 1)
+        single_codes = self.proteome_codes[starts[single_matches]]
+        kept_matches = proteome_ranks[single_codes] >= 0
+        accession_proteome_codes[single_matches[kept_matches]] = single_codes[kept_matches]
+
+        for accession_position in np.flatnonzero(ends - starts > 1):
+            match_codes = self.proteome_codes[starts[accession_position]:ends[accession_position]]
+            match_ranks = proteome_ranks[match_codes]
+            if match_ranks.max() >= 0:
+                accession_proteome_codes[accession_position] = match_codes[np.argmax(match_ranks)]
+
+        return accession_proteome_codes
@@ -23,6 +23,7 @@ from esmecata.proteomes import retrieve_proteomes, compute_stat_proteomes
 from esmecata.clustering import make_clustering, compute_stat_clustering
 from esmecata.annotation import annotate_proteins, compute_stat_annotation
 from esmecata.eggnog import annotate_with_eggnog
+from esmecata.taxonomy import log_taxonomy_cache_statistics
 
 logger = logging.getLogger(__name__)
 
@@ -85,7 +86,8 @@ def perform_workflow(input_file, output_folder, busco_percentage_keep=80, ignore
                         nb_cpu=1, clust_threshold=1, mmseqs_options=None,
                         linclust=None, propagate_annotation=None, uniref_annotation=None,
                         expression_annotation=None, minimal_number_proteomes=1, annotation_files=None,
-                        update_affiliations=None, option_bioservices=None):
+                        update_affiliations=None, option_bioservices=None, subtree_rank=None,
+                        proteome_cache_file=None, proteome_store_folder=None, nested_clustering=None):
     """From the proteomes found by esmecata proteomes, create protein cluster for each taxonomic affiliations.
 
     Args:
@@ -109,6 +111,10 @@ def perform_workflow(input_file, output_folder, busco_percentage_keep=80, ignore
         annotation_files (str): pathnames to UniProt dat files.
         update_affiliations (str): option to update taxonomic affiliations.
         option_bioservices (bool): use bioservices instead of manual queries.
+        subtree_rank (str): fetch the proteomes of the taxa at this rank (such as family) once and resolve the proteomes of their lower taxa locally.
+        proteome_cache_file (str): pathname to a SQLite file storing the answers of the proteome queries between runs.
+        proteome_store_folder (str): pathname to a folder storing the proteomes shared between runs, linked in the output folder instead of being downloaded again.
+        nested_clustering (bool): cluster only the taxa not nested in another taxon, the clusters of nested taxa are derived from them.
     """
     starttime = time.time()
     logger.info('|EsMeCaTa|workflow| Begin workflow.')
@@ -121,10 +127,12 @@ def perform_workflow(input_file, output_folder, busco_percentage_keep=80, ignore
     retrieve_proteomes(input_file, proteomes_output_folder, busco_percentage_keep,
                         ignore_taxadb_update, all_proteomes, uniprot_sparql_endpoint,
                         limit_maximal_number_proteomes, rank_limit, minimal_number_proteomes,
-                        update_affiliations, option_bioservices)
+                        update_affiliations, option_bioservices, subtree_rank, proteome_cache_file,
+                        proteome_store_folder)
 
     clustering_output_folder = os.path.join(output_folder, '1_clustering')
-    make_clustering(proteomes_output_folder, clustering_output_folder, nb_cpu, clust_threshold, mmseqs_options, linclust, remove_tmp)
+    make_clustering(proteomes_output_folder, clustering_output_folder, nb_cpu, clust_threshold, mmseqs_options, linclust, remove_tmp,
+                    nested_clustering)
 
     annotation_output_folder = os.path.join(output_folder, '2_annotation')
     annotate_proteins(clustering_output_folder, annotation_output_folder, uniprot_sparql_endpoint, propagate_annotation,
@@ -146,6 +154,7 @@ def perform_workflow(input_file, output_folder, busco_percentage_keep=80, ignore
     workflow_metadata['proteomes_metadata'] = proteomes_metadata
     workflow_metadata['clustering_metadata'] = clustering_metadata
     workflow_metadata['annotation_metadata'] = annotation_metadata
+    workflow_metadata['taxonomy_cache_statistics'] = log_taxonomy_cache_statistics('workflow')
 
     endtime = time.time()
     duration = endtime - starttime
@@ -169,7 +178,8 @@ def perform_workflow_eggnog(input_file, output_folder, eggnog_database_path, bus
                             remove_tmp=None, limit_maximal_number_proteomes=99, rank_limit=None,
                             nb_cpu=1, clust_threshold=0.5, mmseqs_options=None,
                             linclust=None, minimal_number_proteomes=5, update_affiliations=None,
-                            option_bioservices=None, eggnog_tmp_dir=None):
+                            option_bioservices=None, eggnog_tmp_dir=None, subtree_rank=None,
+                            proteome_cache_file=None, proteome_store_folder=None, nested_clustering=None):
     """From the proteomes found by esmecata proteomes, create protein cluster for each taxonomic affiliations.
 
     Args:
@@ -191,6 +201,10 @@ def perform_workflow_eggnog(input_file, output_folder, eggnog_database_path, bus
         update_affiliations (str): option to update taxonomic affiliations.
         option_bioservices (bool): use bioservices instead of manual queries.
         eggnog_tmp_dir (str): pathname to eggnog-mapper temporary folder.
+        subtree_rank (str): fetch the proteomes of the taxa at this rank (such as family) once and resolve the proteomes of their lower taxa locally.
+        proteome_cache_file (str): pathname to a SQLite file storing the answers of the proteome queries between runs.
+        proteome_store_folder (str): pathname to a folder storing the proteomes shared between runs, linked in the output folder instead of being downloaded again.
+        nested_clustering (bool): cluster only the taxa not nested in another taxon, the clusters of nested taxa are derived from them.
     """
     starttime = time.time()
     logger.info('|EsMeCaTa|workflow| Begin workflow.')
@@ -203,10 +217,12 @@ def perform_workflow_eggnog(input_file, output_folder, eggnog_database_path, bus
     retrieve_proteomes(input_file, proteomes_output_folder, busco_percentage_keep,
                         ignore_taxadb_update, all_proteomes, uniprot_sparql_endpoint,
                         limit_maximal_number_proteomes, rank_limit, minimal_number_proteomes,
-                        update_affiliations, option_bioservices)
+                        update_affiliations, option_bioservices, subtree_rank, proteome_cache_file,
+                        proteome_store_folder)
 
     clustering_output_folder = os.path.join(output_folder, '1_clustering')
-    make_clustering(proteomes_output_folder, clustering_output_folder, nb_cpu, clust_threshold, mmseqs_options, linclust, remove_tmp)
+    make_clustering(proteomes_output_folder, clustering_output_folder, nb_cpu, clust_threshold, mmseqs_options, linclust, remove_tmp,
+                    nested_clustering)
 
     annotation_output_folder = os.path.join(output_folder, '2_annotation')
     annotate_with_eggnog(clustering_output_folder, annotation_output_folder, eggnog_database_path, nb_cpu, eggnog_tmp_dir)
@@ -227,6 +243,7 @@ def perform_workflow_eggnog(input_file, output_folder, eggnog_database_path, bus
     workflow_metadata['proteomes_metadata'] = proteomes_metadata
     workflow_metadata['clustering_metadata'] = clustering_metadata
     workflow_metadata['annotation_metadata'] = annotation_metadata
+    workflow_metadata['taxonomy_cache_statistics'] = log_taxonomy_cache_statistics('workflow')
 
     endtime = time.time()
     duration = endtime - starttime
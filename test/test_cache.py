@@ -0,0 +1,142 @@
+import errno
+import gzip
+import os
+import shutil
+import time
+
+import esmecata.proteomes
+from esmecata.cache import ProteomeMetadataCache, ProteomeStore, compute_file_checksum
+
+
+def test_proteome_metadata_cache():
+    cache_file = 'proteome_cache_test.db'
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+
+    query_options = {'query_system': 'rest', 'busco_percentage_keep': 80, 'all_proteomes': None, 'minimal_number_proteomes': 1}
+    answer = [['UP000000815'], {'214092': ['UP000000815']}, [['UP000000815', 99.0, 'full', '214092', True, None]]]
+
+    proteome_cache = ProteomeMetadataCache(cache_file)
+    assert proteome_cache.get(629, query_options, '2024_01') is None
+    proteome_cache.put(629, query_options, '2024_01', answer)
+    assert proteome_cache.get(629, query_options, '2024_01') == answer
+    # Answers depend on the query options and the UniProt release.
+    assert proteome_cache.get(629, dict(query_options, all_proteomes=True), '2024_01') is None
+    assert proteome_cache.get(629, query_options, '2024_02') is None
+    assert proteome_cache.cache_statistics() == {'hits': 1, 'misses': 3, 'size': 1}
+
+    release_queries = []
+    def release_function():
+        release_queries.append(1)
+        return '2024_01'
+    assert proteome_cache.get_uniprot_release('rest', release_function) == '2024_01'
+    assert proteome_cache.get_uniprot_release('rest', release_function) == '2024_01'
+    assert len(release_queries) == 1
+
+    # Entries are shared with another cache object and removed when they are too old or too numerous.
+    proteome_cache.put(632, query_options, '2024_01', answer)
+    time.sleep(0.01)
+    proteome_cache.get(629, query_options, '2024_01')
+    proteome_cache.close()
+    proteome_cache = ProteomeMetadataCache(cache_file, max_entries=1)
+    assert proteome_cache.get(632, query_options, '2024_01') is None
+    assert proteome_cache.get(629, query_options, '2024_01') == answer
+    proteome_cache.close()
+    proteome_cache = ProteomeMetadataCache(cache_file, max_age=0)
+    assert proteome_cache.cache_statistics()['size'] == 0
+    proteome_cache.close()
+
+    os.remove(cache_file)
+
+
+def test_proteome_store():
+    output_folder = 'proteome_store_output'
+    if os.path.exists(output_folder):
+        shutil.rmtree(output_folder)
+    run_folders = [os.path.join(output_folder, 'run_1'), os.path.join(output_folder, 'run_2')]
+    for run_folder in run_folders:
+        os.makedirs(run_folder)
+    store_folder = os.path.join(output_folder, 'store')
+
+    proteome_file = os.path.join(run_folders[0], 'UP000000815.faa.gz')
+    with gzip.open(proteome_file, 'wt') as output_file:
+        output_file.write('>sp|Q0WJV8|Y1400_YERPE\nMTTIVSVRRNGHVVIAGDGQ\n')
+
+    proteome_store = ProteomeStore(store_folder)
+    proteome_store.add('UP000000815', '2024_01', proteome_file)
+
+    # Proteomes are linked for the same UniProt release.
+    linked_proteome_file = os.path.join(run_folders[1], 'UP000000815.faa.gz')
+    assert proteome_store.link('UP000000815', '2024_02', linked_proteome_file) is False
+    assert proteome_store.link('UP000000815', '2024_01', linked_proteome_file) is True
+    with gzip.open(linked_proteome_file, 'rt') as input_file:
+        assert input_file.read() == '>sp|Q0WJV8|Y1400_YERPE\nMTTIVSVRRNGHVVIAGDGQ\n'
+    assert proteome_store.cache_statistics()['hits'] == 1
+
+    # Proteomes are removed from the store when it is too big but they stay in the run folders.
+    proteome_store.max_size = 0
+    assert proteome_store.evict() == 1
+    assert proteome_store.link('UP000000815', '2024_01', os.path.join(output_folder, 'UP000000815.faa.gz')) is False
+    assert os.path.exists(linked_proteome_file)
+    proteome_store.close()
+
+    shutil.rmtree(output_folder)
+
+
+def test_proteome_store_evict_rerun(monkeypatch):
+    output_folder = 'proteome_store_rerun_output'
+    if os.path.exists(output_folder):
+        shutil.rmtree(output_folder)
+    proteomes_folder = os.path.join(output_folder, 'run', 'proteomes')
+    os.makedirs(proteomes_folder)
+    store_folder = os.path.join(output_folder, 'store')
+
+    proteome_file = os.path.join(output_folder, 'UP000000815.faa.gz')
+    with gzip.open(proteome_file, 'wt') as output_file:
+        output_file.write('>sp|Q0WJV8|Y1400_YERPE\nMTTIVSVRRNGHVVIAGDGQ\n')
+    proteome_store = ProteomeStore(store_folder)
+    proteome_store.add('UP000000815', '2024_01', proteome_file)
+
+    # Store on another file system: the proteome is copied and stays in the run folder after its eviction.
+    real_link = os.link
+    def cross_device_link(source, destination):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'link', cross_device_link)
+    copied_proteome_file = os.path.join(output_folder, 'UP000000815_copy.faa.gz')
+    assert proteome_store.link('UP000000815', '2024_01', copied_proteome_file) is True
+    monkeypatch.setattr(os, 'link', real_link)
+    object_path = os.path.abspath(proteome_store._object_path(compute_file_checksum(proteome_file)))
+    proteome_store.max_size = 0
+    assert proteome_store.evict() == 1
+    proteome_store.close()
+    assert not os.path.islink(copied_proteome_file)
+    with gzip.open(copied_proteome_file, 'rt') as input_file:
+        assert input_file.read() == '>sp|Q0WJV8|Y1400_YERPE\nMTTIVSVRRNGHVVIAGDGQ\n'
+
+    # Symbolic link to the evicted proteome left in the run folder by a previous version, the proteome is downloaded again by the next run.
+    os.symlink(object_path, os.path.join(proteomes_folder, 'UP000000815.faa.gz'))
+    downloaded_proteomes = []
+    def fake_download_proteomes(proteome_to_download, proteomes_folder, session, uniprot_sparql_endpoint, option_bioservices):
+        for proteome in proteome_to_download:
+            downloaded_proteomes.append(proteome)
+            shutil.copyfile(proteome_file, os.path.join(proteomes_folder, proteome+'.faa.gz'))
+        return [], {'resumed_downloads': 0, 'resumed_bytes': 0, 'redownloaded_bytes': 0}
+    monkeypatch.setattr(esmecata.proteomes, 'check_proteomes', lambda *args: ({'UP000000815'}, None))
+    monkeypatch.setattr(esmecata.proteomes, 'get_uniprot_release_number', lambda uniprot_sparql_endpoint: '2024_01')
+    monkeypatch.setattr(esmecata.proteomes, 'download_proteomes', fake_download_proteomes)
+    monkeypatch.setattr(esmecata.proteomes, 'get_rest_uniprot_release', lambda options: {})
+    monkeypatch.setattr(esmecata.proteomes, 'compute_stat_proteomes', lambda output_folder, stat_file: None)
+    esmecata.proteomes.retrieve_proteomes('buchnera_workflow.tsv', os.path.join(output_folder, 'run'), proteome_store_folder=store_folder)
+
+    assert downloaded_proteomes == ['UP000000815']
+    proteome_file_run = os.path.join(proteomes_folder, 'UP000000815.faa.gz')
+    assert not os.path.islink(proteome_file_run)
+    with gzip.open(proteome_file_run, 'rt') as input_file:
+        assert input_file.read() == '>sp|Q0WJV8|Y1400_YERPE\nMTTIVSVRRNGHVVIAGDGQ\n'
+
+    shutil.rmtree(output_folder)
+
+
+if __name__ == "__main__":
+    test_proteome_metadata_cache()
+    test_proteome_store()
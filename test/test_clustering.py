@@ -1,13 +1,28 @@
 import csv
+import gzip
+import json
 import os
 import shutil
 import subprocess
-from esmecata.clustering import make_clustering, filter_protein_cluster, compute_proteome_representativeness_ratio
+import esmecata.clustering
+from Bio import SeqIO
+from esmecata.clustering import make_clustering, filter_protein_cluster, compute_proteome_representativeness_ratio, schedule_taxa_clustering, \
+    compute_clustering_key, reuse_taxon_clustering, find_nested_taxa, derive_nested_taxon_clustering, create_proteomes_mmseqs_db, \
+    create_taxon_mmseqs_db, write_mmseqs_clustering_options, has_mmseqs_clustering_options
+from esmecata.utils import create_proteome_accession_index, ProteomeAccessionIndex, scan_fasta_accessions
 
 RESULTS = {
     'Cluster_1': {'Number_shared_proteins': 604}
 }
 
+
+def copy_clustering_input(input_folder):
+    # Accession files are written next to the proteomes when they are read, so tests reading proteomes use a copy of the input folder.
+    if os.path.exists(input_folder):
+        shutil.rmtree(input_folder)
+    shutil.copytree('clustering_input', input_folder)
+
+
 def test_filter_protein_cluster():
     output_folder = 'output'
     remove_output_folder = False
@@ -18,11 +33,13 @@ def test_filter_protein_cluster():
         os.mkdir(os.path.join(output_folder, 'reference_proteins'))
         os.mkdir(os.path.join(output_folder, 'cluster_founds'))
 
+    input_folder = 'filter_protein_cluster_input'
+    copy_clustering_input(input_folder)
     observation_name = 'Cluster_1'
     protein_clusters = {'Q89AE4': ['Q89AE4', 'P57473'],
                         'Q89AY7': ['Q89AY7']}
-    observation_name_proteomes = [os.path.join('clustering_input', 'proteomes', 'UP000000601.faa.gz'),
-                                os.path.join('clustering_input', 'proteomes', 'UP000001806.faa.gz')]
+    observation_name_proteomes = [os.path.join(input_folder, 'proteomes', 'UP000000601.faa.gz'),
+                                os.path.join(input_folder, 'proteomes', 'UP000001806.faa.gz')]
     clust_threshold = 0.95
 
     expected_protein = {'Q89AE4'}
@@ -32,6 +49,7 @@ def test_filter_protein_cluster():
                             clust_threshold)
     
     assert expected_protein == protein_cluster_to_keeps
+    assert os.path.exists(os.path.join(input_folder, 'proteomes', 'UP000000601.accessions'))
 
     clust_threshold = 0
     expected_protein = {'Q89AE4', 'Q89AY7'}
@@ -42,11 +60,252 @@ def test_filter_protein_cluster():
 
     if remove_output_folder is True:
         shutil.rmtree(output_folder)
+    shutil.rmtree(input_folder)
+
+
+def test_proteome_accession_index():
+    index_file = 'proteome_accession_index.bin'
+    input_folder = 'proteome_accession_index_input'
+    copy_clustering_input(input_folder)
+    observation_name_proteomes = [os.path.join(input_folder, 'proteomes', 'UP000000601.faa.gz'),
+                                os.path.join(input_folder, 'proteomes', 'UP000001806.faa.gz')]
+    create_proteome_accession_index(index_file, observation_name_proteomes)
+
+    proteome_accession_index = ProteomeAccessionIndex(index_file)
+    assert proteome_accession_index.proteomes == ['UP000000601', 'UP000001806']
+    assert proteome_accession_index.is_up_to_date(observation_name_proteomes)
+    proteome_codes = proteome_accession_index.get_proteome_codes(['Q89AE4', 'P57473', 'UNKNOWN'])
+    assert proteome_codes.tolist() == [0, 1, -1]
+    proteome_codes = proteome_accession_index.get_proteome_codes(['Q89AE4', 'P57473'], ['UP000000601'])
+    assert proteome_codes.tolist() == [0, -1]
+
+    protein_clusters = {'Q89AE4': ['Q89AE4', 'P57473'],
+                        'Q89AY7': ['Q89AY7']}
+    number_proteomes, rep_prot_organims, computed_threshold_cluster = compute_proteome_representativeness_ratio(protein_clusters, observation_name_proteomes,
+                                                                                                                proteome_accession_index=proteome_accession_index)
+    assert number_proteomes == 2
+    assert rep_prot_organims == {'Q89AE4': {'UP000000601', 'UP000001806'}, 'Q89AY7': {'UP000000601'}}
+    assert computed_threshold_cluster == {'Q89AE4': 1, 'Q89AY7': 0.5}
+
+    proteome_accession_index.close()
+    os.remove(index_file)
+    shutil.rmtree(input_folder)
+
+
+def test_schedule_taxa_clustering():
+    proteomes_folder = os.path.join('clustering_input', 'proteomes')
+    taxa_proteomes = {'taxon_1': [os.path.join(proteomes_folder, 'UP000000601.faa.gz')],
+                      'taxon_2': [os.path.join(proteomes_folder, 'UP000001806.faa.gz')],
+                      'taxon_3': [os.path.join(proteomes_folder, 'UP000000601.faa.gz'), os.path.join(proteomes_folder, 'UP000001806.faa.gz')]}
+    clustered_taxa = {}
+    def clustering_function(tax_name, proteome_files, nb_threads):
+        clustered_taxa[tax_name] = (proteome_files, nb_threads)
+
+    taxa_threads = schedule_taxa_clustering(taxa_proteomes, 4, clustering_function)
+    assert set(clustered_taxa) == set(taxa_proteomes)
+    for tax_name in taxa_proteomes:
+        assert clustered_taxa[tax_name] == (taxa_proteomes[tax_name], taxa_threads[tax_name])
+    # The largest taxon is started first and shares the free CPUs with the waiting taxa.
+    assert taxa_threads['taxon_3'] == 1
+    assert sum(taxa_threads.values()) <= 4
+
+    taxa_threads = schedule_taxa_clustering({'taxon_3': taxa_proteomes['taxon_3']}, 4, clustering_function)
+    assert taxa_threads == {'taxon_3': 4}
+
+
+def test_reuse_taxon_clustering():
+    input_folder = 'clustering_reuse_input'
+    copy_clustering_input(input_folder)
+    proteomes = [os.path.join(input_folder, 'proteomes', 'UP000000601.faa.gz'), os.path.join(input_folder, 'proteomes', 'UP000001806.faa.gz')]
+    clustering_key = compute_clustering_key(proteomes, 0.5, None, False)
+    assert clustering_key == compute_clustering_key(proteomes[::-1], 0.5, '', False)
+    assert clustering_key != compute_clustering_key(proteomes[:1], 0.5, None, False)
+    assert clustering_key != compute_clustering_key(proteomes, 0.95, None, False)
+    assert clustering_key != compute_clustering_key(proteomes, 0.5, '--min-seq-id 0.5', False)
+    assert clustering_key != compute_clustering_key(proteomes, 0.5, None, True)
+    # Proteome downloaded again with a new content.
+    shutil.copyfile(proteomes[0], proteomes[1])
+    assert clustering_key != compute_clustering_key(proteomes, 0.5, None, False)
+    shutil.rmtree(input_folder)
+
+    output_folder = 'clustering_reuse_output'
+    result_files = {'cluster_founds': '.tsv', 'computed_threshold': '.tsv', 'reference_proteins': '.tsv',
+                    'reference_proteins_representative_fasta': '.faa'}
+    for result_folder_name, file_extension in result_files.items():
+        os.makedirs(os.path.join(output_folder, result_folder_name))
+        with open(os.path.join(output_folder, result_folder_name, 'Buchnera_aphidicola'+file_extension), 'w') as open_file:
+            open_file.write(result_folder_name)
+    os.makedirs(os.path.join(output_folder, 'reference_proteins_consensus_fasta'))
+
+    reuse_taxon_clustering(output_folder, 'Buchnera aphidicola', 'Buchnera sp')
+    for result_folder_name, file_extension in result_files.items():
+        with open(os.path.join(output_folder, result_folder_name, 'Buchnera_sp'+file_extension), 'r') as open_file:
+            assert open_file.read() == result_folder_name
+    assert not os.path.exists(os.path.join(output_folder, 'reference_proteins_consensus_fasta', 'Buchnera_sp.faa'))
+
+    shutil.rmtree(output_folder)
+
+
+def test_find_nested_taxa():
+    taxa_proteomes = {'genus_1': ['UP1', 'UP2'], 'species_1': ['UP1'], 'genus_2': ['UP2', 'UP3']}
+    assert find_nested_taxa(taxa_proteomes) == {'species_1': 'genus_1'}
+    taxa_proteomes['family_1'] = ['UP1', 'UP2', 'UP3']
+    assert find_nested_taxa(taxa_proteomes) == {'species_1': 'family_1', 'genus_1': 'family_1', 'genus_2': 'family_1'}
+
+
+def test_derive_nested_taxon_clustering():
+    output_folder = 'nested_clustering_output'
+    for result_folder_name in ['cluster_founds', 'computed_threshold', 'reference_proteins', 'reference_proteins_representative_fasta',
+                               'reference_proteins_consensus_fasta', os.path.join('mmseqs_tmp', 'Buchnera_aphidicola')]:
+        os.makedirs(os.path.join(output_folder, result_folder_name))
+    # P57500 and P56933 are proteins of UP000001806, P59419 and P59474 are proteins of UP000000601.
+    with open(os.path.join(output_folder, 'cluster_founds', 'Buchnera_aphidicola.tsv'), 'w') as open_file:
+        csvwriter = csv.writer(open_file, delimiter='\t')
+        csvwriter.writerow(['P57500', 'P57500', 'P59419'])
+        csvwriter.writerow(['P56933', 'P56933'])
+        csvwriter.writerow(['P59474', 'P59474'])
+    for fasta_suffix in ['_rep_seq.fasta', '_con_seq.fasta']:
+        with open(os.path.join(output_folder, 'mmseqs_tmp', 'Buchnera_aphidicola', 'cluster'+fasta_suffix), 'w') as open_file:
+            for protein in ['P57500', 'P56933', 'P59474']:
+                open_file.write('>sp|{0}|PROT\nMAAAA\n'.format(protein))
+
+    input_folder = 'nested_clustering_input'
+    copy_clustering_input(input_folder)
+    proteomes = [os.path.join(input_folder, 'proteomes', 'UP000000601.faa.gz')]
+    derive_nested_taxon_clustering(output_folder, 'Buchnera aphidicola', 'Buchnera sp', proteomes, 1)
+
+    with open(os.path.join(output_folder, 'reference_proteins', 'Buchnera_sp.tsv'), 'r') as open_file:
+        assert list(csv.reader(open_file, delimiter='\t')) == [['P57500', 'P59419'], ['P59474', 'P59474']]
+    for fasta_folder in ['reference_proteins_representative_fasta', 'reference_proteins_consensus_fasta']:
+        with open(os.path.join(output_folder, fasta_folder, 'Buchnera_sp.faa'), 'r') as open_file:
+            assert [line.split('|')[1] for line in open_file if line.startswith('>')] == ['P57500', 'P59474']
+
+    shutil.rmtree(output_folder)
+    shutil.rmtree(input_folder)
+
+
+def test_create_proteomes_mmseqs_db(monkeypatch):
+    output_folder = 'proteomes_mmseqs_db_output'
+    proteomes_folder = os.path.join(output_folder, 'proteomes')
+    os.makedirs(proteomes_folder)
+    proteome_files = [os.path.join(proteomes_folder, 'UP000000002.faa.gz'), os.path.join(proteomes_folder, 'UP000000001.faa.gz')]
+    for proteome_file in proteome_files:
+        with open(proteome_file, 'w') as open_file:
+            open_file.write('proteome')
+    mmseqs_db_path = os.path.join(output_folder, 'mmseqs_db')
+
+    # mmseqs createdb writes a lookup file with the key, the accession and the file number of each protein.
+    createdb_commands = []
+    def fake_createdb(command):
+        createdb_commands.append(command)
+        with open(command[-3] + '.lookup', 'w') as open_file:
+            for db_key, file_number in enumerate([1, 0, 1, 0, 1]):
+                open_file.write('{0}\tP{0}\t{1}\n'.format(db_key, file_number))
+        return 0
+    monkeypatch.setattr(esmecata.clustering.subprocess, 'call', fake_createdb)
+
+    mmseqs_proteomes_db, proteome_db_keys = create_proteomes_mmseqs_db(proteome_files, mmseqs_db_path)
+    assert mmseqs_proteomes_db == os.path.join(mmseqs_db_path, 'proteomes_db')
+    # Proteomes are given to createdb sorted, their file numbers follow this order.
+    assert createdb_commands[0][2:4] == sorted(proteome_files)
+    assert {proteome_file: db_keys.tolist() for proteome_file, db_keys in proteome_db_keys.items()} == {proteome_files[1]: [1, 3], proteome_files[0]: [0, 2, 4]}
+
+    # The database is reused for the same proteomes.
+    _, proteome_db_keys = create_proteomes_mmseqs_db(proteome_files[::-1], mmseqs_db_path)
+    assert len(createdb_commands) == 1
+    assert proteome_db_keys[proteome_files[0]].tolist() == [0, 2, 4]
+
+    # A proteome has been downloaded again, the database is created again.
+    with open(proteome_files[0], 'w') as open_file:
+        open_file.write('new proteome')
+    create_proteomes_mmseqs_db(proteome_files, mmseqs_db_path)
+    assert len(createdb_commands) == 2
+
+    shutil.rmtree(output_folder)
+
+
+def fake_mmseqs(command):
+    # Emulate mmseqs createdb and createsubdb with text databases (key and value by line).
+    if command[1] == 'createdb':
+        mmseqs_db = command[-3]
+        with open(mmseqs_db, 'w') as open_db, open(mmseqs_db + '_h', 'w') as open_header_db, \
+                open(mmseqs_db + '.lookup', 'w') as open_lookup, open(mmseqs_db + '.source', 'w') as open_source:
+            db_key = 0
+            for file_number, proteome_file in enumerate(command[2:-3]):
+                open_source.write('{0}\t{1}\n'.format(file_number, os.path.basename(proteome_file)))
+                with gzip.open(proteome_file, 'rt') as open_proteome:
+                    for record in SeqIO.parse(open_proteome, 'fasta'):
+                        open_db.write('{0}\t{1}\n'.format(db_key, record.seq))
+                        open_header_db.write('{0}\t{1}\n'.format(db_key, record.id))
+                        open_lookup.write('{0}\t{1}\t{2}\n'.format(db_key, record.id.split('|')[1], file_number))
+                        db_key += 1
+    elif command[1] == 'createsubdb':
+        keys_file, input_db, output_db = command[2:5]
+        with open(keys_file, 'r') as open_keys:
+            db_keys = set(open_keys.read().split())
+        with open(input_db, 'r') as open_input_db, open(output_db, 'w') as open_output_db:
+            for line in open_input_db:
+                if line.split('\t')[0] in db_keys:
+                    open_output_db.write(line)
+        # Like mmseqs, the other files of the input database are linked.
+        for mmseqs_db_suffix in ['_h', '.lookup', '.source']:
+            if os.path.exists(input_db + mmseqs_db_suffix) and not os.path.exists(output_db + mmseqs_db_suffix):
+                os.symlink(os.path.abspath(input_db + mmseqs_db_suffix), output_db + mmseqs_db_suffix)
+    return 0
+
+
+def test_create_taxon_mmseqs_db(monkeypatch):
+    monkeypatch.setattr(esmecata.clustering.subprocess, 'call', fake_mmseqs)
+    output_folder = 'taxon_mmseqs_db_output'
+    proteomes_folder = os.path.join(output_folder, 'proteomes')
+    os.makedirs(proteomes_folder)
+    proteome_proteins = {'UP000000001': ['P1A', 'P1B'], 'UP000000002': ['P2A', 'P2B'], 'UP000000003': ['P3A']}
+    proteome_files = {}
+    for proteome, proteins in proteome_proteins.items():
+        proteome_files[proteome] = os.path.join(proteomes_folder, proteome+'.faa.gz')
+        with gzip.open(proteome_files[proteome], 'wt') as open_file:
+            for protein in proteins:
+                open_file.write('>sp|{0}|PROT\nMAAAA\n'.format(protein))
+    mmseqs_db_path = os.path.join(output_folder, 'mmseqs_db')
+    mmseqs_tmp_cluster = os.path.join(output_folder, 'mmseqs_tmp', 'taxon')
+    os.makedirs(mmseqs_tmp_cluster)
+    mmseqs_tmp_db = os.path.join(mmseqs_tmp_cluster, 'db')
+
+    mmseqs_proteomes_db, proteome_db_keys = create_proteomes_mmseqs_db([proteome_files['UP000000002'], proteome_files['UP000000003']], mmseqs_db_path)
+    create_taxon_mmseqs_db(mmseqs_tmp_cluster, mmseqs_tmp_db, [proteome_files['UP000000003']], mmseqs_proteomes_db, proteome_db_keys)
+    # The database of all proteomes is created again with a new proteome, the keys of the proteins change.
+    create_proteomes_mmseqs_db(list(proteome_files.values()), mmseqs_db_path)
+
+    taxon_db_files = {}
+    for mmseqs_db_suffix in ['', '_h', '.lookup']:
+        assert not os.path.islink(mmseqs_tmp_db + mmseqs_db_suffix)
+        with open(mmseqs_tmp_db + mmseqs_db_suffix, 'r') as open_file:
+            taxon_db_files[mmseqs_db_suffix] = open_file.read()
+    shutil.rmtree(output_folder)
+
+    assert taxon_db_files == {'': '2\tMAAAA\n', '_h': '2\tsp|P3A|PROT\n', '.lookup': '2\tP3A\t1\n'}
+
+
+def test_mmseqs_clustering_options():
+    mmseqs_tmp_cluster = 'mmseqs_clustering_options_output'
+    os.mkdir(mmseqs_tmp_cluster)
+    # Clustering made before the options were stored, it can not be updated.
+    assert has_mmseqs_clustering_options(mmseqs_tmp_cluster, None, None) is False
+
+    write_mmseqs_clustering_options(mmseqs_tmp_cluster, None, None)
+    assert has_mmseqs_clustering_options(mmseqs_tmp_cluster, '', False) is True
+    assert has_mmseqs_clustering_options(mmseqs_tmp_cluster, '--min-seq-id 0.3 -c 0.8', False) is True
+    assert has_mmseqs_clustering_options(mmseqs_tmp_cluster, '--min-seq-id 0.5 -c 0.8', False) is False
+    assert has_mmseqs_clustering_options(mmseqs_tmp_cluster, None, True) is False
+
+    shutil.rmtree(mmseqs_tmp_cluster)
 
 
 def test_make_clustering():
+    input_folder = 'make_clustering_input'
     output_folder = 'clustering_output'
-    make_clustering('clustering_input', output_folder, nb_cpu=1, clust_threshold=0.5, mmseqs_options=None, linclust=None, remove_tmp=None)
+    copy_clustering_input(input_folder)
+    make_clustering(input_folder, output_folder, nb_cpu=1, clust_threshold=0.5, mmseqs_options=None, linclust=None, remove_tmp=None)
 
     expected_results = {}
     output_stat_file = os.path.join(output_folder, 'stat_number_clustering.tsv')
@@ -61,12 +320,88 @@ def test_make_clustering():
         for data in expected_results[observation_name]:
             assert expected_results[observation_name][data] == RESULTS[observation_name][data]
 
+    shutil.rmtree(input_folder)
+    shutil.rmtree(output_folder)
+
+
+def test_make_clustering_update():
+    input_folder = 'clustering_update_input'
+    output_folder = 'clustering_update_output'
+    copy_clustering_input(input_folder)
+    proteome_tax_id_file = os.path.join(input_folder, 'proteome_tax_id.tsv')
+    with open(proteome_tax_id_file, 'r') as open_file:
+        proteome_tax_id_rows = list(csv.reader(open_file, delimiter='\t'))
+
+    # First clustering with one proteome, then the clustering is updated with the new proteome.
+    with open(proteome_tax_id_file, 'w') as open_file:
+        csvwriter = csv.writer(open_file, delimiter='\t')
+        csvwriter.writerow(proteome_tax_id_rows[0])
+        csvwriter.writerow(proteome_tax_id_rows[1][:-1] + ['UP000001806'])
+    make_clustering(input_folder, output_folder, nb_cpu=1, clust_threshold=0.5, mmseqs_options=None, linclust=None, remove_tmp=None)
+    with open(os.path.join(output_folder, 'cluster_founds', 'Buchnera_aphidicola.tsv'), 'r') as open_file:
+        previous_clusters = {row[0]: set(row[1:]) for row in csv.reader(open_file, delimiter='\t')}
+
+    with open(proteome_tax_id_file, 'w') as open_file:
+        csvwriter = csv.writer(open_file, delimiter='\t')
+        csvwriter.writerows(proteome_tax_id_rows)
+    make_clustering(input_folder, output_folder, nb_cpu=1, clust_threshold=0.5, mmseqs_options=None, linclust=None, remove_tmp=None)
+
+    with open(os.path.join(output_folder, 'esmecata_metadata_clustering_1.json'), 'r') as open_file:
+        assert json.load(open_file)['updated_clustering'] == ['Buchnera aphidicola']
+
+    # The previous clusters are kept (same representatives and proteins) and the proteins of the new proteome are added.
+    with open(os.path.join(output_folder, 'cluster_founds', 'Buchnera_aphidicola.tsv'), 'r') as open_file:
+        updated_clusters = {row[0]: set(row[1:]) for row in csv.reader(open_file, delimiter='\t')}
+    for representative_protein, cluster_proteins in previous_clusters.items():
+        assert cluster_proteins.issubset(updated_clusters[representative_protein])
+    updated_cluster_proteins = set().union(*updated_clusters.values())
+    assert set(scan_fasta_accessions(os.path.join(input_folder, 'proteomes', 'UP000000601.faa.gz'))).issubset(updated_cluster_proteins)
+
+    cluster_proteomes = set()
+    with open(os.path.join(output_folder, 'computed_threshold', 'Buchnera_aphidicola.tsv'), 'r') as open_file:
+        csvreader = csv.DictReader(open_file, delimiter='\t')
+        for line in csvreader:
+            cluster_proteomes.update(line['proteomes'].split(','))
+    assert cluster_proteomes == {'UP000000601', 'UP000001806'}
+
+    shutil.rmtree(input_folder)
+    shutil.rmtree(output_folder)
+
+
+def test_make_clustering_update_options():
+    input_folder = 'clustering_update_options_input'
+    output_folder = 'clustering_update_options_output'
+    copy_clustering_input(input_folder)
+    proteome_tax_id_file = os.path.join(input_folder, 'proteome_tax_id.tsv')
+    with open(proteome_tax_id_file, 'r') as open_file:
+        proteome_tax_id_rows = list(csv.reader(open_file, delimiter='\t'))
+
+    with open(proteome_tax_id_file, 'w') as open_file:
+        csvwriter = csv.writer(open_file, delimiter='\t')
+        csvwriter.writerow(proteome_tax_id_rows[0])
+        csvwriter.writerow(proteome_tax_id_rows[1][:-1] + ['UP000001806'])
+    make_clustering(input_folder, output_folder, nb_cpu=1, clust_threshold=0.5, mmseqs_options=None, linclust=None, remove_tmp=None)
+
+    # New proteome but other mmseqs options: the taxon is clustered again instead of being updated.
+    with open(proteome_tax_id_file, 'w') as open_file:
+        csvwriter = csv.writer(open_file, delimiter='\t')
+        csvwriter.writerows(proteome_tax_id_rows)
+    make_clustering(input_folder, output_folder, nb_cpu=1, clust_threshold=0.5, mmseqs_options='--min-seq-id 0.5 -c 0.8', linclust=None, remove_tmp=None)
+
+    with open(os.path.join(output_folder, 'esmecata_metadata_clustering_1.json'), 'r') as open_file:
+        assert json.load(open_file)['updated_clustering'] == []
+    with open(os.path.join(output_folder, 'mmseqs_tmp', 'Buchnera_aphidicola', 'clustering_options.json'), 'r') as open_file:
+        assert json.load(open_file)['mmseqs_options'] == ['--min-seq-id', '0.5', '-c', '0.8']
+
+    shutil.rmtree(input_folder)
     shutil.rmtree(output_folder)
 
 
 def test_clustering_cli():
+    input_folder = 'clustering_cli_input'
     output_folder = 'clustering_output'
-    subprocess.call(['esmecata', 'clustering', '-i', 'clustering_input', '-o', output_folder, '-c', '1', '-t', '0.5'])
+    copy_clustering_input(input_folder)
+    subprocess.call(['esmecata', 'clustering', '-i', input_folder, '-o', output_folder, '-c', '1', '-t', '0.5'])
     expected_results = {}
     output_stat_file = os.path.join(output_folder, 'stat_number_clustering.tsv')
     with open(output_stat_file, 'r') as stat_file_read:
@@ -80,6 +415,7 @@ def test_clustering_cli():
         for data in expected_results[observation_name]:
             assert expected_results[observation_name][data] == RESULTS[observation_name][data]
 
+    shutil.rmtree(input_folder)
     shutil.rmtree(output_folder)
 
 
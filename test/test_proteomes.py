@@ -1,5 +1,9 @@
 import csv
+import gzip
+import io
+import json
 import os
+import requests
 import shutil
 import subprocess
 import time
@@ -7,10 +11,16 @@ import time
 from collections import OrderedDict, Counter
 from ete3 import NCBITaxa
 
+import esmecata.proteomes
 from esmecata.proteomes import taxonomic_affiliation_to_taxon_id, associate_taxon_to_taxon_id, \
                                 disambiguate_taxon, find_proteomes_tax_ids, filter_rank_limit, \
-                                rest_query_proteomes, sparql_query_proteomes, subsampling_proteomes, \
-                                update_taxonomy
+                                rest_query_proteomes, sparql_query_proteomes, sparql_query_proteomes_batch, subsampling_proteomes, \
+                                update_taxonomy, translate_taxon_names, group_identical_affiliations, \
+                                expand_to_observations, check_proteome_file, iter_json_results, create_cost_plan, get_batch, \
+                                find_subtree_taxa, select_proteomes, get_organism_lineages, \
+                                download_proteomes, retrieve_proteomes, sparql_download_proteomes, get_proteome_protein_counts
+import esmecata.utils
+from esmecata.utils import stream_uniprot_sparql_query
 
 TAXONOMIES = {'id_1': 'cellular organisms;Bacteria;Proteobacteria;Gammaproteobacteria;Enterobacterales;Yersiniaceae;Yersinia;species not found'}
 
@@ -26,6 +36,17 @@ def test_taxonomic_affiliation_to_taxon_id():
         assert expected_json_taxonomic_affiliations[taxon] == taxon_ids[taxon]
 
 
+def test_translate_taxon_names():
+    ncbi = NCBITaxa()
+    taxon_names = ['Bacteria', 'Yersinia', 'Bacteria', 'yersinia', 'species not found']
+    expected_tax_names_to_ids = {'Bacteria': [2], 'Yersinia': [629, 444888], 'yersinia': [629, 444888]}
+
+    tax_names_to_ids = translate_taxon_names(taxon_names, ncbi, chunk_size=1)
+    assert 'species not found' not in tax_names_to_ids
+    for taxon in expected_tax_names_to_ids:
+        assert set(expected_tax_names_to_ids[taxon]) == set(tax_names_to_ids[taxon])
+
+
 def test_associate_taxon_to_taxon_id():
     ncbi = NCBITaxa()
     update_affiliations = None
@@ -50,6 +71,18 @@ def test_disambiguate_taxon():
         assert expected_json_taxonomic_affiliations[taxon] == json_taxonomic_affiliations[taxon]
 
 
+def test_disambiguate_taxon_multiple_observations():
+    ncbi = NCBITaxa()
+    json_taxonomic_affiliations = {'id_1': OrderedDict([('Bacteria', [2]), ('Yersinia', [629, 444888])]),
+                                   'id_2': OrderedDict([('Eukaryota', [2759]), ('Yersinia', [629, 444888])]),
+                                   'id_3': OrderedDict([('Bacteria', [2]), ('Yersinia', [444888, 629]), ('Yersinia pestis', [632])])}
+    json_taxonomic_affiliations = disambiguate_taxon(json_taxonomic_affiliations, ncbi)
+
+    assert json_taxonomic_affiliations['id_1']['Yersinia'] == [629]
+    assert json_taxonomic_affiliations['id_2']['Yersinia'] == [444888]
+    assert json_taxonomic_affiliations['id_3']['Yersinia'] == [629]
+
+
 def test_filter_rank_limit():
     ncbi = NCBITaxa()
     update_affiliations = None
@@ -99,6 +132,18 @@ def test_filter_rank_limit():
         assert expected_json_taxonomic_affiliations['id_1'][taxon] == json_taxonomic_affiliations['id_1'][taxon]
 
 
+def test_group_identical_affiliations():
+    taxonomies = {'id_1': 'Bacteria;Yersinia', 'id_2': 'Bacteria;Bacillus', 'id_3': ' Bacteria; Yersinia', 'id_4': float('nan')}
+    unique_taxonomies, observation_representatives = group_identical_affiliations(taxonomies)
+
+    assert unique_taxonomies == {'id_1': 'Bacteria;Yersinia', 'id_2': 'Bacteria;Bacillus'}
+    assert observation_representatives == {'id_1': 'id_1', 'id_2': 'id_2', 'id_3': 'id_1'}
+
+    proteomes_ids = expand_to_observations({'id_1': (629, ['UP000000815']), 'id_2': (1386, ['UP000001570'])}, observation_representatives)
+    assert list(proteomes_ids.keys()) == ['id_1', 'id_2', 'id_3']
+    assert proteomes_ids['id_3'] == (629, ['UP000000815'])
+
+
 def test_organism_ids():
     ncbi = NCBITaxa()
     proteomes, organism_ids, proteomes_data = rest_query_proteomes('test', '9', 'Buchnera aphidicola', 80, None, None)
@@ -151,6 +196,49 @@ def test_update_taxonomy():
     assert new_taxonomic_affiliation == expected_taconomic_affiliation
 
 
+def test_update_taxonomy_shared_lineages():
+    ncbi = NCBITaxa()
+    taxon_lineages = {}
+    outdated_taxonomic_affiliations = ['Bacteria;Yersinia', 'Gammaproteobacteria;Yersinia', 'Proteobacteria;Yersinia;Yersinia pestis']
+    tax_names_to_ids = translate_taxon_names([taxon for affiliation in outdated_taxonomic_affiliations for taxon in affiliation.split(';')], ncbi)
+    new_taxonomic_affiliations = [update_taxonomy('test', affiliation, ncbi, tax_names_to_ids, taxon_lineages)
+                                  for affiliation in outdated_taxonomic_affiliations]
+
+    expected_taconomic_affiliation = 'root;cellular organisms;Bacteria;Pseudomonadota;Gammaproteobacteria;Enterobacterales;Yersiniaceae;Yersinia'
+    assert new_taxonomic_affiliations[0] == expected_taconomic_affiliation
+    assert new_taxonomic_affiliations[1] == expected_taconomic_affiliation
+    assert new_taxonomic_affiliations[2] == expected_taconomic_affiliation + ';Yersinia pestis'
+    # Lineages of the two Yersinia taxon IDs are computed once and reused.
+    assert set(taxon_lineages) == {2, 629, 444888, 1224, 1236, 632}
+
+
+class ChunkedResponse:
+    # Response streamed by chunks, as requests Response with stream=True.
+    def __init__(self, content, url):
+        self.content = content
+        self.url = url
+
+    def iter_content(self, chunk_size):
+        for position in range(0, len(self.content), chunk_size):
+            yield self.content[position:position+chunk_size]
+
+
+def test_iter_json_results():
+    results = [{'id': 'UP000000625', 'taxonomy': {'taxonId': 83333}, 'components': [{'name': 'Chromosome', 'description': 'Escherichia coli ["K-12"]'}]},
+               {'id': 'UP000001014', 'taxonomy': {'taxonId': 99287}, 'components': []}]
+    content = json.dumps({'results': results}).encode('utf-8')
+    for chunk_size in [1, 7, len(content)]:
+        assert list(iter_json_results(ChunkedResponse(content, 'test'), chunk_size)) == results
+
+    truncated_response = ChunkedResponse(content[:-20], 'test')
+    try:
+        list(iter_json_results(truncated_response, 7))
+        incomplete_error = False
+    except ValueError:
+        incomplete_error = True
+    assert incomplete_error
+
+
 def test_rest_query_proteomes():
     expected_proteoems = ['UP000255169', 'UP000000815']
     expected_organism_ids = {'632': ['UP000000815'], '29486': ['UP000255169']}
@@ -314,6 +402,18 @@ def test_find_proteome_sparql_all_proteomes():
         assert data in proteomes_data
 
 
+def test_sparql_query_proteomes_batch():
+    tax_id_proteomes = sparql_query_proteomes_batch({54906: ('test', 'Albuliformes'), 33256: ('test', 'Ascaridoidea')}, 80, all_proteomes=None)
+    time.sleep(1)
+
+    for tax_id, tax_name in [(54906, 'Albuliformes'), (33256, 'Ascaridoidea')]:
+        proteomes, organism_ids, proteomes_data = sparql_query_proteomes('test', tax_id, tax_name, 80, all_proteomes=None)
+        time.sleep(1)
+        assert set(proteomes) == set(tax_id_proteomes[tax_id][0])
+        assert organism_ids.keys() == tax_id_proteomes[tax_id][1].keys()
+        assert sorted(proteome_data[0] for proteome_data in proteomes_data) == sorted(proteome_data[0] for proteome_data in tax_id_proteomes[tax_id][2])
+
+
 def test_find_proteomes_tax_ids():
     expected_proteomes_ids = {'id_1': (629, ['UP000000815', 'UP000255169'])}
     ncbi = NCBITaxa()
@@ -347,6 +447,502 @@ def test_sparql_find_proteomes_tax_ids():
         assert set(expected_proteomes_ids[taxon][1]) == set(proteomes_ids[taxon][1])
 
 
+class PagedSession:
+    # Session answering the pages of a batch query, linked with the Link header as UniProt REST.
+    def __init__(self, nb_pages):
+        self.nb_pages = nb_pages
+        self.urls = []
+
+    def get(self, url, stream=False):
+        self.urls.append(url)
+        page = len(self.urls)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = str(page).encode('utf-8')
+        if page < self.nb_pages:
+            response.headers['Link'] = '<https://rest.uniprot.org/page{0}>; rel="next"'.format(page + 1)
+        return response
+
+
+class CountingRateLimiter:
+    def __init__(self):
+        self.nb_tokens = 0
+
+    def acquire(self):
+        self.nb_tokens += 1
+        return 0
+
+
+def test_get_batch_rate_limiter():
+    session = PagedSession(3)
+    rate_limiter = CountingRateLimiter()
+    assert [response.text for response in get_batch(session, 'https://rest.uniprot.org/page1', rate_limiter=rate_limiter)] == ['1', '2', '3']
+    assert session.urls == ['https://rest.uniprot.org/page1', 'https://rest.uniprot.org/page2', 'https://rest.uniprot.org/page3']
+    # A token is used for each page.
+    assert rate_limiter.nb_tokens == 3
+
+
+def test_find_proteomes_tax_ids_not_founds(monkeypatch):
+    tax_id_proteomes = {'629': ['UP000000815', 'UP000255169']}
+    def fake_rest_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_keep, all_proteomes, session=None, option_bioservices=None,
+                                  minimal_number_proteomes=1, rate_limiter=None):
+        proteomes = tax_id_proteomes.get(tax_id, [])
+        return proteomes, {'632': proteomes}, [[proteome, 100, 'full', '632', True, None] for proteome in proteomes]
+    monkeypatch.setattr(esmecata.proteomes, 'rest_query_proteomes', fake_rest_query_proteomes)
+
+    json_taxonomic_affiliations = {'id_1': OrderedDict([('Bacteria', ['2']), ('Yersinia', ['629']), ('Yersinia pestis', ['632'])]),
+                                   'id_2': OrderedDict([('Bacteria', ['2']), ('Yersinia', ['629']), ('Yersinia pestis', ['632'])]),
+                                   'id_3': OrderedDict([('Bacteria', ['2']), ('Proteobacteria', ['1224'])])}
+    proteomes_description_folder = 'proteomes_description_not_founds'
+    os.mkdir(proteomes_description_folder)
+    proteomes_ids, single_proteomes, tax_id_not_founds = find_proteomes_tax_ids(json_taxonomic_affiliations=json_taxonomic_affiliations, ncbi=None,
+                                                                                proteomes_description_folder=proteomes_description_folder,
+                                                                                busco_percentage_keep=90, all_proteomes=None)
+    shutil.rmtree(proteomes_description_folder)
+
+    assert proteomes_ids == {'id_1': ('629', ['UP000000815', 'UP000255169']), 'id_2': ('629', ['UP000000815', 'UP000255169'])}
+    # Taxa without proteomes reached by the rank-walks, with the taxon name of the first observation reaching them.
+    assert tax_id_not_founds == {'632': ['Yersinia pestis'], '1224': ['Proteobacteria'], '2': ['Bacteria']}
+    assert list(tax_id_not_founds) == ['632', '1224', '2']
+
+
+SUBTREE_AFFILIATIONS = {'id_1': OrderedDict([('Bacteria', [2]), ('Enterobacterales', [91347]), ('Yersiniaceae', [1903411]), ('Yersinia', [629]), ('Yersinia pestis', [632])]),
+                        'id_2': OrderedDict([('Bacteria', [2]), ('Enterobacterales', [91347]), ('Yersiniaceae', [1903411]), ('Yersinia', [629]), ('Yersinia ruckeri', [29486])]),
+                        'id_3': OrderedDict([('Bacteria', [2]), ('Enterobacteriaceae', [543]), ('Escherichia', [561]), ('species not found', ['not_found'])]),
+                        'id_4': OrderedDict([('Bacteria', [2]), ('Bacillota', [1239])])}
+
+# proteome_id, busco_score, assembly_level, org_tax_id, reference_proteome, component_elements
+SUBTREE_PROTEOMES_DATA = [['UP000000001', 95, 'full', '632', True, None],
+                          ['UP000000002', 80, 'full', '632', True, None],
+                          ['UP000000003', 99, 'partial', '29486', False, None],
+                          ['UP000000004', 92, 'full', '29486', False, None]]
+
+
+def test_find_subtree_taxa():
+    ncbi = NCBITaxa()
+    subtree_taxa = find_subtree_taxa(SUBTREE_AFFILIATIONS, ncbi, 'family')
+    # Observations are grouped by their taxon at the subtree rank, id_4 has no family.
+    assert subtree_taxa == {'id_1': ((1903411, 'Yersiniaceae'), [(629, 'Yersinia'), (632, 'Yersinia pestis')]),
+                            'id_2': ((1903411, 'Yersiniaceae'), [(629, 'Yersinia'), (29486, 'Yersinia ruckeri')]),
+                            'id_3': ((543, 'Enterobacteriaceae'), [(561, 'Escherichia')])}
+
+
+def test_select_proteomes():
+    proteomes, organism_ids = select_proteomes('id_1', 629, 'Yersinia', SUBTREE_PROTEOMES_DATA, 90, None)
+    assert proteomes == ['UP000000001']
+    assert organism_ids == {'632': ['UP000000001'], '29486': ['UP000000004']}
+    # Not enough reference proteomes, non-reference proteomes are added.
+    proteomes, _ = select_proteomes('id_1', 629, 'Yersinia', SUBTREE_PROTEOMES_DATA, 90, None, minimal_number_proteomes=2)
+    assert proteomes == ['UP000000004', 'UP000000001']
+    proteomes, _ = select_proteomes('id_1', 629, 'Yersinia', SUBTREE_PROTEOMES_DATA, 90, True)
+    assert proteomes == ['UP000000004', 'UP000000001']
+    proteomes, organism_ids = select_proteomes('id_1', 629, 'Yersinia', SUBTREE_PROTEOMES_DATA, None, None)
+    assert proteomes == ['UP000000001', 'UP000000002']
+    assert organism_ids == {'632': ['UP000000001', 'UP000000002'], '29486': ['UP000000004']}
+    # With SPARQL, reference proteomes are also non-reference proteomes.
+    proteomes, _ = select_proteomes('id_1', 629, 'Yersinia', SUBTREE_PROTEOMES_DATA, 90, None, sparql_proteomes=True)
+    assert proteomes == {'UP000000001'}
+    proteomes, _ = select_proteomes('id_1', 629, 'Yersinia', SUBTREE_PROTEOMES_DATA, 90, True, sparql_proteomes=True)
+    assert proteomes == {'UP000000001', 'UP000000004'}
+
+
+def test_get_organism_lineages():
+    ncbi = NCBITaxa()
+    organism_lineages = get_organism_lineages(['632', '29486', '999999999'], ncbi)
+    assert organism_lineages == {'632': {1, 131567, 2, 1224, 1236, 91347, 1903411, 629, 632},
+                                 '29486': {1, 131567, 2, 1224, 1236, 91347, 1903411, 629, 29486},
+                                 '999999999': set()}
+
+
+def test_find_proteomes_tax_ids_subtree_rank(monkeypatch):
+    queried_tax_ids = []
+    def fake_rest_query_proteomes(observation_name, tax_id, tax_name, busco_percentage_keep, all_proteomes, session=None, option_bioservices=None,
+                                  minimal_number_proteomes=1, rate_limiter=None):
+        queried_tax_ids.append(tax_id)
+        proteomes_data = SUBTREE_PROTEOMES_DATA if tax_id == 1903411 else []
+        proteomes, organism_ids = select_proteomes(observation_name, tax_id, tax_name, proteomes_data, busco_percentage_keep, all_proteomes, minimal_number_proteomes)
+        return proteomes, organism_ids, proteomes_data
+    monkeypatch.setattr(esmecata.proteomes, 'rest_query_proteomes', fake_rest_query_proteomes)
+
+    json_taxonomic_affiliations = {observation_name: SUBTREE_AFFILIATIONS[observation_name] for observation_name in ['id_1', 'id_2']}
+    proteomes_description_folder = 'proteomes_description_subtree'
+    os.mkdir(proteomes_description_folder)
+    proteomes_ids, _, _ = find_proteomes_tax_ids(json_taxonomic_affiliations=json_taxonomic_affiliations, ncbi=NCBITaxa(),
+                                                 proteomes_description_folder=proteomes_description_folder,
+                                                 busco_percentage_keep=90, all_proteomes=None, subtree_rank='family')
+    with open(os.path.join(proteomes_description_folder, 'id_2.tsv'), 'r') as open_file:
+        id_2_descriptions = list(csv.reader(open_file, delimiter='\t'))
+    shutil.rmtree(proteomes_description_folder)
+
+    # Only the family is queried, the proteomes of the lower taxa are selected with the lineage of their organisms.
+    assert queried_tax_ids == [1903411]
+    assert proteomes_ids == {'id_1': (632, ['UP000000001']), 'id_2': (29486, ['UP000000004'])}
+    assert [row[:3] for row in id_2_descriptions[1:]] == [['29486', 'Yersinia ruckeri', 'UP000000003'], ['29486', 'Yersinia ruckeri', 'UP000000004']]
+
+
+def test_check_proteome_file():
+    proteome_file = 'test_proteome.faa.gz'
+    with gzip.open(proteome_file, 'wt') as output_file:
+        output_file.write('>sp|P0A7B8|HSLV_ECOLI\nMTTIVSVRRNGHVVIAGDGQ\n>tr|A0A0H3|A0A0H3_ECOLI\nMKV\n')
+    assert check_proteome_file(proteome_file) == ['P0A7B8', 'A0A0H3']
+    assert check_proteome_file(proteome_file, 2) == ['P0A7B8', 'A0A0H3']
+
+    error = None
+    try:
+        check_proteome_file(proteome_file, 3)
+    except ValueError as check_error:
+        error = check_error
+    assert error is not None
+
+    # Truncated gzip file.
+    with open(proteome_file, 'rb') as input_file:
+        proteome_data = input_file.read()
+    with open(proteome_file, 'wb') as output_file:
+        output_file.write(proteome_data[:-8])
+    error = None
+    try:
+        check_proteome_file(proteome_file)
+    except EOFError as check_error:
+        error = check_error
+    assert error is not None
+    os.remove(proteome_file)
+
+
+PROTEOME_DATA = gzip.compress(b'>sp|P0A7B8|HSLV_ECOLI\nMTTIVSVRRNGHVVIAGDGQ\n>tr|A0A0H3|A0A0H3_ECOLI\nMKV\n')
+
+
+def proteome_response(status_code, content, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.raw = io.BytesIO(content)
+    if headers is not None:
+        response.headers.update(headers)
+    return response
+
+
+class ProteomeSession:
+    # Session giving its answers (responses or exceptions) in order to the proteome downloads.
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.request_headers = []
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        self.request_headers.append(headers)
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+def test_download_proteomes_retry(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    proteomes_folder = 'download_proteomes_output'
+    os.makedirs(proteomes_folder, exist_ok=True)
+    # Temporary files left by an interrupted run for a proteome not to download anymore.
+    stale_files = ['.UP000000009_x1y2z3' + esmecata.proteomes.PROTEOME_TMP_SUFFIX, '.UP000000009' + esmecata.proteomes.PROTEOME_PARTIAL_SUFFIX,
+                   '.UP000000009' + esmecata.proteomes.PROTEOME_PARTIAL_SUFFIX + '.json']
+    for stale_file in stale_files:
+        with open(os.path.join(proteomes_folder, stale_file), 'w') as output_file:
+            output_file.write('stale')
+
+    session = ProteomeSession([requests.exceptions.ConnectionError('Connection reset by peer'),
+                               proteome_response(200, PROTEOME_DATA, {'X-Total-Results': '2'})])
+    failed_proteomes, download_statistics = download_proteomes({'UP000000001'}, proteomes_folder, session, download_rate=100, nb_attempts=2)
+    proteomes_files = sorted(os.listdir(proteomes_folder))
+    with open(os.path.join(proteomes_folder, 'UP000000001.faa.gz'), 'rb') as input_file:
+        proteome_data = input_file.read()
+    shutil.rmtree(proteomes_folder)
+
+    assert failed_proteomes == []
+    assert len(session.request_headers) == 2
+    assert proteome_data == PROTEOME_DATA
+    assert download_statistics == {'resumed_downloads': 0, 'resumed_bytes': 0, 'redownloaded_bytes': 0}
+    # The stale temporary files have been removed and no temporary file is left.
+    assert proteomes_files == ['UP000000001.accessions', 'UP000000001.faa.gz']
+
+
+def test_download_proteomes_truncated(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    proteomes_folder = 'download_proteomes_truncated_output'
+    os.makedirs(proteomes_folder, exist_ok=True)
+
+    # A truncated gzip file is rejected and downloaded again from the start.
+    session = ProteomeSession([proteome_response(200, PROTEOME_DATA[:-8], {'X-Total-Results': '2', 'ETag': '"v1"'}),
+                               proteome_response(200, PROTEOME_DATA, {'X-Total-Results': '2', 'ETag': '"v1"'})])
+    failed_proteomes, _ = download_proteomes({'UP000000001'}, proteomes_folder, session, download_rate=100, nb_attempts=2)
+    proteomes_files = sorted(os.listdir(proteomes_folder))
+    shutil.rmtree(proteomes_folder)
+
+    assert failed_proteomes == []
+    assert session.request_headers == [{}, {}]
+    assert proteomes_files == ['UP000000001.accessions', 'UP000000001.faa.gz']
+
+    # Proteome with less protein sequences than expected at each attempt.
+    os.makedirs(proteomes_folder, exist_ok=True)
+    session = ProteomeSession([proteome_response(200, PROTEOME_DATA, {'X-Total-Results': '3'}),
+                               proteome_response(200, PROTEOME_DATA, {'X-Total-Results': '3'})])
+    failed_proteomes, _ = download_proteomes({'UP000000001'}, proteomes_folder, session, download_rate=100, nb_attempts=2)
+    proteomes_files = os.listdir(proteomes_folder)
+    shutil.rmtree(proteomes_folder)
+
+    assert failed_proteomes == ['UP000000001']
+    assert proteomes_files == []
+
+
+def write_partial_download(proteomes_folder, partial_data, validator):
+    os.makedirs(proteomes_folder, exist_ok=True)
+    partial_proteome_file = os.path.join(proteomes_folder, '.UP000000001' + esmecata.proteomes.PROTEOME_PARTIAL_SUFFIX)
+    with open(partial_proteome_file, 'wb') as output_file:
+        output_file.write(partial_data)
+    http_str = 'https://rest.uniprot.org/uniprotkb/stream?query=proteome:UP000000001&format=fasta&compressed=true'
+    with open(partial_proteome_file + '.json', 'w') as output_file:
+        json.dump({'url': http_str, 'validator': validator}, output_file)
+
+
+def test_download_proteomes_resume():
+    proteomes_folder = 'download_proteomes_resume_output'
+    write_partial_download(proteomes_folder, PROTEOME_DATA[:20], '"v1"')
+    session = ProteomeSession([proteome_response(206, PROTEOME_DATA[20:], {'X-Total-Results': '2', 'ETag': '"v1"',
+                                                                           'Content-Range': 'bytes 20-{0}/{1}'.format(len(PROTEOME_DATA)-1, len(PROTEOME_DATA))})])
+    failed_proteomes, download_statistics = download_proteomes({'UP000000001'}, proteomes_folder, session, download_rate=100, nb_attempts=1)
+    proteomes_files = sorted(os.listdir(proteomes_folder))
+    with open(os.path.join(proteomes_folder, 'UP000000001.faa.gz'), 'rb') as input_file:
+        proteome_data = input_file.read()
+    shutil.rmtree(proteomes_folder)
+
+    assert failed_proteomes == []
+    assert session.request_headers == [{'Range': 'bytes=20-', 'If-Range': '"v1"'}]
+    assert proteome_data == PROTEOME_DATA
+    assert download_statistics == {'resumed_downloads': 1, 'resumed_bytes': 20, 'redownloaded_bytes': 0}
+    assert proteomes_files == ['UP000000001.accessions', 'UP000000001.faa.gz']
+
+
+def test_download_proteomes_changed_validator():
+    proteomes_folder = 'download_proteomes_changed_output'
+    write_partial_download(proteomes_folder, PROTEOME_DATA[:20], '"v1"')
+    # The proteome has changed since the partial download, the server sends the whole proteome.
+    session = ProteomeSession([proteome_response(200, PROTEOME_DATA, {'X-Total-Results': '2', 'ETag': '"v2"'})])
+    failed_proteomes, download_statistics = download_proteomes({'UP000000001'}, proteomes_folder, session, download_rate=100, nb_attempts=1)
+    proteomes_files = sorted(os.listdir(proteomes_folder))
+    with open(os.path.join(proteomes_folder, 'UP000000001.faa.gz'), 'rb') as input_file:
+        proteome_data = input_file.read()
+    shutil.rmtree(proteomes_folder)
+
+    assert failed_proteomes == []
+    assert session.request_headers == [{'Range': 'bytes=20-', 'If-Range': '"v1"'}]
+    assert proteome_data == PROTEOME_DATA
+    assert download_statistics == {'resumed_downloads': 0, 'resumed_bytes': 0, 'redownloaded_bytes': 20}
+    assert proteomes_files == ['UP000000001.accessions', 'UP000000001.faa.gz']
+
+
+def test_download_proteomes_range_not_satisfiable():
+    proteomes_folder = 'download_proteomes_416_output'
+    # Complete download interrupted before being checked and renamed.
+    write_partial_download(proteomes_folder, PROTEOME_DATA, '"v1"')
+    session = ProteomeSession([proteome_response(416, b'', {'Content-Range': 'bytes */{0}'.format(len(PROTEOME_DATA))}),
+                               proteome_response(200, PROTEOME_DATA, {'X-Total-Results': '2', 'ETag': '"v1"'})])
+    failed_proteomes, download_statistics = download_proteomes({'UP000000001'}, proteomes_folder, session, download_rate=100, nb_attempts=1)
+    proteomes_files = sorted(os.listdir(proteomes_folder))
+    with open(os.path.join(proteomes_folder, 'UP000000001.faa.gz'), 'rb') as input_file:
+        proteome_data = input_file.read()
+    shutil.rmtree(proteomes_folder)
+
+    assert failed_proteomes == []
+    assert session.request_headers == [{'Range': 'bytes={0}-'.format(len(PROTEOME_DATA)), 'If-Range': '"v1"'}, {}]
+    assert proteome_data == PROTEOME_DATA
+    assert download_statistics == {'resumed_downloads': 0, 'resumed_bytes': 0, 'redownloaded_bytes': len(PROTEOME_DATA)}
+    assert proteomes_files == ['UP000000001.accessions', 'UP000000001.faa.gz']
+
+
+def test_retrieve_proteomes_failed_download(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    output_folder = 'retrieve_proteomes_failed_output'
+    session = ProteomeSession([requests.exceptions.ConnectionError('Connection reset by peer')])
+    monkeypatch.setattr(esmecata.proteomes, 'check_proteomes', lambda *args: ({'UP000000001'}, session))
+    real_download_proteomes = esmecata.proteomes.download_proteomes
+    def download_proteomes_once(proteome_to_download, proteomes_folder, session, uniprot_sparql_endpoint, option_bioservices):
+        return real_download_proteomes(proteome_to_download, proteomes_folder, session, uniprot_sparql_endpoint, option_bioservices,
+                                       download_rate=100, nb_attempts=1)
+    monkeypatch.setattr(esmecata.proteomes, 'download_proteomes', download_proteomes_once)
+
+    error = None
+    try:
+        retrieve_proteomes('buchnera_workflow.tsv', output_folder)
+    except SystemExit as exit_error:
+        error = exit_error
+    proteomes_files = os.listdir(os.path.join(output_folder, 'proteomes'))
+    shutil.rmtree(output_folder)
+
+    assert error is not None
+    assert proteomes_files == []
+
+
+SPARQL_PROTEIN_ROWS = [['http://purl.uniprot.org/proteomes/UP000000001', 'http://purl.uniprot.org/uniprot/P0A7B8', 'HSLV_ECOLI',
+                        'http://purl.uniprot.org/isoforms/P0A7B8-1', 'MTTIVSVRRNGHVVIAGDGQ', 'true^^http://www.w3.org/2001/XMLSchema#boolean'],
+                       ['http://purl.uniprot.org/proteomes/UP000000002', 'http://purl.uniprot.org/uniprot/A0A0H3', 'A0A0H3_YERPE',
+                        'http://purl.uniprot.org/isoforms/A0A0H3-1', 'M' + 'K' * 69, 'false^^http://www.w3.org/2001/XMLSchema#boolean'],
+                       # Non-canonical isoform, not written.
+                       ['http://purl.uniprot.org/proteomes/UP000000001', 'http://purl.uniprot.org/uniprot/P0A7B8', 'HSLV_ECOLI',
+                        'http://purl.uniprot.org/isoforms/P0A7B8-2', 'MTTIV', 'true^^http://www.w3.org/2001/XMLSchema#boolean'],
+                       ['http://purl.uniprot.org/proteomes/UP000000001', 'http://purl.uniprot.org/uniprot/P0A6F5', 'CH60_ECOLI',
+                        'http://purl.uniprot.org/isoforms/P0A6F5-1', 'MAAKDVKFGN', '1']]
+
+
+SPARQL_COUNT_ROWS = [['http://purl.uniprot.org/proteomes/UP000000001', '2^^http://www.w3.org/2001/XMLSchema#integer'],
+                     ['http://purl.uniprot.org/proteomes/UP000000002', '1^^http://www.w3.org/2001/XMLSchema#integer']]
+
+
+def test_sparql_download_proteomes(monkeypatch):
+    sparql_queries = []
+    def fake_stream_uniprot_sparql_query(sparql_query, uniprot_sparql_endpoint):
+        sparql_queries.append(sparql_query)
+        answer_rows = SPARQL_COUNT_ROWS if 'COUNT' in sparql_query else SPARQL_PROTEIN_ROWS
+        for line in answer_rows:
+            yield line
+    monkeypatch.setattr(esmecata.proteomes, 'stream_uniprot_sparql_query', fake_stream_uniprot_sparql_query)
+
+    proteomes_folder = 'sparql_download_proteomes_output'
+    os.makedirs(proteomes_folder, exist_ok=True)
+    sparql_download_proteomes(['UP000000001', 'UP000000002'], proteomes_folder, 'https://sparql.uniprot.org/sparql')
+    proteomes_files = sorted(os.listdir(proteomes_folder))
+    proteome_sequences = {}
+    proteome_accessions = {}
+    for proteome in ['UP000000001', 'UP000000002']:
+        with gzip.open(os.path.join(proteomes_folder, proteome+'.faa.gz'), 'rt') as input_file:
+            proteome_sequences[proteome] = input_file.read()
+        with open(os.path.join(proteomes_folder, proteome+'.accessions'), 'r') as input_file:
+            proteome_accessions[proteome] = input_file.read().splitlines()
+    shutil.rmtree(proteomes_folder)
+
+    # The sequences of the two proteomes are counted with a single query and downloaded with a single query.
+    assert len(sparql_queries) == 2
+    assert all('VALUES (?proteome) { (proteome:UP000000001) (proteome:UP000000002) }' in sparql_query for sparql_query in sparql_queries)
+    assert proteome_sequences['UP000000001'] == '>sp|P0A7B8|HSLV_ECOLI\nMTTIVSVRRNGHVVIAGDGQ\n>sp|P0A6F5|CH60_ECOLI\nMAAKDVKFGN\n'
+    assert proteome_sequences['UP000000002'] == '>tr|A0A0H3|A0A0H3_YERPE\n' + 'M' + 'K' * 59 + '\n' + 'K' * 10 + '\n'
+    assert proteome_accessions == {'UP000000001': ['P0A7B8', 'P0A6F5'], 'UP000000002': ['A0A0H3']}
+    assert proteomes_files == ['UP000000001.accessions', 'UP000000001.faa.gz', 'UP000000002.accessions', 'UP000000002.faa.gz']
+
+
+def test_sparql_download_proteomes_truncated(monkeypatch):
+    # The answer stops after the first sequence of UP000000001.
+    def fake_stream_uniprot_sparql_query(sparql_query, uniprot_sparql_endpoint):
+        answer_rows = SPARQL_COUNT_ROWS if 'COUNT' in sparql_query else SPARQL_PROTEIN_ROWS[:3]
+        for line in answer_rows:
+            yield line
+    monkeypatch.setattr(esmecata.proteomes, 'stream_uniprot_sparql_query', fake_stream_uniprot_sparql_query)
+
+    proteomes_folder = 'sparql_download_proteomes_truncated_output'
+    os.makedirs(proteomes_folder, exist_ok=True)
+    error = None
+    try:
+        sparql_download_proteomes(['UP000000001', 'UP000000002'], proteomes_folder, 'https://sparql.uniprot.org/sparql')
+    except ValueError as download_error:
+        error = download_error
+    proteomes_files = os.listdir(proteomes_folder)
+    shutil.rmtree(proteomes_folder)
+
+    assert error is not None
+    assert proteomes_files == []
+
+
+class FakeSPARQLWrapper:
+    # SPARQLWrapper answering a TSV as UniProt SPARQL endpoint.
+    answer = b''
+    responses = []
+
+    def __init__(self, endpoint):
+        self.agent = 'sparqlwrapper'
+
+    def setQuery(self, query):
+        pass
+
+    def setReturnFormat(self, return_format):
+        pass
+
+    def query(self):
+        query_result = type('QueryResult', (), {})()
+        query_result.response = io.BytesIO(FakeSPARQLWrapper.answer)
+        FakeSPARQLWrapper.responses.append(query_result.response)
+        return query_result
+
+
+def test_stream_uniprot_sparql_query(monkeypatch):
+    monkeypatch.setattr(esmecata.utils, 'SPARQLWrapper', FakeSPARQLWrapper)
+    FakeSPARQLWrapper.answer = '"proteome"\t"protein"\n"http://purl.uniprot.org/proteomes/UP000000001"\t"http://purl.uniprot.org/uniprot/P0A7B8"\n'.encode('utf-8')
+    lines = list(stream_uniprot_sparql_query('SELECT ?proteome ?protein', 'https://sparql.uniprot.org/sparql'))
+    assert lines == [['http://purl.uniprot.org/proteomes/UP000000001', 'http://purl.uniprot.org/uniprot/P0A7B8']]
+
+    # Empty answer.
+    FakeSPARQLWrapper.answer = b''
+    assert list(stream_uniprot_sparql_query('SELECT ?proteome ?protein', 'https://sparql.uniprot.org/sparql')) == []
+    assert all(response.closed for response in FakeSPARQLWrapper.responses)
+
+
+def test_create_cost_plan():
+    output_folder = 'cost_plan_output'
+    proteomes_folder = os.path.join(output_folder, 'proteomes')
+    os.makedirs(proteomes_folder, exist_ok=True)
+    # UP000000001 is already downloaded.
+    with gzip.open(os.path.join(proteomes_folder, 'UP000000001.faa.gz'), 'wt') as proteome_file:
+        proteome_file.write('>sp|P0A7B8|HSLV_ECOLI\nMTTIVSVRRNGHVVIAGDGQATLGNTVMKGNVKKVRRLYNDKVIAGFAGGTADAFTLFELFERKLEMHQGHLVKAAVELAKDWRTDRMLRKLEALLAVADETASLIITGNGDVVQPENDLIAIGSGGPYAQAAARALLENTELSAREIAEKALDIAGDICIYTNHFHTIEELSYKA\n')
+    proteome_tax_id_file = os.path.join(output_folder, 'proteome_tax_id.tsv')
+    with open(proteome_tax_id_file, 'w') as output_file:
+        csvwriter = csv.writer(output_file, delimiter='\t')
+        csvwriter.writerow(['observation_name', 'name', 'tax_id', 'tax_rank', 'proteome'])
+        csvwriter.writerow(['Cluster_1', 'Escherichia coli', '562', 'species', 'UP000000001,UP000000002'])
+        csvwriter.writerow(['Cluster_2', 'Escherichia coli', '562', 'species', 'UP000000001,UP000000002'])
+        csvwriter.writerow(['Cluster_3', 'Yersinia', '629', 'genus', 'UP000000003'])
+    proteome_protein_counts = {'UP000000001': 4000, 'UP000000002': 5000, 'UP000000003': 25000}
+
+    cost_plan = create_cost_plan(proteome_tax_id_file, proteome_protein_counts, proteomes_folder, os.path.join(output_folder, 'cost_plan.json'))
+    with open(os.path.join(output_folder, 'cost_plan.json'), 'r') as input_file:
+        assert json.load(input_file) == cost_plan
+
+    assert cost_plan['download']['number_proteomes'] == 3
+    assert cost_plan['download']['number_local_proteomes'] == 1
+    assert cost_plan['download']['estimated_download_bytes'] == 30000 * 250
+    assert cost_plan['clustering']['number_clusterings'] == 2
+    assert cost_plan['clustering']['estimated_proteins'] == 34000
+    assert cost_plan['annotation']['estimated_queries'] == 4
+    assert cost_plan['taxa']['Escherichia coli']['observation_names'] == ['Cluster_1', 'Cluster_2']
+    assert cost_plan['taxa']['Escherichia coli']['estimated_proteins'] == 9000
+    assert cost_plan['taxa']['Yersinia']['estimated_mmseqs_memory_bytes'] > cost_plan['taxa']['Escherichia coli']['estimated_mmseqs_memory_bytes']
+
+    cost_plan = create_cost_plan(proteome_tax_id_file, proteome_protein_counts, proteomes_folder, os.path.join(output_folder, 'cost_plan.json'),
+                                 uniprot_sparql_endpoint='https://sparql.uniprot.org/sparql')
+    assert cost_plan['annotation']['estimated_queries'] == 2
+
+    shutil.rmtree(output_folder)
+
+
+def test_create_cost_plan_failed_protein_counts(monkeypatch):
+    output_folder = 'cost_plan_failed_output'
+    proteomes_folder = os.path.join(output_folder, 'proteomes')
+    os.makedirs(proteomes_folder, exist_ok=True)
+    proteome_tax_id_file = os.path.join(output_folder, 'proteome_tax_id.tsv')
+    with open(proteome_tax_id_file, 'w') as output_file:
+        csvwriter = csv.writer(output_file, delimiter='\t')
+        csvwriter.writerow(['observation_name', 'name', 'tax_id', 'tax_rank', 'proteome'])
+        csvwriter.writerow(['Cluster_1', 'Escherichia coli', '562', 'species', 'UP000000001,UP000000002'])
+
+    # One query by proteome, the query of UP000000001 fails.
+    monkeypatch.setattr(esmecata.proteomes, 'PROTEOME_COUNT_BATCH_SIZE', 1)
+    session = ProteomeSession([requests.exceptions.ConnectionError('Connection reset by peer'),
+                               proteome_response(200, b'Proteome Id\tProtein count\nUP000000002\t5000\n')])
+    proteome_protein_counts = get_proteome_protein_counts({'UP000000001', 'UP000000002'}, session)
+    assert proteome_protein_counts == {'UP000000002': 5000}
+
+    cost_plan = create_cost_plan(proteome_tax_id_file, proteome_protein_counts, proteomes_folder, os.path.join(output_folder, 'cost_plan.json'))
+    shutil.rmtree(output_folder)
+
+    assert cost_plan['download']['proteomes_without_protein_count'] == ['UP000000001']
+    assert cost_plan['download']['estimated_download_bytes'] == 5000 * 250
+    assert cost_plan['taxa']['Escherichia coli']['estimated_proteins'] == 5000
+
+
 def test_check_cli():
     output_folder = 'proteomes_output'
     subprocess.call(['esmecata', 'check', '-i', 'buchnera_workflow.tsv', '-o', output_folder])
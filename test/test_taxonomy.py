@@ -0,0 +1,145 @@
+import os
+import shutil
+import sqlite3
+
+from collections import Counter
+from ete3 import NCBITaxa
+
+from esmecata.proteomes import subsampling_proteomes
+from esmecata.taxonomy import CachedNCBITaxa, TaxonomyIndex, create_taxonomy_index, get_taxonomy_service
+
+
+def test_cached_ncbi_taxa():
+    ncbi = NCBITaxa()
+    cached_ncbi = CachedNCBITaxa(ncbi)
+
+    for _ in range(2):
+        assert cached_ncbi.get_lineage(629) == ncbi.get_lineage(629)
+        assert cached_ncbi.get_rank([629, '1236', 'not_found']) == ncbi.get_rank([629, 1236])
+        assert cached_ncbi.get_taxid_translator([629, 1236]) == ncbi.get_taxid_translator([629, 1236])
+        assert cached_ncbi.get_name_translator(['Yersinia', 'species not found']) == ncbi.get_name_translator(['Yersinia', 'species not found'])
+
+    cache_statistics = cached_ncbi.cache_statistics()
+    assert cache_statistics['get_lineage'] == {'hits': 1, 'misses': 1, 'size': 1}
+    assert cache_statistics['get_rank'] == {'hits': 2, 'misses': 2, 'size': 2}
+    assert cache_statistics['get_name_translator'] == {'hits': 2, 'misses': 2, 'size': 2}
+
+
+def test_cached_ncbi_taxa_lru():
+    cached_ncbi = CachedNCBITaxa(NCBITaxa(), cache_size=2)
+    cached_ncbi.get_rank([2, 629, 1236])
+
+    assert len(cached_ncbi.rank_cache.entries) == 2
+    assert list(cached_ncbi.rank_cache.entries) == [629, 1236]
+
+
+def test_get_taxonomy_service():
+    assert get_taxonomy_service() is get_taxonomy_service()
+
+
+def test_taxonomy_index():
+    output_folder = 'taxonomy_index_output'
+    os.mkdir(output_folder)
+    index_file = os.path.join(output_folder, 'taxonomy_index.bin')
+    ncbi = NCBITaxa()
+    create_taxonomy_index(index_file)
+    taxonomy_index = TaxonomyIndex(index_file)
+
+    for tax_id in [629, 444888, 562, 107806]:
+        assert taxonomy_index.get_lineage(tax_id) == ncbi.get_lineage(tax_id)
+    assert taxonomy_index.get_rank([629, '1236', 'not_found']) == ncbi.get_rank([629, 1236])
+    assert taxonomy_index.get_taxid_translator([629, 1236]) == ncbi.get_taxid_translator([629, 1236])
+    assert taxonomy_index.get_name_translator(['Yersinia', 'escherichia coli', 'Proteobacteria', 'species not found']) == ncbi.get_name_translator(['Yersinia', 'escherichia coli', 'Proteobacteria', 'species not found'])
+
+    shutil.rmtree(output_folder)
+
+
+def write_ete3_database(ete3_dbfile, species_rows, synonym_rows=[], merged_rows=[]):
+    # Database with the schema of ete3 taxa.sqlite.
+    connection = sqlite3.connect(ete3_dbfile)
+    connection.executescript("""
+    CREATE TABLE stats (version INT PRIMARY KEY);
+    CREATE TABLE species (taxid INT PRIMARY KEY, parent INT, spname VARCHAR(50) COLLATE NOCASE, common VARCHAR(50) COLLATE NOCASE, rank VARCHAR(50), track TEXT);
+    CREATE TABLE synonym (taxid INT,spname VARCHAR(50) COLLATE NOCASE, PRIMARY KEY (spname, taxid));
+    CREATE TABLE merged (taxid_old INT, taxid_new INT);
+    """)
+    for species_row in species_rows:
+        connection.execute('INSERT INTO species (taxid, parent, spname, common, rank, track) VALUES (?, ?, ?, ?, ?, ?);', species_row)
+    for synonym_row in synonym_rows:
+        connection.execute('INSERT INTO synonym (taxid, spname) VALUES (?, ?);', synonym_row)
+    for merged_row in merged_rows:
+        connection.execute('INSERT INTO merged (taxid_old, taxid_new) VALUES (?, ?);', merged_row)
+    connection.commit()
+    connection.close()
+
+
+def test_taxonomy_index_ete3_root():
+    # ete3 stores the root with an empty parent.
+    output_folder = 'taxonomy_index_root_output'
+    os.mkdir(output_folder)
+    ete3_dbfile = os.path.join(output_folder, 'taxa.sqlite')
+    # Like ete3, values are inserted as the strings of the taxdump tables.
+    write_ete3_database(ete3_dbfile, [('1', '', 'root', '', 'no rank', '1'), ('2', '1', 'Bacteria', '', 'superkingdom', '2,1'),
+                                      ('561', '2', 'Escherichia', '', 'genus', '561,2,1'), ('562', '561', 'Escherichia coli', '', 'species', '562,561,2,1')],
+                        synonym_rows=[('562', 'Bacillus coli')], merged_rows=[('1637', '562')])
+
+    index_file = os.path.join(output_folder, 'taxonomy_index.bin')
+    create_taxonomy_index(index_file, ete3_dbfile)
+    taxonomy_index = TaxonomyIndex(index_file)
+
+    assert taxonomy_index.get_lineage(1) == [1]
+    assert taxonomy_index.get_lineage(562) == [1, 2, 561, 562]
+    assert taxonomy_index.get_lineage(1637) == [1, 2, 561, 562]
+    assert taxonomy_index.get_rank([1, 562]) == {1: 'no rank', 562: 'species'}
+    assert taxonomy_index.get_taxid_translator([1, 561]) == {1: 'root', 561: 'Escherichia'}
+    assert taxonomy_index.get_name_translator(['root', 'Bacillus coli']) == {'root': [1], 'Bacillus coli': [562]}
+
+    shutil.rmtree(output_folder)
+
+
+def test_taxonomy_index_corrupted_lineage():
+    output_folder = 'taxonomy_index_corrupted_output'
+    os.mkdir(output_folder)
+    ete3_dbfile = os.path.join(output_folder, 'taxa.sqlite')
+    # Parent 543 of 620 is missing and 10 and 11 are parents of each other.
+    write_ete3_database(ete3_dbfile, [('1', '', 'root', '', 'no rank', '1'), ('2', '1', 'Bacteria', '', 'superkingdom', '2,1'),
+                                      ('620', '543', 'Shigella', '', 'genus', '620,543,2,1'),
+                                      ('10', '11', 'Cellvibrio', '', 'genus', '10,11'), ('11', '10', 'Cellulomonas', '', 'genus', '11,10')])
+    index_file = os.path.join(output_folder, 'taxonomy_index.bin')
+    create_taxonomy_index(index_file, ete3_dbfile)
+    taxonomy_index = TaxonomyIndex(index_file)
+
+    assert taxonomy_index.get_lineage(2) == [1, 2]
+    for taxid in [620, 10]:
+        error = None
+        try:
+            taxonomy_index.get_lineage(taxid)
+        except ValueError as lineage_error:
+            error = lineage_error
+        assert error is not None
+
+    shutil.rmtree(output_folder)
+
+
+def test_subsampling_proteomes_taxonomy_index():
+    output_folder = 'taxonomy_index_output'
+    os.mkdir(output_folder)
+    index_file = os.path.join(output_folder, 'taxonomy_index.bin')
+    create_taxonomy_index(index_file)
+    taxonomy_index = TaxonomyIndex(index_file)
+
+    organism_ids = {'2562891': ['UP000477739'], '208962': ['UP000292187', 'UP000193938', 'UP000650750', 'UP000407502', 'UP000003042'],
+                    '562': ['UP000000625', 'UP000000558', 'UP000464341', 'UP000219757', 'UP000092491',
+                            'UP000567387', 'UP000234906', 'UP000016096', 'UP000017268', 'UP000017618'],
+                    '564': ['UP000510927', 'UP000392711', 'UP000000745', 'UP000033773']}
+    revert_organism_ids ={}
+    for org_id, proteomes in organism_ids.items():
+        revert_organism_ids.update({proteome_id: org_id for proteome_id in proteomes})
+
+    selected_proteomes = subsampling_proteomes(organism_ids, 10, taxonomy_index)
+    selected_organisms = [revert_organism_ids[proteome] for proteome in selected_proteomes]
+
+    expected_proteomes_representation = {'562': 5, '2562891': 1, '208962': 3, '564': 2}
+    assert Counter(selected_organisms) == expected_proteomes_representation
+
+    shutil.rmtree(output_folder)